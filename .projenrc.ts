@@ -257,6 +257,46 @@ project.tasks.tryFind('post-compile')?.exec(
   '-x prefer-ref-interface:aws-cdk-lib.aws_elasticloadbalancingv2.MutualAuthentication.trustStore'
 );
 
+project.tasks.addTask('backtest-outlier-detection', {
+  description: 'Backtests outlier detection algorithms and thresholds over weeks of per-AZ history',
+  steps: [
+    {
+      exec: 'python3 test/backtest_outlier_detection.py',
+      receiveArgs: true,
+    },
+  ],
+});
+
+project.tasks.addTask('benchmark-cold-start', {
+  description: 'Measures the cold start cost of the outlier detection function',
+  steps: [
+    {
+      exec: 'python3 test/benchmark_cold_start.py',
+      receiveArgs: true,
+    },
+  ],
+});
+
+project.tasks.addTask('benchmark-outlier-detection', {
+  description: 'Benchmarks the outlier detection function against the CloudWatch stand-in',
+  steps: [
+    {
+      exec: 'python3 test/benchmark_outlier_detection.py',
+      receiveArgs: true,
+    },
+  ],
+});
+
+project.tasks.addTask('load-test-outlier-detection', {
+  description: 'Drives the outlier detection function with production shaped load against the CloudWatch stand-in',
+  steps: [
+    {
+      exec: 'python3 test/load_outlier_detection.py',
+      receiveArgs: true,
+    },
+  ],
+});
+
 // Run Python unit tests for outlier detection as part of the test workflow
 project.tasks.tryFind('test')?.exec('python3 -m unittest discover -s test -p "test_*.py" -v');
 
@@ -22,6 +22,8 @@ import { IFunction } from 'aws-cdk-lib/aws-lambda';
 import { Construct, IConstruct } from 'constructs';
 import { IContributionDefinition, InsightRuleBody } from './InsightRuleBody';
 import { IAvailabilityZoneMapper } from '../azmapper/IAvailabilityZoneMapper';
+import { OutlierDetectionMetrics } from '../metrics/OutlierDetectionMetrics';
+import { OutlierDetectionMetricProps } from '../metrics/props/OutlierDetectionMetricProps';
 import { RegionalAvailabilityMetrics } from '../metrics/RegionalAvailabilityMetrics';
 import { RegionalLatencyMetrics } from '../metrics/RegionalLatencyMetrics';
 import { ZonalLatencyMetrics } from '../metrics/ZonalLatencyMetrics';
@@ -36,6 +38,7 @@ import { AvailabilityAndLatencyMetrics } from '../metrics/AvailabilityAndLatency
 import { IOperationAvailabilityMetricDetails } from '../services/IOperationAvailabilityMetricDetails';
 import { IOperationLatencyMetricDetails } from '../services/IOperationLatencyMetricDetails';
 import { LatencyOutlierMetricAggregation } from '../outlier-detection/LatencyOutlierMetricAggregation';
+import { OutlierDetectionPrefetch } from '../outlier-detection/OutlierDetectionPrefetch';
 import { MinimumUnhealthyTargets } from '../utilities/MinimumUnhealthyTargets';
 
 /**
@@ -346,30 +349,28 @@ export class AvailabilityAndLatencyAlarmsAndRules {
       ];
     });
 
-    let str: string = JSON.stringify(metricDimensions)
-      .replace(/[\\]/g, '\\\\')
-      .replace(/[\"]/g, '\\"')
-      .replace(/[\/]/g, '\\/')
-      .replace(/[\b]/g, '\\b')
-      .replace(/[\f]/g, '\\f')
-      .replace(/[\n]/g, '\\n')
-      .replace(/[\r]/g, '\\r')
-      .replace(/[\t]/g, '\\t');
-
-    let outlierMetrics: IMetric = new MathExpression({
-      expression:
-        `MAX(LAMBDA("${outlierDetectionFunction.functionName}",` +
-        `"${outlierDetectionAlgorithm.toString()}",` +
-        `"${outlierThreshold}",` +
-        `"${availabilityZoneId}",` +
-        `"${str}",` +
-        `"${metricDetails.metricNamespace}",` +
-        `"${metricDetails.faultMetricNames.join(':')}",` +
-        '"Sum",' +
-        '"Count"' +
-        '))',
-      period: metricDetails.period
-    });
+    let outlierMetricProps: OutlierDetectionMetricProps = {
+      outlierDetectionFunction: outlierDetectionFunction,
+      outlierDetectionAlgorithm: outlierDetectionAlgorithm,
+      outlierThreshold: outlierThreshold,
+      metricDimensions: metricDimensions,
+      metricNamespace: metricDetails.metricNamespace,
+      metricNames: metricDetails.faultMetricNames,
+      statistic: 'Sum',
+      unit: 'Count',
+      period: metricDetails.period,
+    };
+
+    let outlierMetrics: IMetric =
+      OutlierDetectionMetrics.createZonalOutlierMetric(
+        outlierMetricProps,
+        availabilityZoneId,
+      );
+
+    AvailabilityAndLatencyAlarmsAndRules.addOutlierDetectionPrefetchQuery(
+      outlierMetricProps,
+      metricDetails.evaluationPeriods,
+    );
 
     return new Alarm(
       scope,
@@ -390,6 +391,22 @@ export class AvailabilityAndLatencyAlarmsAndRules {
     );
   }
 
+  /**
+   * Adds the alarm's query to the Prefetch event of the outlier detection
+   * function, when the function was created with prefetch enabled, so the
+   * window is fetched shortly before the alarm evaluates it.
+   * @param props The props of the alarm's outlier detection metric
+   * @param evaluationPeriods The number of periods the alarm evaluates
+   */
+  static addOutlierDetectionPrefetchQuery(
+    props: OutlierDetectionMetricProps,
+    evaluationPeriods: number,
+  ): void {
+    OutlierDetectionPrefetch.of(props.outlierDetectionFunction)?.addQuery(
+      OutlierDetectionMetrics.createPrefetchQuery(props, evaluationPeriods),
+    );
+  }
+
   static createZonalFaultRateOutlierAlarmForAlb(
     scope: IConstruct,
     loadBalancers: IApplicationLoadBalancer[],
@@ -423,30 +440,28 @@ export class AvailabilityAndLatencyAlarmsAndRules {
       });
     });
 
-    let str: string = JSON.stringify(metricDimensions)
-      .replace(/[\\]/g, '\\\\')
-      .replace(/[\"]/g, '\\"')
-      .replace(/[\/]/g, '\\/')
-      .replace(/[\b]/g, '\\b')
-      .replace(/[\f]/g, '\\f')
-      .replace(/[\n]/g, '\\n')
-      .replace(/[\r]/g, '\\r')
-      .replace(/[\t]/g, '\\t');
-
-    let outlierMetrics: IMetric = new MathExpression({
-      expression:
-        `MAX(LAMBDA("${outlierDetectionFunction.functionName}",` +
-        `"${outlierDetectionAlgorithm.toString()}",` +
-        `"${outlierThreshold}",` +
-        `"${availabilityZoneId}",` +
-        `"${str}",` +
-        '"AWS/ApplicationELB",' +
-        '"HTTPCode_ELB_5XX_Count:HTTPCode_Target_5XX_Count",' +
-        '"Sum",' +
-        '"Count"' +
-        '))',
-      period: period
-    });
+    let outlierMetricProps: OutlierDetectionMetricProps = {
+      outlierDetectionFunction: outlierDetectionFunction,
+      outlierDetectionAlgorithm: outlierDetectionAlgorithm,
+      outlierThreshold: outlierThreshold,
+      metricDimensions: metricDimensions,
+      metricNamespace: 'AWS/ApplicationELB',
+      metricNames: ['HTTPCode_ELB_5XX_Count', 'HTTPCode_Target_5XX_Count'],
+      statistic: 'Sum',
+      unit: 'Count',
+      period: period,
+    };
+
+    let outlierMetrics: IMetric =
+      OutlierDetectionMetrics.createZonalOutlierMetric(
+        outlierMetricProps,
+        availabilityZoneId,
+      );
+
+    AvailabilityAndLatencyAlarmsAndRules.addOutlierDetectionPrefetchQuery(
+      outlierMetricProps,
+      evaluationPeriods,
+    );
 
     return new Alarm(scope, 'AZ' + counter + 'AlbIsolatedImpactAlarmOutlier', {
       alarmName:
@@ -492,30 +507,28 @@ export class AvailabilityAndLatencyAlarmsAndRules {
       });
     });
 
-    let str: string = JSON.stringify(metricDimensions)
-      .replace(/[\\]/g, '\\\\')
-      .replace(/[\"]/g, '\\"')
-      .replace(/[\/]/g, '\\/')
-      .replace(/[\b]/g, '\\b')
-      .replace(/[\f]/g, '\\f')
-      .replace(/[\n]/g, '\\n')
-      .replace(/[\r]/g, '\\r')
-      .replace(/[\t]/g, '\\t');
-
-    let outlierMetrics: IMetric = new MathExpression({
-      expression:
-        `MAX(LAMBDA("${outlierDetectionFunction.functionName}",` +
-        `"${outlierDetectionAlgorithm.toString()}",` +
-        `"${outlierThreshold}",` +
-        `"${availabilityZoneId}",` +
-        `"${str}",` +
-        '"AWS/NATGateway",' +
-        '"PacketsDropCount",' +
-        '"Sum",' +
-        '"Count"' +
-        '))',
-      period: period
-    });
+    let outlierMetricProps: OutlierDetectionMetricProps = {
+      outlierDetectionFunction: outlierDetectionFunction,
+      outlierDetectionAlgorithm: outlierDetectionAlgorithm,
+      outlierThreshold: outlierThreshold,
+      metricDimensions: metricDimensions,
+      metricNamespace: 'AWS/NATGateway',
+      metricNames: ['PacketsDropCount'],
+      statistic: 'Sum',
+      unit: 'Count',
+      period: period,
+    };
+
+    let outlierMetrics: IMetric =
+      OutlierDetectionMetrics.createZonalOutlierMetric(
+        outlierMetricProps,
+        availabilityZoneId,
+      );
+
+    AvailabilityAndLatencyAlarmsAndRules.addOutlierDetectionPrefetchQuery(
+      outlierMetricProps,
+      evaluationPeriods,
+    );
 
     return new Alarm(
       scope,
@@ -557,33 +570,31 @@ export class AvailabilityAndLatencyAlarmsAndRules {
       ];
     });
 
-    let str: string = JSON.stringify(metricDimensions)
-      .replace(/[\\]/g, '\\\\')
-      .replace(/[\"]/g, '\\"')
-      .replace(/[\/]/g, '\\/')
-      .replace(/[\b]/g, '\\b')
-      .replace(/[\f]/g, '\\f')
-      .replace(/[\n]/g, '\\n')
-      .replace(/[\r]/g, '\\r')
-      .replace(/[\t]/g, '\\t');
-
     // TODO: Incorporate this into the Lambda function logic
     outlierMetric;
 
-    let outlierMetrics: IMetric = new MathExpression({
-      expression:
-        `MAX(LAMBDA("${outlierDetectionFunction.functionName}",` +
-        `"${outlierDetectionAlgorithm.toString()}",` +
-        `"${outlierThreshold}",` +
-        `"${availabilityZoneId}",` +
-        `"${str}",` +
-        `"${metricDetails.metricNamespace}",` +
-        `"${metricDetails.successMetricNames.join(':')}",` +
-        `"TC(${MetricsHelper.convertDurationByUnit(metricDetails.successAlarmThreshold, metricDetails.unit)}:)"`+
-        '"Milliseconds"' +
-        '))',
-      period: metricDetails.period
-    });
+    let outlierMetricProps: OutlierDetectionMetricProps = {
+      outlierDetectionFunction: outlierDetectionFunction,
+      outlierDetectionAlgorithm: outlierDetectionAlgorithm,
+      outlierThreshold: outlierThreshold,
+      metricDimensions: metricDimensions,
+      metricNamespace: metricDetails.metricNamespace,
+      metricNames: metricDetails.successMetricNames,
+      statistic: `TC(${MetricsHelper.convertDurationByUnit(metricDetails.successAlarmThreshold, metricDetails.unit)}:)`,
+      unit: 'Milliseconds',
+      period: metricDetails.period,
+    };
+
+    let outlierMetrics: IMetric =
+      OutlierDetectionMetrics.createZonalOutlierMetric(
+        outlierMetricProps,
+        availabilityZoneId,
+      );
+
+    AvailabilityAndLatencyAlarmsAndRules.addOutlierDetectionPrefetchQuery(
+      outlierMetricProps,
+      metricDetails.evaluationPeriods,
+    );
 
     return new Alarm(
       scope,
@@ -50,6 +50,12 @@ export class CanaryTest extends Construct {
             faultBoundary: 'az',
             metricNamespace: this.metricNamespace,
             requestCount: props.requestCount,
+            requestsPerSecond: props.requestsPerSecond,
+            maxConcurrentRequests: props.maxConcurrentRequests,
+            maxResponseBodyBytes: props.maxResponseBodyBytes,
+            expectedResponseBodySize: props.expectedResponseBodySize,
+            expectedResponseBodySha256: props.expectedResponseBodySha256,
+            aggregateMetrics: props.aggregateMetrics,
           },
         };
 
@@ -90,6 +96,12 @@ export class CanaryTest extends Construct {
         faultBoundary: 'region',
         metricNamespace: this.metricNamespace,
         requestCount: props.regionalRequestCount,
+        requestsPerSecond: props.requestsPerSecond,
+        maxConcurrentRequests: props.maxConcurrentRequests,
+        maxResponseBodyBytes: props.maxResponseBodyBytes,
+        expectedResponseBodySize: props.expectedResponseBodySize,
+        expectedResponseBodySha256: props.expectedResponseBodySha256,
+        aggregateMetrics: props.aggregateMetrics,
       },
     };
 
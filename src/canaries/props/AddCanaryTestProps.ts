@@ -20,6 +20,57 @@ export interface AddCanaryTestProps {
    */
   readonly regionalRequestCount?: number;
 
+  /**
+   * The rate at which the requests are started. Requests are started on
+   * schedule whether or not earlier ones have finished.
+   *
+   * @default - Requests are sent one at a time, waiting one second after each one finishes
+   */
+  readonly requestsPerSecond?: number;
+
+  /**
+   * The maximum number of requests in flight at once, only used
+   * when requestsPerSecond is set
+   *
+   * @default - 10 concurrent requests
+   */
+  readonly maxConcurrentRequests?: number;
+
+  /**
+   * The most bytes of each response body that are kept. Bodies are
+   * streamed, and what is kept is only logged for failed probes.
+   *
+   * @default - 8192 bytes
+   */
+  readonly maxResponseBodyBytes?: number;
+
+  /**
+   * The size in bytes every response body is expected to have. Probes
+   * that get a different size are counted as ResponseBodyCheckFailure.
+   *
+   * @default - The size isn't checked
+   */
+  readonly expectedResponseBodySize?: number;
+
+  /**
+   * The hex SHA-256 digest every response body is expected to have.
+   * Probes that get a different digest are counted as
+   * ResponseBodyCheckFailure.
+   *
+   * @default - The digest isn't checked
+   */
+  readonly expectedResponseBodySha256?: string;
+
+  /**
+   * Whether to aggregate the metrics of successful requests in each
+   * invocation into one EMF event per dimension set, instead of writing
+   * an event for every request. Failed requests are still written
+   * individually with all of their details.
+   *
+   * @default - false
+   */
+  readonly aggregateMetrics?: boolean;
+
   /**
    * A schedule expression
    */
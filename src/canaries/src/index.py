@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 import json
 import http.client
+import http.cookiejar
 import urllib.parse
 import urllib
 import time
@@ -10,26 +11,61 @@ import copy
 import os
 import traceback
 import uuid
+import hashlib
+import socket
+import threading
+import weakref
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from inspect import getfullargspec
 from dateutil import parser
 from datetime import datetime, timedelta, timezone
 from aws_embedded_metrics import metric_scope
+from aws_embedded_metrics.logger.metrics_logger_factory import create_metrics_logger
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.util.connection import allowed_gai_family
 from requests.adapters import HTTPAdapter
 
 ignore_ssl_errors = os.environ.get("IGNORE_SSL_ERRORS")
 region = os.environ.get("REGION")
-#session = requests.Session()
-#session.mount("http://", HTTPAdapter(max_retries = 0))
 
 try:
   timeout = float(os.environ.get("TIMEOUT"))
 except (TypeError, ValueError):
   timeout = 2.0
 
+# Without a rate requests are sent one at a time, pausing this long after
+# each one. With requestsPerSecond they are started at that rate, whether or
+# not earlier ones have finished, on up to maxConcurrentRequests threads
+DEFAULT_REQUESTS_PER_SECOND = None
+DEFAULT_MAX_CONCURRENT_REQUESTS = 10
+SEQUENTIAL_PAUSE_SECONDS = 1
+
+# Response bodies are streamed, keeping at most this many bytes to log when
+# the probe fails
+DEFAULT_MAX_RESPONSE_BODY_BYTES = 8192
+BODY_CHUNK_BYTES = 16384
+
+# When aggregating, a dimension set's values are flushed once it has this many
+AGGREGATION_FLUSH_VALUES = 1000
+
+# A request isn't started unless it can time out this long before the function does
+DEADLINE_MARGIN_MS = 1000
+
+# One session per scheme and host, kept across warm invocations so probes
+# reuse pooled keep-alive connections instead of paying DNS, TCP and TLS
+# setup every time
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Sockets that have already carried a request
+seen_sockets = weakref.WeakSet()
+seen_sockets_lock = threading.Lock()
+
 #patch_all(double_patch=True)
 patch_all()
 
@@ -68,11 +104,231 @@ def latency_timer(method, metric_parameter_name):
     return code
   return timed
 
-@metric_scope
+class TimedConnectionMixin:
+  """
+  Times the DNS lookup, TCP connect and TLS handshake of each new connection
+  into phases, in milliseconds. The host is resolved once, so the lookup can
+  be timed on its own, and each address is tried in turn until one connects,
+  as urllib3 does. ConnectTime is the attempt that connected, the time spent
+  on addresses that failed is FailedConnectTime.
+  """
+  phases = None
+
+  def _new_conn(self):
+    host = self._dns_host
+    begin = time.perf_counter()
+
+    try:
+      addresses = [info[4][0] for info in socket.getaddrinfo(host.strip("[]"), self.port, allowed_gai_family(), socket.SOCK_STREAM)]
+    except socket.gaierror:
+      # Let urllib3 raise its usual error
+      return super()._new_conn()
+
+    resolved = time.perf_counter()
+    failed = 0.0
+    error = None
+
+    for address in addresses:
+      attempt = time.perf_counter()
+      self._dns_host = address
+
+      try:
+        sock = super()._new_conn()
+      except Exception as e:
+        failed += time.perf_counter() - attempt
+        error = e
+        continue
+      finally:
+        self._dns_host = host
+
+      self.phases = {"DnsLookupTime": (resolved - begin) * 1000, "ConnectTime": (time.perf_counter() - attempt) * 1000}
+
+      if error is not None:
+        self.phases["FailedConnectTime"] = failed * 1000
+
+      return sock
+
+    if error is not None:
+      raise error
+
+    return super()._new_conn()
+
+  def connect(self):
+    begin = time.perf_counter()
+    super().connect()
+
+    if isinstance(self, HTTPSConnection) and self.phases is not None:
+      self.phases["TlsHandshakeTime"] = (time.perf_counter() - begin) * 1000 - sum(self.phases.values())
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+  pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+  pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+  ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+  ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+  """An HTTPAdapter whose connections time their setup phases"""
+
+  def init_poolmanager(self, *args, **kwargs):
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+def get_session(parsed_url, pool_size):
+  """The pooled session for the url's scheme and host, created on first use"""
+  key = (parsed_url.scheme, parsed_url.netloc)
+
+  with sessions_lock:
+    if key not in sessions:
+      session = requests.Session()
+      # Each probe should look like a new client to the service
+      session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains = []))
+      adapter = TimedHTTPAdapter(max_retries = 0, pool_connections = 1, pool_maxsize = pool_size)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+      sessions[key] = session
+
+    return sessions[key]
+
+def is_reused(connection):
+  """Whether the connection's socket has carried a request before, and remembers it if not"""
+  sock = getattr(connection, "sock", None)
+
+  if sock is None:
+    return None
+
+  with seen_sockets_lock:
+    if sock in seen_sockets:
+      return True
+
+    seen_sockets.add(sock)
+    return False
+
+def read_body(response, max_bytes, digest):
+  """
+  Streams the body, keeping at most max_bytes of it. Returns the kept bytes,
+  the size of the whole body and, when digest is set, its SHA-256 hex digest.
+  """
+  kept = bytearray()
+  size = 0
+  sha256 = hashlib.sha256() if digest else None
+
+  for chunk in response.iter_content(chunk_size = BODY_CHUNK_BYTES):
+    size += len(chunk)
+
+    if sha256 is not None:
+      sha256.update(chunk)
+
+    if len(kept) < max_bytes:
+      kept += chunk[:max_bytes - len(kept)]
+
+  return bytes(kept), size, sha256.hexdigest() if sha256 is not None else None
+
+class ProbeRecorder:
+  """Records what a probe writes to its metrics so it can be emitted later"""
+
+  def __init__(self):
+    self.context = self
+    self.properties = {}
+    self.values = {}
+    self.units = {}
+    self.namespace = None
+    self.dimensions = None
+
+  def set_property(self, key, value):
+    self.properties[key] = value
+
+  def put_metric(self, key, value, unit = "None"):
+    self.values.setdefault(key, []).append(value)
+    self.units[key] = unit
+
+  def set_namespace(self, namespace):
+    self.namespace = namespace
+
+  def set_dimensions(self, *dimensions):
+    self.dimensions = dimensions[0] if dimensions else None
+
+  def failed(self):
+    return self.values.get("Success") != [1] or 1 in self.values.get("ResponseBodyCheckFailure", [])
+
+def flush(logger):
+  # Probes run on pool threads, flush_sync doesn't need an event loop
+  logger.flush_sync()
+
+def new_logger(namespace, dimensions):
+  logger = create_metrics_logger()
+  logger.set_namespace(namespace)
+
+  if dimensions is not None:
+    logger.set_dimensions(dimensions)
+
+  return logger
+
+class MetricsAggregator:
+  """
+  Collects the metric values of successful probes per namespace and
+  dimension set, and emits them as EMF value arrays in one event each.
+  Failed probes are emitted right away in their own event, with all of
+  their properties, as they are without aggregation.
+  """
+
+  def __init__(self, id):
+    self.id = id
+    self.loggers = {}
+    self.counts = {}
+    self.probes = 0
+    self._lock = threading.Lock()
+
+  def add(self, recorder):
+    if recorder.failed():
+      logger = new_logger(recorder.namespace, recorder.dimensions)
+
+      for key, value in recorder.properties.items():
+        logger.set_property(key, value)
+
+      for key, values in recorder.values.items():
+        for value in values:
+          logger.put_metric(key, value, recorder.units[key])
+
+      flush(logger)
+      return
+
+    key = (recorder.namespace, tuple(sorted((recorder.dimensions or {}).items())))
+
+    with self._lock:
+      self.probes += 1
+
+      if key not in self.loggers:
+        self.loggers[key] = new_logger(recorder.namespace, recorder.dimensions)
+        self.loggers[key].set_property("LambdaRequestId", self.id)
+        self.counts[key] = 0
+
+      for name, values in recorder.values.items():
+        for value in values:
+          self.loggers[key].put_metric(name, value, recorder.units[name])
+
+      self.counts[key] += sum(len(values) for values in recorder.values.values())
+
+      if self.counts[key] >= AGGREGATION_FLUSH_VALUES:
+        flush(self.loggers.pop(key))
+
+  def flush(self):
+    with self._lock:
+      for logger in self.loggers.values():
+        flush(logger)
+
+      self.loggers.clear()
+
 @latency_timer("metrics")
 @xray_recorder.capture('url_check')
-def verify_request(context, item, method, id, metrics = None):
+def probe(context, item, method, id, scheduled_time = None, pool_size = 10, metrics = None):
   method_start = (time.time() * 1000)
+  schedule_delay = None if scheduled_time is None else (time.perf_counter() - scheduled_time) * 1000
   metrics.set_property("MethodStartTime", round(method_start))
   code = None
   
@@ -91,6 +347,11 @@ def verify_request(context, item, method, id, metrics = None):
   fault_boundary_id = item["faultBoundaryId"]
   fault_boundary = item["faultBoundary"]
   metric_namespace = item["metricNamespace"]
+  max_body_bytes = DEFAULT_MAX_RESPONSE_BODY_BYTES
+  if "maxResponseBodyBytes" in item and item["maxResponseBodyBytes"] is not None:
+    max_body_bytes = int(item["maxResponseBodyBytes"])
+  expected_size = item.get("expectedResponseBodySize")
+  expected_sha256 = item.get("expectedResponseBodySha256")
 
   xray_recorder.put_annotation("Source", "canary")
   xray_recorder.put_annotation("Url", url)
@@ -102,6 +363,10 @@ def verify_request(context, item, method, id, metrics = None):
 
     metrics.set_property("Method", method)
     metrics.set_property("Url", url)
+
+    if schedule_delay is not None:
+      metrics.put_metric("ScheduleDelay", schedule_delay, "Milliseconds")
+
     metrics.set_property("PostData", post_data)
     
     parsed_url = urllib.parse.urlparse(url)
@@ -119,7 +384,6 @@ def verify_request(context, item, method, id, metrics = None):
     metrics.set_property("InvocationId", invocation_id)
     h["X-Invocation-Id"] = invocation_id
     
-    metrics.set_property("Headers", h)
     if fault_boundary == "az":
       metrics.set_dimensions({"Operation": operation, "AZ-ID": fault_boundary_id, "Region": region })
     else:
@@ -131,17 +395,45 @@ def verify_request(context, item, method, id, metrics = None):
     try:
       start = (time.time() * 1000)
       metrics.set_property("RequestStartTime", round(start))
+      request_start = time.perf_counter()
       
-      response = requests.request(method = method, headers = h, url = url, data = str(post_data), verify = verify, timeout = timeout, stream = True)
-      data = response.text
+      session = get_session(parsed_url, pool_size)
+      response = session.request(method = method, headers = h, url = url, data = str(post_data), verify = verify, timeout = timeout, stream = True)
+      headers_received = time.perf_counter()
+      # The connection goes back to the pool once the body is read
+      connection = response.raw._connection
+      reused = is_reused(connection)
+      body, body_size, body_sha256 = read_body(response, max_body_bytes, expected_sha256 is not None)
+      body_read = time.perf_counter()
       response_end = time.time() * 1000
-      if response.raw._connection and response.raw._connection.sock:
-        sock = response.raw._connection.sock.getsockname()
+      if connection and connection.sock:
+        sock = connection.sock.getsockname()
         metrics.set_property("RemoteIpAddress", str(sock[0]) + ":" + str(sock[1]))
       else:
         metrics.set_property("RemoteIpAddress", "Unknown")
       metrics.set_property("ResponseReceivedTime", round(response_end))
       metrics.put_metric("TimeToResponseReceived", response_end - start, "Milliseconds")
+
+      # Handshakes only add to the latency of requests on new connections
+      if reused is not None:
+        metrics.set_property("ConnectionReused", reused)
+        metrics.put_metric("NewConnection", 0 if reused else 1, "Count")
+        metrics.put_metric("TimeToResponseReceivedReusedConnection" if reused else "TimeToResponseReceivedNewConnection", response_end - start, "Milliseconds")
+
+      # Setup phases are only reported by the request that opened the connection,
+      # the time to first byte is what's left of the wait for the headers
+      setup = 0
+      phases = getattr(connection, "phases", None) if reused is False else None
+      if phases is not None:
+        for name, value in phases.items():
+          metrics.put_metric(name, value, "Milliseconds")
+          setup += value
+        connection.phases = None
+
+      metrics.put_metric("TimeToFirstByte", max(0, (headers_received - request_start) * 1000 - setup), "Milliseconds")
+      metrics.put_metric("BodyReadTime", (body_read - headers_received) * 1000, "Milliseconds")
+      metrics.put_metric("TimeToResponseBodyRead", (body_read - request_start) * 1000, "Milliseconds")
+      metrics.put_metric("ResponseBodySize", body_size, "Bytes")
     except http.client.RemoteDisconnected as e:
       metrics.set_property("RemoteDisconnected", str(e))
       error = True
@@ -160,6 +452,7 @@ def verify_request(context, item, method, id, metrics = None):
       error = True
      
     if error == True:
+      metrics.set_property("Headers", h)
       metrics.put_metric("Failure", 1, "Count")
       metrics.put_metric("Fault", 0, "Count")
       metrics.put_metric("Error", 0, "Count")
@@ -167,23 +460,37 @@ def verify_request(context, item, method, id, metrics = None):
       return None
     
     code = response.status_code
-    response_headers = dict(response.headers)
 
     metrics.set_property("HttpStatusCode", code) 
-    metrics.set_property("ResponseHeaders", response_headers)
     
     if response.reason:   
       metrics.set_property("Reason", response.reason)
-    
-    try:
-      data = response.text
-      json_obj = json.loads(data)
-      metrics.set_property("Response", json_obj) 
-      response_decode_end = time.time() * 1000
-      metrics.set_property("ResponseDecodedTime", round(response_decode_end))
-      metrics.put_metric("TimeToResponseBodyRead", response_decode_end - start, "Milliseconds")
-    except Exception as e:
-      metrics.set_property("ResponseDecodeError", str(e))
+
+    failed = code < 200 or code > 399
+
+    if expected_size is not None or expected_sha256 is not None:
+      size_mismatch = expected_size is not None and body_size != int(expected_size)
+      sha256_mismatch = expected_sha256 is not None and body_sha256 != expected_sha256.lower()
+      metrics.put_metric("ResponseBodyCheckFailure", (1 if size_mismatch or sha256_mismatch else 0), "Count")
+
+      if size_mismatch:
+        metrics.set_property("ResponseBodySizeMismatch", body_size)
+      if sha256_mismatch:
+        metrics.set_property("ResponseBodySha256Mismatch", body_sha256)
+
+      failed = failed or size_mismatch or sha256_mismatch
+
+    # Only failed probes log the request headers and what was kept of the response
+    if failed:
+      metrics.set_property("Headers", h)
+      metrics.set_property("ResponseHeaders", dict(response.headers))
+      metrics.set_property("ResponseTruncated", body_size > len(body))
+
+      try:
+        metrics.set_property("Response", json.loads(body))
+      except Exception as e:
+        metrics.set_property("Response", body.decode("utf-8", errors = "replace"))
+        metrics.set_property("ResponseDecodeError", str(e))
 
     metrics.put_metric("Success", (1 if code >= 200 and code <= 399 else 0), "Count")
     metrics.put_metric("Error", (1 if code >= 400 and code <= 499 else 0), "Count")
@@ -210,6 +517,71 @@ def verify_request(context, item, method, id, metrics = None):
       metrics.put_metric("Fault", (1 if code >= 500 and code <= 599 else 0), "Count")
       metrics.put_metric("Failure", 0, "Count")     
 
+@metric_scope
+def verify_request(context, item, method, id, scheduled_time = None, pool_size = 10, metrics = None):
+  """Probes the url, emitting its own EMF event"""
+  return probe(context, item, method, id, scheduled_time = scheduled_time, pool_size = pool_size, metrics = metrics)
+
+def verify_request_aggregated(aggregator, context, item, method, id, scheduled_time = None, pool_size = 10):
+  """Probes the url, adding its metrics to the aggregator"""
+  recorder = ProbeRecorder()
+  code = probe(context, item, method, id, scheduled_time = scheduled_time, pool_size = pool_size, metrics = recorder)
+  aggregator.add(recorder)
+  return code
+
+def run_sequential(context, item, methods, id, errors, tracebacks, aggregator = None):
+  """Sends one request per method in methods one after another, returns how many were skipped"""
+  for x, method in enumerate(methods):
+    if context.get_remaining_time_in_millis() < timeout * 1000 + DEADLINE_MARGIN_MS:
+      return len(methods) - x
+
+    try:
+      if aggregator is not None:
+        verify_request_aggregated(aggregator, context, item, method, id, pool_size = 1)
+      else:
+        verify_request(context, item, method, id, pool_size = 1)
+
+      time.sleep(SEQUENTIAL_PAUSE_SECONDS)
+    except Exception as e:
+      errors.append(str(e))
+      tracebacks.append(traceback.format_exc())
+
+  return 0
+
+def run_open_loop(context, item, methods, id, requests_per_second, max_concurrent_requests, errors, tracebacks, aggregator = None):
+  """Starts one request per method in methods at a fixed rate, returns how many were skipped"""
+  interval = 1.0 / requests_per_second
+  begin = time.perf_counter()
+  futures = []
+  skipped = 0
+
+  with ThreadPoolExecutor(max_workers = max_concurrent_requests) as pool:
+    for x, method in enumerate(methods):
+      scheduled_time = begin + x * interval
+      delay = scheduled_time - time.perf_counter()
+
+      if delay > 0:
+        time.sleep(delay)
+
+      if context.get_remaining_time_in_millis() < timeout * 1000 + DEADLINE_MARGIN_MS:
+        skipped = len(methods) - x
+        break
+
+      # Latency is timed inside the request, so it doesn't include waiting for a thread
+      if aggregator is not None:
+        futures.append(pool.submit(verify_request_aggregated, aggregator, context, item, method, id, scheduled_time = scheduled_time, pool_size = max_concurrent_requests))
+      else:
+        futures.append(pool.submit(verify_request, context, item, method, id, scheduled_time = scheduled_time, pool_size = max_concurrent_requests))
+
+    for future in futures:
+      try:
+        future.result()
+      except Exception as e:
+        errors.append(str(e))
+        tracebacks.append(traceback.format_exc())
+
+  return skipped
+
 @metric_scope
 @xray_recorder.capture('handler')
 def handler(event, context, metrics):
@@ -238,19 +610,43 @@ def handler(event, context, metrics):
     if "requestCount" in event["parameters"] and event["parameters"]["requestCount"] is not None:
       request_count = int(event["parameters"]["requestCount"])
 
+    requests_per_second = DEFAULT_REQUESTS_PER_SECOND
+    if "requestsPerSecond" in event["parameters"] and event["parameters"]["requestsPerSecond"] is not None:
+      requests_per_second = float(event["parameters"]["requestsPerSecond"])
+
+    max_concurrent_requests = DEFAULT_MAX_CONCURRENT_REQUESTS
+    if "maxConcurrentRequests" in event["parameters"] and event["parameters"]["maxConcurrentRequests"] is not None:
+      max_concurrent_requests = int(event["parameters"]["maxConcurrentRequests"])
+
+    if requests_per_second is None:
+      max_concurrent_requests = 1
+
     methods = event["parameters"]["methods"]
 
     if methods is None or len(methods) == 0:
       methods = [ "GET" ]
 
-    for method in methods:
-      for x in range(0, request_count):
-        try:
-          verify_request(context, event["parameters"], method, id)
-          time.sleep(1)
-        except Exception as e:
-          errors.append(str(e))
-          tracebacks.append(traceback.format_exc())
+    aggregator = None
+    if "aggregateMetrics" in event["parameters"] and event["parameters"]["aggregateMetrics"] == True:
+      aggregator = MetricsAggregator(id)
+
+    metrics.set_property("RequestsPerSecond", requests_per_second)
+    metrics.set_property("MaxConcurrentRequests", max_concurrent_requests)
+    metrics.set_property("AggregateMetrics", aggregator is not None)
+
+    try:
+      if requests_per_second is None:
+        skipped = run_sequential(context, event["parameters"], [method for method in methods for x in range(0, request_count)], id,
+          errors, tracebacks, aggregator)
+      else:
+        skipped = run_open_loop(context, event["parameters"], [method for method in methods for x in range(0, request_count)], id,
+          requests_per_second, max_concurrent_requests, errors, tracebacks, aggregator)
+
+      metrics.put_metric("SkippedRequests", skipped, "Count")
+    finally:
+      if aggregator is not None:
+        aggregator.flush()
+        metrics.put_metric("AggregatedProbes", aggregator.probes, "Count")
   
   metrics.set_property("Errors", errors)
   metrics.set_property("Tracebacks", tracebacks)
@@ -22,7 +22,10 @@ import { AvailabilityMetricType } from '../utilities/AvailabilityMetricType';
 import { LatencyMetricType } from '../utilities/LatencyMetricType';
 import { MetricsHelper } from '../utilities/MetricsHelper';
 import { AvailabilityAndLatencyMetrics } from '../metrics/AvailabilityAndLatencyMetrics';
+import { OutlierDetectionMetrics } from '../metrics/OutlierDetectionMetrics';
 import { IOperation } from '../services/IOperation';
+import { IOperationMetricDetails } from '../services/IOperationMetricDetails';
+import { OutlierDetectionAlgorithm } from '../utilities/OutlierDetectionAlgorithm';
 
 /**
  * Creates an operation level availability and latency dashboard
@@ -284,6 +287,93 @@ export class OperationAvailabilityAndLatencyDashboard
         ] : []
     );
 
+    if (props.outlierDetectionFunction) {
+      // A single LAMBDA call per widget returns a series for every AZ
+      let metricDimensions = (metricDetails: IOperationMetricDetails): { [key: string]: { [key: string]: string }[] } => {
+        return Object.fromEntries(availabilityZones.map((availabilityZone: string) => {
+          let azLetter: string = availabilityZone.substring(availabilityZone.length - 1);
+          let availabilityZoneId: string = props.azMapper.availabilityZoneIdFromAvailabilityZoneLetter(azLetter);
+
+          return [
+            availabilityZoneId,
+            [metricDetails.metricDimensions.zonalDimensions(availabilityZoneId, Aws.REGION)]
+          ];
+        }));
+      };
+
+      let outlierWidgets: IWidget[] = [];
+
+      if (props.availabilityOutlierDetectionAlgorithm !== undefined &&
+        props.availabilityOutlierDetectionAlgorithm != OutlierDetectionAlgorithm.STATIC &&
+        props.availabilityOutlierThreshold !== undefined
+      ) {
+        outlierWidgets.push(
+          new GraphWidget({
+            height: 6,
+            width: 12,
+            title: 'Fault Rate Outliers',
+            region: Aws.REGION,
+            left: [
+              OutlierDetectionMetrics.createAllZonesOutlierMetric({
+                outlierDetectionFunction: props.outlierDetectionFunction,
+                outlierDetectionAlgorithm: props.availabilityOutlierDetectionAlgorithm,
+                outlierThreshold: props.availabilityOutlierThreshold,
+                metricDimensions: metricDimensions(operation.serverSideAvailabilityMetricDetails),
+                metricNamespace: operation.serverSideAvailabilityMetricDetails.metricNamespace,
+                metricNames: operation.serverSideAvailabilityMetricDetails.faultMetricNames,
+                statistic: 'Sum',
+                unit: 'Count',
+                period: operation.serverSideAvailabilityMetricDetails.period
+              })
+            ],
+            leftYAxis: {
+              min: 0,
+              max: 1,
+              label: 'Outlier',
+              showUnits: false,
+            }
+          })
+        );
+      }
+
+      if (props.latencyOutlierDetectionAlgorithm !== undefined &&
+        props.latencyOutlierDetectionAlgorithm != OutlierDetectionAlgorithm.STATIC &&
+        props.latencyOutlierThreshold !== undefined
+      ) {
+        outlierWidgets.push(
+          new GraphWidget({
+            height: 6,
+            width: 12,
+            title: 'High Latency Outliers',
+            region: Aws.REGION,
+            left: [
+              OutlierDetectionMetrics.createAllZonesOutlierMetric({
+                outlierDetectionFunction: props.outlierDetectionFunction,
+                outlierDetectionAlgorithm: props.latencyOutlierDetectionAlgorithm,
+                outlierThreshold: props.latencyOutlierThreshold,
+                metricDimensions: metricDimensions(operation.serverSideLatencyMetricDetails),
+                metricNamespace: operation.serverSideLatencyMetricDetails.metricNamespace,
+                metricNames: operation.serverSideLatencyMetricDetails.successMetricNames,
+                statistic: `TC(${MetricsHelper.convertDurationByUnit(operation.serverSideLatencyMetricDetails.successAlarmThreshold, operation.serverSideLatencyMetricDetails.unit)}:)`,
+                unit: 'Milliseconds',
+                period: operation.serverSideLatencyMetricDetails.period
+              })
+            ],
+            leftYAxis: {
+              min: 0,
+              max: 1,
+              label: 'Outlier',
+              showUnits: false,
+            }
+          })
+        );
+      }
+
+      if (outlierWidgets.length > 0) {
+        dashboard.addWidgets(...outlierWidgets);
+      }
+    }
+
     dashboard.addWidgets(
       new TextWidget({
         height: 1,
@@ -1,8 +1,10 @@
 // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 // SPDX-License-Identifier: Apache-2.0
 import { Duration } from 'aws-cdk-lib';
+import { IFunction } from 'aws-cdk-lib/aws-lambda';
 import { IAvailabilityZoneMapper } from '../../azmapper/IAvailabilityZoneMapper';
 import { IOperationAlarmsAndRules } from '../../alarmsandrules/IOperationAlarmsAndRules';
+import { OutlierDetectionAlgorithm } from '../../utilities/OutlierDetectionAlgorithm';
 
 /**
  * Properties for creating an availability and latency dashboard for
@@ -23,4 +25,40 @@ export interface OperationAvailabilityAndLatencyDashboardProps {
    * The AZ Mapper
    */
   readonly azMapper: IAvailabilityZoneMapper;
+
+  /**
+   * The outlier detection function used to graph each Availability
+   * Zone's outlier result
+   *
+   * @default - No outlier widgets are added
+   */
+  readonly outlierDetectionFunction?: IFunction;
+
+  /**
+   * The algorithm used to find fault rate outliers
+   *
+   * @default - No fault rate outlier widget is added
+   */
+  readonly availabilityOutlierDetectionAlgorithm?: OutlierDetectionAlgorithm;
+
+  /**
+   * The threshold for the fault rate outlier algorithm
+   *
+   * @default - No fault rate outlier widget is added
+   */
+  readonly availabilityOutlierThreshold?: number;
+
+  /**
+   * The algorithm used to find high latency outliers
+   *
+   * @default - No high latency outlier widget is added
+   */
+  readonly latencyOutlierDetectionAlgorithm?: OutlierDetectionAlgorithm;
+
+  /**
+   * The threshold for the high latency outlier algorithm
+   *
+   * @default - No high latency outlier widget is added
+   */
+  readonly latencyOutlierThreshold?: number;
 }
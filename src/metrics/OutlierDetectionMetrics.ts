@@ -0,0 +1,124 @@
+// Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+// SPDX-License-Identifier: Apache-2.0
+import { IMetric, MathExpression } from 'aws-cdk-lib/aws-cloudwatch';
+import { OutlierDetectionMetricProps } from './props/OutlierDetectionMetricProps';
+
+/**
+ * Creates metrics that are calculated by the outlier detection function
+ */
+export class OutlierDetectionMetrics {
+  /**
+   * The Availability Zone Id argument that makes the outlier detection
+   * function return one result per Availability Zone
+   */
+  static readonly ALL_AVAILABILITY_ZONES: string = '*';
+
+  /**
+   * Creates the LAMBDA metric math function call that runs the outlier
+   * detection function for the provided Availability Zone Id
+   * @param props
+   * @param availabilityZoneId
+   * @returns
+   */
+  static createOutlierDetectionExpression(
+    props: OutlierDetectionMetricProps,
+    availabilityZoneId: string,
+  ): string {
+    let str: string = JSON.stringify(props.metricDimensions)
+      .replace(/[\\]/g, '\\\\')
+      .replace(/[\"]/g, '\\"')
+      .replace(/[\/]/g, '\\/')
+      .replace(/[\b]/g, '\\b')
+      .replace(/[\f]/g, '\\f')
+      .replace(/[\n]/g, '\\n')
+      .replace(/[\r]/g, '\\r')
+      .replace(/[\t]/g, '\\t');
+
+    return (
+      `LAMBDA("${props.outlierDetectionFunction.functionName}",` +
+      `"${props.outlierDetectionAlgorithm.toString()}",` +
+      `"${props.outlierThreshold}",` +
+      `"${availabilityZoneId}",` +
+      `"${str}",` +
+      `"${props.metricNamespace}",` +
+      `"${props.metricNames.join(':')}",` +
+      `"${props.statistic}",` +
+      `"${props.unit}"` +
+      ')'
+    );
+  }
+
+  /**
+   * Creates the query a Prefetch event sends to the outlier detection
+   * function so it fetches the window an alarm on this metric evaluates
+   * before the alarm asks for it. The arguments are the same as the
+   * LAMBDA function call's, the function fetches every Availability Zone.
+   * @param props
+   * @param evaluationPeriods The number of periods the alarm evaluates
+   * @returns
+   */
+  static createPrefetchQuery(
+    props: OutlierDetectionMetricProps,
+    evaluationPeriods: number,
+  ): { [key: string]: any } {
+    return {
+      Period: props.period.toSeconds(),
+      EvaluationPeriods: evaluationPeriods,
+      Arguments: [
+        props.outlierDetectionAlgorithm.toString(),
+        `${props.outlierThreshold}`,
+        OutlierDetectionMetrics.ALL_AVAILABILITY_ZONES,
+        JSON.stringify(props.metricDimensions),
+        props.metricNamespace,
+        props.metricNames.join(':'),
+        props.statistic,
+        props.unit,
+      ],
+    };
+  }
+
+  /**
+   * Creates a metric that is 1 when the Availability Zone is an outlier
+   * and 0 otherwise, suitable for alarming
+   * @param props
+   * @param availabilityZoneId
+   * @returns
+   */
+  static createZonalOutlierMetric(
+    props: OutlierDetectionMetricProps,
+    availabilityZoneId: string,
+  ): IMetric {
+    return new MathExpression({
+      expression:
+        'MAX(' +
+        OutlierDetectionMetrics.createOutlierDetectionExpression(
+          props,
+          availabilityZoneId,
+        ) +
+        ')',
+      period: props.period,
+      label: props.label,
+    });
+  }
+
+  /**
+   * Creates a metric that returns one outlier time series for each
+   * Availability Zone from a single invocation of the outlier detection
+   * function. Use this on dashboards instead of one zonal outlier metric
+   * per Availability Zone.
+   * @param props
+   * @returns
+   */
+  static createAllZonesOutlierMetric(
+    props: OutlierDetectionMetricProps,
+  ): IMetric {
+    return new MathExpression({
+      expression: OutlierDetectionMetrics.createOutlierDetectionExpression(
+        props,
+        OutlierDetectionMetrics.ALL_AVAILABILITY_ZONES,
+      ),
+      period: props.period,
+      label: props.label,
+    });
+  }
+}
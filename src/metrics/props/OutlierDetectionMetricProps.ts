@@ -0,0 +1,73 @@
+// Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+// SPDX-License-Identifier: Apache-2.0
+import { Duration } from 'aws-cdk-lib';
+import { IFunction } from 'aws-cdk-lib/aws-lambda';
+import { OutlierDetectionAlgorithm } from '../../utilities/OutlierDetectionAlgorithm';
+
+/**
+ * Properties for a metric calculated by the outlier detection function
+ */
+export interface OutlierDetectionMetricProps {
+  /**
+   * The outlier detection function used as the LAMBDA data source
+   */
+  readonly outlierDetectionFunction: IFunction;
+
+  /**
+   * The algorithm the function uses to find outliers
+   */
+  readonly outlierDetectionAlgorithm: OutlierDetectionAlgorithm;
+
+  /**
+   * The threshold for the algorithm
+   */
+  readonly outlierThreshold: number;
+
+  /**
+   * The dimension sets to fetch for each Availability Zone Id. The values
+   * of each Availability Zone's dimension sets are added together. A
+   * dimension value of '*' matches every value of that dimension, so a
+   * fleet of hosts or targets can be fetched with one dimension set per
+   * Availability Zone instead of one per host.
+   *
+   * A dimension set with a wildcard is fetched with a SEARCH expression,
+   * which has two limits. It can't filter on the unit, so metrics with any
+   * unit are summed and the unit prop is ignored for that set, and the
+   * function logs a warning when a unit is given. And it only matches
+   * metrics that have exactly the dimensions in the set, a metric with an
+   * additional dimension isn't included.
+   */
+  readonly metricDimensions: { [key: string]: { [key: string]: string }[] };
+
+  /**
+   * The namespace of the metrics
+   */
+  readonly metricNamespace: string;
+
+  /**
+   * The names of the metrics, these are added together
+   */
+  readonly metricNames: string[];
+
+  /**
+   * The statistic to fetch for each metric
+   */
+  readonly statistic: string;
+
+  /**
+   * The unit of the metrics
+   */
+  readonly unit: string;
+
+  /**
+   * The period of the metric
+   */
+  readonly period: Duration;
+
+  /**
+   * The metric label
+   *
+   * @default - No label
+   */
+  readonly label?: string;
+}
@@ -24,6 +24,7 @@ import {
 import { ILogGroup, LogGroup, RetentionDays } from 'aws-cdk-lib/aws-logs';
 import { Construct } from 'constructs';
 import { IOutlierDetectionFunction } from './IOutlierDetectionFunction';
+import { OutlierDetectionPrefetch } from './OutlierDetectionPrefetch';
 import { OutlierDetectionFunctionProps } from './props/OutlierDetectionFunctionProps';
 import { MetricsHelper } from '../utilities/MetricsHelper';
 
@@ -84,12 +85,6 @@ export class OutlierDetectionFunction
       managedPolicies: [xrayManagedPolicy, cwManagedPolicy],
     });
 
-    let sciPyLayer: ILayerVersion = new LayerVersion(this, 'SciPyLayer', {
-      code: Code.fromAsset(path.join(__dirname, 'src/scipy-layer.zip')),
-      compatibleArchitectures: [Architecture.ARM_64],
-      compatibleRuntimes: [MetricsHelper.PythonRuntime],
-    });
-
     let monitoringLayer: ILayerVersion = new LayerVersion(
       this,
       'MonitoringLayer',
@@ -102,6 +97,22 @@ export class OutlierDetectionFunction
       },
     );
 
+    let layers: ILayerVersion[] = [monitoringLayer];
+    let environment: { [key: string]: string } = {
+      REGION: Aws.REGION,
+      PARTITION: Aws.PARTITION,
+    };
+
+    if (props.slim) {
+      environment.USE_NUMPY = 'false';
+    } else {
+      layers.unshift(new LayerVersion(this, 'SciPyLayer', {
+        code: Code.fromAsset(path.join(__dirname, 'src/scipy-layer.zip')),
+        compatibleArchitectures: [Architecture.ARM_64],
+        compatibleRuntimes: [MetricsHelper.PythonRuntime],
+      }));
+    }
+
     if (props.vpc !== undefined && props.vpc != null) {
       let sg: ISecurityGroup = new SecurityGroup(
         this,
@@ -123,11 +134,8 @@ export class OutlierDetectionFunction
         tracing: Tracing.ACTIVE,
         timeout: Duration.seconds(5),
         memorySize: 512,
-        layers: [sciPyLayer, monitoringLayer],
-        environment: {
-          REGION: Aws.REGION,
-          PARTITION: Aws.PARTITION,
-        },
+        layers: layers,
+        environment: environment,
         vpc: props.vpc,
         securityGroups: [sg],
         vpcSubnets: props.subnetSelection,
@@ -142,11 +150,8 @@ export class OutlierDetectionFunction
         tracing: Tracing.ACTIVE,
         timeout: Duration.seconds(5),
         memorySize: 512,
-        layers: [sciPyLayer, monitoringLayer],
-        environment: {
-          REGION: Aws.REGION,
-          PARTITION: Aws.PARTITION,
-        },
+        layers: layers,
+        environment: environment,
       });
     }
 
@@ -162,6 +167,10 @@ export class OutlierDetectionFunction
       sourceAccount: Aws.ACCOUNT_ID
     });
 
+    if (props.prefetch) {
+      new OutlierDetectionPrefetch(this.function);
+    }
+
     this.logGroup = new LogGroup(this, 'logGroup', {
       logGroupName: `/aws/lambda/${this.function.functionName}`,
       retention: RetentionDays.ONE_WEEK,
@@ -0,0 +1,89 @@
+// Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+// SPDX-License-Identifier: Apache-2.0
+import { Lazy, Stack } from 'aws-cdk-lib';
+import { CfnRule } from 'aws-cdk-lib/aws-events';
+import { ServicePrincipal } from 'aws-cdk-lib/aws-iam';
+import { IFunction } from 'aws-cdk-lib/aws-lambda';
+import { Construct } from 'constructs';
+
+/**
+ * Sends the outlier detection function one Prefetch event at the start of
+ * every minute with the queries of every alarm that uses it, so each window
+ * is fetched just after its period completes and before the alarms evaluate
+ * it. It is added as a child of the function, the alarms find it there and
+ * add their queries.
+ */
+export class OutlierDetectionPrefetch extends Construct {
+  /**
+   * The id of the construct under the function
+   */
+  static readonly ID: string = 'Prefetch';
+
+  /**
+   * Finds the prefetch of the function, if it has one
+   * @param outlierDetectionFunction
+   * @returns
+   */
+  static of(
+    outlierDetectionFunction: IFunction,
+  ): OutlierDetectionPrefetch | undefined {
+    return outlierDetectionFunction.node.tryFindChild(
+      OutlierDetectionPrefetch.ID,
+    ) as OutlierDetectionPrefetch | undefined;
+  }
+
+  /**
+   * The rule that sends the Prefetch events
+   */
+  rule: CfnRule;
+
+  private queries: { [key: string]: any }[];
+
+  constructor(outlierDetectionFunction: IFunction) {
+    super(outlierDetectionFunction, OutlierDetectionPrefetch.ID);
+    this.queries = [];
+
+    // A cron schedule fires at the start of the minute, a rate doesn't
+    // line up with the period boundaries. The L2 rule target resolves its
+    // input when it is added, before the alarms have added their queries,
+    // so the input is rendered at synthesis instead.
+    this.rule = new CfnRule(this, 'Rule', {
+      scheduleExpression: 'cron(* * * * ? *)',
+      state: 'ENABLED',
+      targets: [
+        {
+          id: 'OutlierDetectionFunction',
+          arn: outlierDetectionFunction.functionArn,
+          input: Lazy.string({
+            produce: () =>
+              Stack.of(this).toJsonString({
+                EventType: 'Prefetch',
+                PrefetchRequest: {
+                  Queries: this.queries,
+                },
+              }),
+          }),
+        },
+      ],
+    });
+
+    outlierDetectionFunction.addPermission('PrefetchPermission', {
+      action: 'lambda:InvokeFunction',
+      principal: new ServicePrincipal('events.amazonaws.com'),
+      sourceArn: this.rule.attrArn,
+    });
+  }
+
+  /**
+   * Adds a query to the Prefetch event, the alarms for every Availability
+   * Zone send the same query so it is only added once
+   * @param query
+   */
+  addQuery(query: { [key: string]: any }): void {
+    let key: string = JSON.stringify(query);
+
+    if (!this.queries.some((existing) => JSON.stringify(existing) == key)) {
+      this.queries.push(query);
+    }
+  }
+}
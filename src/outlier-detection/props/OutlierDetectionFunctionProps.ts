@@ -13,4 +13,22 @@ export interface OutlierDetectionFunctionProps {
    * The subnets to use in the VPC
    */
   readonly subnetSelection?: SubnetSelection;
+
+  /**
+   * Deploys the function without the SciPy layer so it uses its pure Python
+   * calculations, which give identical results. This makes cold starts
+   * faster, NumPy only helps on long dashboard time ranges.
+   *
+   * @default false
+   */
+  readonly slim?: boolean;
+
+  /**
+   * Sends the function a Prefetch event every minute with the queries of
+   * the alarms that use it, so their windows are already fetched when the
+   * alarms evaluate them.
+   *
+   * @default false
+   */
+  readonly prefetch?: boolean;
 }
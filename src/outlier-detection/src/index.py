@@ -1,15 +1,163 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 import os
-import boto3
 import json
 import time
 import traceback
 import sys
 import math
-from aws_embedded_metrics import metric_scope
-
-cw_client = boto3.client("cloudwatch", os.environ.get("AWS_REGION", "us-east-1"))
+import functools
+import random
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# boto3, aws_embedded_metrics and NumPy are imported on first use so that a
+# cold start only pays for what the invocation needs. An invocation served
+# from the fetch cache never creates the CloudWatch client, and NumPy is
+# only loaded when it is enabled and installed.
+np = None
+_numpy_import_attempted = False
+
+cw_client = None
+_cw_client_lock = threading.Lock()
+
+# Every per-AZ outlier alarm for an operation sends the same query with only the
+# AZ-ID argument changed, so results fetched in this container are reused by the
+# other alarms evaluated in the same minute.
+FETCH_CACHE_TTL_SECONDS = float(os.environ.get("FETCH_CACHE_TTL_SECONDS", "30"))
+FETCH_CACHE_MAX_ENTRIES = int(os.environ.get("FETCH_CACHE_MAX_ENTRIES", "128"))
+QUERY_PLAN_CACHE_MAX_ENTRIES = 256
+
+# The AZ-ID argument that requests the results for every AZ
+ALL_AVAILABILITY_ZONES = "*"
+
+# Incremental evaluation keeps each query's series and scores in the container
+# and only fetches the datapoints after the newest one it has, refetching the
+# last few periods to pick up late arriving data.
+INCREMENTAL_EVALUATION = os.environ.get("INCREMENTAL_EVALUATION", "false").lower() == "true"
+INCREMENTAL_OVERLAP_PERIODS = int(os.environ.get("INCREMENTAL_OVERLAP_PERIODS", "2"))
+INCREMENTAL_STATE_TTL_SECONDS = float(os.environ.get("INCREMENTAL_STATE_TTL_SECONDS", "900"))
+INCREMENTAL_STATE_MAX_ENTRIES = int(os.environ.get("INCREMENTAL_STATE_MAX_ENTRIES", "64"))
+
+# How much detail about each calculation is written to the EMF log. OFF writes
+# none, SUMMARY writes the decision and a few statistics for the newest
+# timestamp, FULL adds the query, results and per timestamp statistics for the
+# sampled fraction of invocations, capped at DIAGNOSTICS_MAX_BYTES.
+DIAGNOSTICS_LEVEL = os.environ.get("DIAGNOSTICS_LEVEL", "SUMMARY").upper()
+DIAGNOSTICS_SAMPLE_RATE = float(os.environ.get("DIAGNOSTICS_SAMPLE_RATE", "1.0"))
+DIAGNOSTICS_MAX_BYTES = int(os.environ.get("DIAGNOSTICS_MAX_BYTES", "65536"))
+
+# Prefetch events are sent at the start of every minute by a schedule that
+# is created when prefetch is enabled for the function. They fetch each
+# query's window ending at the last period boundary into the fetch cache,
+# and into the retained series with incremental evaluation, so the alarm
+# invocations that follow in the same container skip the fetch. Only
+# completed periods are fetched, a bucket that is still filling would be
+# served stale once its period ends. Each query in the event is {"Period",
+# "EvaluationPeriods", "Arguments"}, with the same arguments as the alarm's
+# LAMBDA call. Queries whose last boundary is more than
+# PREFETCH_MAX_AGE_SECONDS ago are skipped, since an earlier event already
+# fetched that window, and results are cached until PREFETCH_GRACE_SECONDS
+# after the next boundary, when the alarms evaluating that window have run.
+PREFETCH_MAX_AGE_SECONDS = int(os.environ.get("PREFETCH_MAX_AGE_SECONDS", "60"))
+PREFETCH_GRACE_SECONDS = int(os.environ.get("PREFETCH_GRACE_SECONDS", "30"))
+
+# Set PROFILE to true to run each GetMetricData invocation under cProfile and
+# write the PROFILE_TOP_FUNCTIONS functions with the most cumulative time to
+# the EMF log. Only the handler thread is profiled, the time fetch threads
+# spend is reported by the phase timings.
+PROFILE = os.environ.get("PROFILE", "false").lower() == "true"
+PROFILE_TOP_FUNCTIONS = int(os.environ.get("PROFILE_TOP_FUNCTIONS", "25"))
+
+# Long windows are split into time slices of at least FETCH_SLICE_MIN_PERIODS
+# periods. The slices of each query chunk are fetched concurrently on the
+# shared client, FETCH_MAX_CONCURRENCY requests at a time, which is capped at
+# the client's default connection pool size of 10.
+FETCH_MAX_SLICES = int(os.environ.get("FETCH_MAX_SLICES", "4"))
+FETCH_SLICE_MIN_PERIODS = int(os.environ.get("FETCH_SLICE_MIN_PERIODS", "360"))
+FETCH_MAX_CONCURRENCY = min(int(os.environ.get("FETCH_MAX_CONCURRENCY", "8")), 10)
+
+# The fetch stops FETCH_DEADLINE_RESERVE_MS before the function would time out
+# so there is time left to score and return what was fetched, flagged as
+# PartialData. Throttled and failed requests are retried with exponential
+# backoff and full jitter within that deadline, starting at
+# FETCH_RETRY_BASE_SECONDS and capped at FETCH_RETRY_MAX_SECONDS. Throttling
+# also adds a shared delay before every request in the container, which
+# halves after each successful one. The client makes a single attempt per
+# call, these retries replace its own. Without a deadline, when there is no
+# Lambda context, a request is tried at most FETCH_MAX_ATTEMPTS times.
+FETCH_DEADLINE_RESERVE_MS = int(os.environ.get("FETCH_DEADLINE_RESERVE_MS", "500"))
+FETCH_RETRY_BASE_SECONDS = float(os.environ.get("FETCH_RETRY_BASE_SECONDS", "0.05"))
+FETCH_RETRY_MAX_SECONDS = float(os.environ.get("FETCH_RETRY_MAX_SECONDS", "1.0"))
+FETCH_MAX_ATTEMPTS = int(os.environ.get("FETCH_MAX_ATTEMPTS", "5"))
+FETCH_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("FETCH_CONNECT_TIMEOUT_SECONDS", "1"))
+FETCH_READ_TIMEOUT_SECONDS = float(os.environ.get("FETCH_READ_TIMEOUT_SECONDS", "3"))
+THROTTLING_ERROR_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException")
+TRANSIENT_ERROR_CODES = ("InternalFailure", "InternalServiceError", "ServiceUnavailable", "RequestTimeout")
+TRANSIENT_EXCEPTIONS = ("ReadTimeoutError", "ConnectTimeoutError", "EndpointConnectionError", "ConnectionClosedError")
+
+# GetMetricData limits. Plans that exceed them are split into chunks that are
+# sent as separate requests.
+MAX_QUERIES_PER_REQUEST = 500
+MAX_EXPRESSION_LENGTH = 2048
+
+# A dimension set with this value for a dimension matches every value of it.
+# The set is fetched with a SEARCH expression that CloudWatch expands and
+# sums, so the query stays the same size however many hosts or targets the
+# dimension has. SEARCH can't filter on the unit, so the unit argument is
+# ignored for these sets, and it only matches metrics with exactly the
+# dimensions in the set.
+DIMENSION_WILDCARD = "*"
+
+# With METRICS_INSIGHTS on, plans whose dimensions differ between AZs in a
+# single dimension are also compiled into one Metrics Insights query per
+# metric name that groups by that dimension, so the request stays the same
+# size however many AZs and dimension sets there are. It is used for windows
+# that start within the METRICS_INSIGHTS_MAX_AGE_SECONDS Metrics Insights can
+# query, and the plan's enumerated queries are used otherwise. Metrics
+# Insights can't filter on the unit, so the metrics must be published with
+# the one unit the alarm asks for.
+METRICS_INSIGHTS = os.environ.get("METRICS_INSIGHTS", "false").lower() == "true"
+METRICS_INSIGHTS_MAX_AGE_SECONDS = int(os.environ.get("METRICS_INSIGHTS_MAX_AGE_SECONDS", str(3 * 3600)))
+METRICS_INSIGHTS_FUNCTIONS = {"Sum": "SUM", "Average": "AVG", "Minimum": "MIN", "Maximum": "MAX", "SampleCount": "COUNT"}
+
+# Use NumPy for the column operations when it is available. Both paths
+# produce the same verdicts, the pure Python one is the fallback.
+USE_NUMPY = os.environ.get("USE_NUMPY", "true").lower() == "true"
+
+# The EWMA algorithm smooths each AZ's values over EWMA_SPAN periods and
+# compares them to a baseline of the AZ's own values over
+# EWMA_BASELINE_SPAN periods, once the baseline has EWMA_WARMUP_PERIODS
+# values. Both are kept as running values so each timestamp costs the same.
+# Alarm windows are only a few periods long, so EWMA_LOOKBACK_PERIODS before
+# the window are fetched and scored too, and only the window is returned.
+EWMA_SPAN = int(os.environ.get("EWMA_SPAN", "3"))
+EWMA_BASELINE_SPAN = int(os.environ.get("EWMA_BASELINE_SPAN", "30"))
+EWMA_WARMUP_PERIODS = int(os.environ.get("EWMA_WARMUP_PERIODS", "5"))
+EWMA_LOOKBACK_PERIODS = int(os.environ.get("EWMA_LOOKBACK_PERIODS", str(EWMA_BASELINE_SPAN)))
+
+# The ENSEMBLE algorithm runs CHI_SQUARED, Z_SCORE, IQR and MAD from one set
+# of column statistics and flags an AZ when at least threshold of them do.
+# Each runs with its own threshold below. With n AZs the largest possible
+# z-score is the square root of n - 1, so the Z_SCORE default suits 3 AZs.
+ENSEMBLE_CHI_SQUARED_THRESHOLD = float(os.environ.get("ENSEMBLE_CHI_SQUARED_THRESHOLD", "0.05"))
+ENSEMBLE_Z_SCORE_THRESHOLD = float(os.environ.get("ENSEMBLE_Z_SCORE_THRESHOLD", "1.0"))
+ENSEMBLE_MAD_THRESHOLD = float(os.environ.get("ENSEMBLE_MAD_THRESHOLD", "3.0"))
+
+# Algorithms whose result at a timestamp depends on the timestamps before
+# it. They are scored from EWMA_LOOKBACK_PERIODS before the window, and the
+# incremental path scores all of that for them.
+STATEFUL_ALGORITHMS = ("EWMA",)
+
+# Periods GetMetricData accepts below one minute. These are only useful for
+# metrics published with high (1 second) storage resolution.
+HIGH_RESOLUTION_PERIODS = (1, 5, 10, 30)
+
+# The minimum period CloudWatch can return for data older than each age, in
+# seconds, based on how long each resolution is retained.
+RETENTION_MINIMUM_PERIODS = ((63 * 86400, 3600), (15 * 86400, 300), (3 * 3600, 60))
 
 
 # --- Pure Python replacements for numpy/scipy ---
@@ -66,11 +214,72 @@ def _chi_squared_p_value(observed):
 
     expected = total / n
     chi2 = sum((o - expected) ** 2 / expected for o in observed)
-    df = n - 1
 
+    return _chi_squared_sf(chi2, n - 1)
+
+
+def _chi_squared_sf(chi2, df):
+    """Survival function of the chi-squared distribution with df degrees of freedom."""
     return 1.0 - _regularized_gamma_inc(df / 2.0, chi2 / 2.0)
 
 
+# The computed survival function is within a few ulp of the true, decreasing,
+# one. Where it is more than this far from the threshold, its comparison with
+# the threshold can't differ from the true function's.
+CHI_SQUARED_DECISION_GUARD = 1e-12
+
+
+def _chi_squared_isf_bracket(df, p):
+    """
+    Bisects for the chi-squared value where _chi_squared_sf crosses p and
+    returns (below, above) with sf(below) > p and sf(above) <= p. below is 0
+    when sf never exceeds p and above is infinite when sf never reaches it.
+    """
+    if _chi_squared_sf(0.0, df) <= p:
+        return 0.0, 0.0
+
+    below = 0.0
+    above = max(1.0, float(df))
+
+    while _chi_squared_sf(above, df) > p:
+        below = above
+        above *= 2
+
+        if above > 2.0 ** 40:
+            return below, math.inf
+
+    for _ in range(200):
+        middle = (below + above) / 2
+
+        if middle <= below or middle >= above:
+            break
+
+        if _chi_squared_sf(middle, df) > p:
+            below = middle
+        else:
+            above = middle
+
+    return below, above
+
+
+@functools.lru_cache(maxsize = 256)
+def _chi_squared_decision_bounds(df, threshold):
+    """
+    Returns (low, high) for a chi-squared test at the threshold: statistics
+    below low are never outliers and those above high always are, so only
+    the narrow band between them needs the exact p-value. The bounds come
+    from the same survival function the exact path uses, so decisions are
+    identical to comparing each p-value with the threshold.
+    """
+    low, _ = _chi_squared_isf_bracket(df, threshold + CHI_SQUARED_DECISION_GUARD)
+
+    if threshold - CHI_SQUARED_DECISION_GUARD < 0:
+        return low, math.inf
+
+    _, high = _chi_squared_isf_bracket(df, threshold - CHI_SQUARED_DECISION_GUARD)
+    return low, high
+
+
 def _regularized_gamma_inc(a, x):
     """
     Compute the regularized lower incomplete gamma function P(a, x)
@@ -128,10 +337,901 @@ def _gamma_inc_cf(a, x, max_iter=200, eps=1e-15):
     return math.exp(-x + a * math.log(x) - ln_gamma_a) * h
 
 
+# --- Warm container caches ---
+
+class TTLCache:
+    """
+    A size-capped, least recently used cache whose entries expire
+    after a fixed time to live. Hit, miss and eviction counts are kept
+    for the lifetime of the container.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, clock = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+
+        if expires_at <= self.clock():
+            del self._entries[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl_seconds = None):
+        if self.max_entries <= 0:
+            return
+
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+
+        if key in self._entries:
+            del self._entries[key]
+
+        self._entries[key] = (self.clock() + ttl, value)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Evictions": self.evictions,
+            "Size": len(self._entries)
+        }
+
+
+fetch_cache = TTLCache(FETCH_CACHE_MAX_ENTRIES, FETCH_CACHE_TTL_SECONDS)
+
+def plan_period(period, start, now = None) -> int:
+    """
+    Chooses the period to fetch at. This is the requested period rounded up
+    to one GetMetricData accepts, raised when the window starts too far back
+    for that resolution to still be retained.
+    """
+    period = max(int(period), 1)
+
+    if period < 60:
+        period = next(p for p in HIGH_RESOLUTION_PERIODS + (60,) if p >= period)
+    else:
+        period = int(math.ceil(period / 60.0)) * 60
+
+    if now is None:
+        now = time.time()
+
+    age = now - start
+
+    for minimum_age, minimum_period in RETENTION_MINIMUM_PERIODS:
+        if age > minimum_age:
+            period = max(period, minimum_period)
+            break
+
+    return period
+
+
+QueryPlan = namedtuple("QueryPlan", ["key", "azs", "queries", "operation", "period", "chunks", "insights", "insights_labels", "warnings"], defaults = ((), None, ()))
+
+
+def _chunk_queries(az_inputs: list, max_queries: int = MAX_QUERIES_PER_REQUEST, max_expression_length: int = MAX_EXPRESSION_LENGTH) -> list:
+    """
+    Packs each AZ's input queries and the expression that adds them up into
+    chunks that each fit in one GetMetricData request. An AZ whose inputs
+    don't fit in one expression is split into partial sums with Ids
+    <az>_p<n>, which are labelled with the AZ and added together when the
+    results are folded. Each partial sum stays in the chunk with its inputs.
+    """
+    parts = []
+
+    for az, inputs in az_inputs:
+        groups = [[]]
+        length = -1
+
+        for query in inputs:
+            if groups[-1] and (len(groups[-1]) + 1 >= max_queries or length + 1 + len(query["Id"]) > max_expression_length):
+                groups.append([])
+                length = -1
+
+            groups[-1].append(query)
+            length += 1 + len(query["Id"])
+
+        for index, group in enumerate(groups):
+            parts.append(group + [{
+                "Id": az.replace("-", "_") if len(groups) == 1 else az.replace("-", "_") + "_p" + str(index),
+                "Label": az,
+                "ReturnData": True,
+                "Expression": "+".join(query["Id"] for query in group)
+            }])
+
+    chunks = [[]]
+
+    for part in parts:
+        if chunks[-1] and len(chunks[-1]) + len(part) > max_queries:
+            chunks.append([])
+
+        chunks[-1].extend(part)
+
+    return [tuple(chunk) for chunk in chunks if chunk]
+
+
+def _search_expression(metric_namespace: str, names: tuple, dimension_set: dict, metric_stat: str, period: int) -> str:
+    """
+    Builds the expression that sums every metric in names whose dimensions
+    are those of the set, with wildcard dimensions matching any value.
+    """
+    text = [metric_namespace, metric_stat, *names, *dimension_set, *(str(value) for value in dimension_set.values())]
+
+    if any(c in value for value in text for c in "\"'\\"):
+        raise ValueError("Dimension sets with a wildcard can't contain quotes: " + json.dumps(dimension_set))
+
+    schema = "{" + ",".join('"' + value + '"' for value in [metric_namespace] + list(dimension_set)) + "}"
+    terms = ['"' + name + '"="' + str(value) + '"' for name, value in dimension_set.items() if value != DIMENSION_WILDCARD]
+    terms.append("(" + " OR ".join('MetricName="' + metric + '"' for metric in names) + ")")
+
+    return "SUM(SEARCH('" + schema + " " + " ".join(terms) + "', '" + metric_stat + "', " + str(period) + "))"
+
+
+def _insights_queries(dimensions_per_az: dict, metric_namespace: str, names: tuple, metric_stat: str, period: int):
+    """
+    Builds the Metrics Insights queries that fetch every AZ at once, one per
+    metric name, grouped by the one dimension whose value differs between
+    AZs. Returns the queries and a map of each group's value to its AZ, or
+    None when the schema doesn't allow it: a statistic Metrics Insights
+    doesn't have, more than one dimension set for an AZ, dimension names
+    that differ between AZs, or quotes in any name or value.
+    """
+    function = METRICS_INSIGHTS_FUNCTIONS.get(metric_stat)
+    dimension_sets = list(dimensions_per_az.items())
+
+    if function is None or len(dimension_sets) < 2 or any(len(sets) != 1 for az, sets in dimension_sets):
+        return None
+
+    dimension_sets = [(az, sets[0]) for az, sets in dimension_sets]
+    dimension_names = sorted(dimension_sets[0][1])
+
+    if any(sorted(dimensions) != dimension_names for az, dimensions in dimension_sets):
+        return None
+
+    varying = [name for name in dimension_names if len({dimensions[name] for az, dimensions in dimension_sets}) > 1]
+
+    if len(varying) != 1 or any(dimensions[varying[0]] == DIMENSION_WILDCARD for az, dimensions in dimension_sets):
+        return None
+
+    group = varying[0]
+    labels = {dimensions[group]: az for az, dimensions in dimension_sets}
+
+    if len(labels) != len(dimension_sets):
+        return None
+
+    text = [metric_namespace, *names, *dimension_names, *(str(value) for az, dimensions in dimension_sets for value in dimensions.values())]
+
+    if any(c in value for value in text for c in "\"'\\"):
+        return None
+
+    schema = "SCHEMA(" + ", ".join('"' + value + '"' for value in [metric_namespace] + dimension_names) + ")"
+    where = " AND ".join(
+        '"' + name + "\" = '" + str(dimension_sets[0][1][name]) + "'"
+        for name in dimension_names
+        if name != group and dimension_sets[0][1][name] != DIMENSION_WILDCARD
+    )
+    queries = []
+
+    for index, metric in enumerate(names):
+        expression = "SELECT " + function + '("' + metric + '") FROM ' + schema + (" WHERE " + where if where else "") + ' GROUP BY "' + group + '"'
+
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            return None
+
+        queries.append({
+            "Id": "insights_" + str(index),
+            "Expression": expression,
+            "Period": period,
+            "ReturnData": True
+        })
+
+    return tuple(queries), labels
+
+
+@functools.lru_cache(maxsize = QUERY_PLAN_CACHE_MAX_ENTRIES)
+def compile_query_plan(dimensions_per_az_json: str, metric_namespace: str, metric_names: str, metric_stat: str, unit: str, period: int = 60):
+    """
+    Parses the LAMBDA arguments that describe what to fetch and builds the
+    GetMetricData queries for them. The plan key is built from the parsed
+    values so that semantically identical arguments share cache entries.
+    A dimension set with a wildcard value is fetched with one SEARCH
+    expression for all of its metric names instead of one MetricStat each.
+    SEARCH can't filter on the unit, so a warning is returned in the plan
+    when a unit is given with one. The returned queries are shared between
+    invocations and must not be mutated.
+    """
+    dimensions_per_az: dict = json.loads(dimensions_per_az_json)
+    names: tuple = tuple(metric_names.split(":"))
+
+    az_inputs = []
+    key_dimensions = []
+    operation = ""
+    warnings = []
+
+    for az in dimensions_per_az:
+
+        index = 0
+        inputs = []
+        az_key_dimensions = []
+
+        for dimension_set in dimensions_per_az[az]:
+
+            dimensions = []
+
+            for dim in dimension_set:
+                dimensions.append({
+                    "Name": dim,
+                    "Value": dimension_set[dim]
+                })
+
+                if dim == "Operation":
+                    operation = dimension_set[dim]
+
+            az_key_dimensions.append(tuple(sorted(dimension_set.items())))
+
+            if DIMENSION_WILDCARD in dimension_set.values():
+                if unit and not warnings:
+                    warnings.append("The " + unit + " unit isn't applied to dimension sets with a wildcard, metrics with any unit are summed")
+
+                inputs.append({
+                  "Id": az.replace("-", "_") + "_" + str(index),
+                  "Label": az + " " + ":".join(names),
+                  "ReturnData": False,
+                  "Expression": _search_expression(metric_namespace, names, dimension_set, metric_stat, period)
+                })
+
+                index += 1
+                continue
+
+            for metric in names:
+                inputs.append({
+                  "Id": az.replace("-", "_") + "_" + str(index),
+                  "Label": az + ' ' + metric,
+                  "ReturnData": False,
+                  "MetricStat": {
+                    "Metric": {
+                      "Namespace": metric_namespace,
+                      "MetricName": metric,
+                      "Dimensions": dimensions
+                    },
+                    "Period": period,
+                    "Stat": metric_stat,
+                    "Unit": unit,
+                  }
+                })
+
+                index += 1
+
+        az_inputs.append((az, inputs))
+        key_dimensions.append((az, tuple(az_key_dimensions)))
+
+    key = (metric_namespace, names, metric_stat, unit, period, tuple(key_dimensions))
+    chunks = tuple(_chunk_queries(az_inputs))
+    queries = tuple(query for chunk in chunks for query in chunk)
+    insights, insights_labels = _insights_queries(dimensions_per_az, metric_namespace, names, metric_stat, period) or ((), None)
+
+    return QueryPlan(
+        key = key,
+        azs = tuple(dimensions_per_az.keys()),
+        queries = queries,
+        operation = operation,
+        period = period,
+        chunks = chunks,
+        insights = insights,
+        insights_labels = insights_labels,
+        warnings = tuple(warnings)
+    )
+
+
+# --- Columnar timestamp x AZ matrix ---
+
+class AZMatrix:
+    """
+    Columnar representation of the fetched values: one timestamp vector,
+    newest first, and one row per AZ holding its value at each of those
+    timestamps. The outlier algorithms operate on whole rows at a time.
+    """
+
+    __slots__ = ("timestamps", "azs", "rows", "_array")
+
+    def __init__(self, timestamps: list, azs: list, rows: list):
+        self.timestamps = timestamps
+        self.azs = azs
+        self.rows = rows
+        self._array = None
+
+    @classmethod
+    def from_counts(cls, az_counts: dict):
+        """
+        Builds a matrix from a dict of timestamp to a dict of AZ to value.
+        AZs missing at a timestamp are filled with 0, as they are when
+        GetMetricData returns no datapoint for them.
+        """
+        azs = list(dict.fromkeys(az for counts in az_counts.values() for az in counts))
+        timestamps = sorted(az_counts.keys(), reverse = True)
+        rows = [[az_counts[timestamp].get(az, 0) for timestamp in timestamps] for az in azs]
+        return cls(timestamps, azs, rows)
+
+    @classmethod
+    def from_columns(cls, timestamps: list, azs: list, columns: list):
+        """Builds a matrix from one tuple of AZ values per timestamp."""
+        rows = [list(row) for row in zip(*columns)] if columns else [[] for az in azs]
+        return cls(timestamps, list(azs), rows)
+
+    def columns(self) -> list:
+        return list(zip(*self.rows))
+
+    def to_counts(self) -> dict:
+        return {
+            timestamp: {az: self.rows[i][j] for i, az in enumerate(self.azs)}
+            for j, timestamp in enumerate(self.timestamps)
+        }
+
+    def row_index(self, az_id: str) -> int:
+        return self.azs.index(az_id)
+
+    def array(self):
+        """The rows as a 2D NumPy array, built once per matrix."""
+        if self._array is None:
+            self._array = np.array(self.rows, dtype = float).reshape(len(self.azs), len(self.timestamps))
+        return self._array
+
+
+class AZMatrixBuilder:
+    """
+    Folds GetMetricData results into an AZMatrix as they are read. Results
+    added for the same AZ under different parts, such as the partial sums of
+    a chunked plan, are added together.
+    """
+
+    def __init__(self, azs):
+        self.azs = list(azs)
+        self._series = {az: {} for az in self.azs}
+
+    def add(self, az: str, timestamps: list, values: list, part: str = ""):
+        if az not in self._series:
+            self.azs.append(az)
+            self._series[az] = {}
+
+        series = self._series[az].setdefault(part, {})
+
+        for timestamp, value in zip(timestamps, values):
+            series[int(timestamp.timestamp())] = value
+
+    def build(self) -> AZMatrix:
+        timestamps = set()
+
+        for parts in self._series.values():
+            for series in parts.values():
+                timestamps.update(series)
+
+        timestamps = sorted(timestamps, reverse = True)
+        rows = []
+
+        for az in self.azs:
+            # Parts can arrive in any order, add them in a fixed one
+            parts = [self._series[az][part] for part in sorted(self._series[az])]
+
+            if len(parts) == 1:
+                rows.append([parts[0].get(timestamp, 0) for timestamp in timestamps])
+            else:
+                rows.append([sum(series.get(timestamp, 0) for series in parts) for timestamp in timestamps])
+
+        return AZMatrix(timestamps, self.azs, rows)
+
+
+def _as_matrix(az_counts) -> AZMatrix:
+    if isinstance(az_counts, AZMatrix):
+        return az_counts
+    return AZMatrix.from_counts(az_counts)
+
+
+def _numpy_enabled() -> bool:
+    global np, _numpy_import_attempted
+
+    if not USE_NUMPY:
+        return False
+
+    if not _numpy_import_attempted:
+        _numpy_import_attempted = True
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+    return np is not None
+
+
+# The column kernels below return one value per timestamp. Sums are taken
+# with sum() over the original values on both paths, like _mean and _std, so
+# the results are identical to theirs on every Python version, including the
+# compensated summation of 3.12 and later, which adding NumPy rows in order
+# doesn't reproduce. NumPy is only used for element-wise steps and sorting,
+# which round the same way Python does.
+
+def _column_sums(matrix: AZMatrix) -> list:
+    return [sum(column) for column in zip(*matrix.rows)]
+
+
+def _column_means(matrix: AZMatrix) -> list:
+    n = len(matrix.azs)
+    return [s / n for s in _column_sums(matrix)]
+
+
+def _column_stds(matrix: AZMatrix, means) -> list:
+    n = len(matrix.azs)
+    return [math.sqrt(sum((v - m) ** 2 for v in column) / n) for column, m in zip(zip(*matrix.rows), means)]
+
+
+def _sorted_columns(rows):
+    """Sorts the values in each column, returning them as rows of ascending rank."""
+    if _numpy_enabled():
+        return np.sort(rows, axis = 0)
+
+    return [list(rank) for rank in zip(*(sorted(column) for column in zip(*rows)))]
+
+
+def _column_percentiles(sorted_rows, p):
+    """The p-th percentile of each column, matching _percentile."""
+    n = len(sorted_rows)
+    k = (p / 100.0) * (n - 1)
+    f = math.floor(k)
+    c = math.ceil(k)
+
+    if f == c:
+        return sorted_rows[int(k)]
+
+    if _numpy_enabled():
+        return sorted_rows[f] * (c - k) + sorted_rows[c] * (k - f)
+
+    return [low * (c - k) + high * (k - f) for low, high in zip(sorted_rows[f], sorted_rows[c])]
+
+
+def _column_medians(sorted_rows):
+    """The median of each column, matching _median."""
+    n = len(sorted_rows)
+    mid = n // 2
+
+    if n % 2 != 0:
+        return sorted_rows[mid]
+
+    if _numpy_enabled():
+        return (sorted_rows[mid - 1] + sorted_rows[mid]) / 2.0
+
+    return [(low + high) / 2.0 for low, high in zip(sorted_rows[mid - 1], sorted_rows[mid])]
+
+
+def _first(vector):
+    """The value for the newest timestamp, as a Python number."""
+    if np is not None and isinstance(vector, np.ndarray):
+        return vector[0].item()
+    return vector[0]
+
+
+def _to_list(vector) -> list:
+    if np is not None and isinstance(vector, np.ndarray):
+        return vector.tolist()
+    return list(vector)
+
+
+# --- Diagnostics ---
+
+class Diagnostics:
+    """
+    Decides how much diagnostic detail an invocation writes to its metrics
+    scope. Summary values are written as properties right away. Detailed
+    sections are only collected when the invocation is sampled for a full
+    dump, and are serialized once when flushed, dropping any section that
+    would take the output past the byte budget.
+    """
+
+    LEVELS = ("OFF", "SUMMARY", "FULL")
+
+    def __init__(self, metrics, level: str = None, sample_rate: float = None, max_bytes: int = None):
+        self.metrics = metrics
+        self.level = (level or DIAGNOSTICS_LEVEL).upper()
+
+        if self.level not in self.LEVELS:
+            self.level = "SUMMARY"
+
+        self.sample_rate = DIAGNOSTICS_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.max_bytes = DIAGNOSTICS_MAX_BYTES if max_bytes is None else max_bytes
+        self.detailed = self.level == "FULL" and random.random() < self.sample_rate
+        self._sections = []
+
+    def summary(self, name: str, value):
+        if self.level != "OFF":
+            self.metrics.set_property(name, value)
+
+    def add(self, name: str, value):
+        """Adds a detailed section, in order of importance. Callers should check `detailed` before building expensive values."""
+        if self.detailed:
+            self._sections.append((name, value))
+
+    def flush(self) -> str:
+        if not self.detailed:
+            return None
+
+        parts = []
+        dropped = []
+        size = 2
+
+        for name, value in self._sections:
+            part = json.dumps(name) + ":" + json.dumps(value, default = str, separators = (",", ":"))
+            part_size = len(part.encode("utf-8")) + (1 if parts else 0)
+
+            if size + part_size > self.max_bytes:
+                dropped.append(name)
+                continue
+
+            parts.append(part)
+            size += part_size
+
+        output = "{" + ",".join(parts) + "}"
+        self.metrics.set_property("Diagnostics", output)
+        self._sections = []
+
+        if dropped:
+            self.metrics.set_property("DiagnosticsDropped", dropped)
+
+        return output
+
+
+class PhaseTimings:
+    """
+    Accumulates the time an invocation spends in each phase. Fetch threads
+    record pages concurrently, so nothing is written to the metrics scope
+    until emit is called from the handler thread. Fetch covers the whole
+    fetch, including the time spent folding pages that is also reported as
+    Assemble.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.page_latencies = []
+        self.datapoints = 0
+        self.counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - begin)
+
+    def page(self, seconds: float, datapoints: int):
+        with self._lock:
+            self.page_latencies.append(seconds)
+            self.datapoints += datapoints
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def emit(self, metrics):
+        for name, seconds in self.phases.items():
+            metrics.put_metric(name + "Latency", seconds * 1000, "Milliseconds")
+
+        if self.page_latencies:
+            for seconds in self.page_latencies:
+                metrics.put_metric("GetMetricDataPageLatency", seconds * 1000, "Milliseconds")
+
+            metrics.put_metric("GetMetricDataPages", len(self.page_latencies), "Count")
+            metrics.put_metric("GetMetricDataDatapoints", self.datapoints, "Count")
+
+        for name, value in self.counts.items():
+            metrics.put_metric(name, value, "Count")
+
+
+def _profile_summary(profiler, top: int) -> list:
+    """The functions with the most cumulative time in a cProfile run."""
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    functions = sorted(stats.items(), key = lambda entry: entry[1][3], reverse = True)[:top]
+
+    return [
+        {
+            "Function": filename + ":" + str(line) + "(" + name + ")",
+            "Calls": calls,
+            "TotalMs": round(total * 1000, 3),
+            "CumulativeMs": round(cumulative * 1000, 3)
+        }
+        for (filename, line, name), (primitive_calls, calls, total, cumulative, callers) in functions
+    ]
+
+
+class FetchDeadlineExceeded(Exception):
+    """
+    Raised when the fetch runs out of time. Carries the matrix built from
+    the pages fetched before the deadline, if there is one.
+    """
+
+    def __init__(self, matrix = None):
+        super().__init__("The fetch ran out of time before the function timeout")
+        self.matrix = matrix
+
+
+class AdaptiveBackoff:
+    """
+    A delay shared by every request in the container. Each throttle doubles
+    it, up to FETCH_RETRY_MAX_SECONDS, and each successful request halves
+    it, so a burst of invocations at a minute boundary slows down together.
+    """
+
+    def __init__(self):
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def throttled(self):
+        with self._lock:
+            self.delay = min(FETCH_RETRY_MAX_SECONDS, max(FETCH_RETRY_BASE_SECONDS, self.delay * 2))
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay >= FETCH_RETRY_BASE_SECONDS else 0.0
+
+
+backoff = AdaptiveBackoff()
+
+
+def _error_code(error: Exception) -> str:
+    response = getattr(error, "response", None)
+    return response.get("Error", {}).get("Code", "") if isinstance(response, dict) else ""
+
+
+def _sleep_until_deadline(seconds: float, deadline: float):
+    """Sleeps for seconds, raising FetchDeadlineExceeded if that would pass the deadline."""
+    if deadline is not None and time.monotonic() + seconds >= deadline:
+        raise FetchDeadlineExceeded()
+
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def _get_metric_data_with_retries(request: dict, deadline: float, timings: PhaseTimings) -> dict:
+    """
+    Calls GetMetricData, retrying throttled and transient failures with
+    full jitter until it succeeds or the deadline would pass. Without a
+    deadline the last error is raised after FETCH_MAX_ATTEMPTS attempts.
+    """
+    attempt = 0
+
+    while True:
+        _sleep_until_deadline(random.uniform(0, backoff.delay) if backoff.delay else 0.0, deadline)
+
+        try:
+            data = _cloudwatch().get_metric_data(**request)
+            backoff.succeeded()
+            return data
+        except Exception as e:
+            code = _error_code(e)
+
+            if code in THROTTLING_ERROR_CODES:
+                timings.count("GetMetricDataThrottles")
+                backoff.throttled()
+            elif code not in TRANSIENT_ERROR_CODES and type(e).__name__ not in TRANSIENT_EXCEPTIONS:
+                raise
+
+            if deadline is None and attempt + 1 >= FETCH_MAX_ATTEMPTS:
+                raise
+
+            timings.count("GetMetricDataRetries")
+            _sleep_until_deadline(random.uniform(0, min(FETCH_RETRY_MAX_SECONDS, FETCH_RETRY_BASE_SECONDS * 2 ** attempt)), deadline)
+            attempt += 1
+
+
+def deadline_from(context) -> float:
+    """The time.monotonic() by which fetching must stop, None without a Lambda context."""
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+
+    return time.monotonic() + (context.get_remaining_time_in_millis() - FETCH_DEADLINE_RESERVE_MS) / 1000
+
+
+# --- Incremental evaluation ---
+
+class RetainedSeries:
+    """
+    The columns fetched for one query plan and the scores computed from
+    them, kept across invocations. Every column carries a version that
+    changes whenever a refetch changes its values, so scores are only
+    recomputed for new or changed timestamps.
+    """
+
+    def __init__(self, azs, period: int):
+        self.azs = list(azs)
+        self.period = period
+        self.fetched_from = None
+        self.columns = {}
+        self.scores = {}
+        self._version = 0
+
+    def refetch_start(self, start: int):
+        """
+        Where to start fetching to bring the window up to date, or None if
+        the retained columns don't cover the start of the window.
+        """
+        if self.fetched_from is None or start < self.fetched_from or not self.columns:
+            return None
+
+        newest = max(self.columns)
+
+        if newest < start:
+            return None
+
+        return max(start, newest - INCREMENTAL_OVERLAP_PERIODS * self.period)
+
+    def merge(self, matrix: AZMatrix, fetched_from: int) -> int:
+        """
+        Replaces everything at or after fetched_from with the fetched
+        matrix, the same as a full fetch would return. Returns the number
+        of columns that are new or changed.
+        """
+        fetched = dict(zip(matrix.timestamps, matrix.columns()))
+        changed = 0
+
+        for timestamp in [t for t in self.columns if t >= fetched_from and t not in fetched]:
+            del self.columns[timestamp]
+
+        for timestamp, column in fetched.items():
+            existing = self.columns.get(timestamp)
+
+            if existing is None or existing[1] != column:
+                self._version += 1
+                self.columns[timestamp] = (self._version, column)
+                changed += 1
+
+        if self.fetched_from is None or fetched_from < self.fetched_from:
+            self.fetched_from = fetched_from
+
+        return changed
+
+    def trim(self, start: int):
+        """Drops the columns older than the start of the window being evaluated."""
+        if self.fetched_from is not None and start > self.fetched_from:
+            for timestamp in [t for t in self.columns if t < start]:
+                del self.columns[timestamp]
+
+            for scores in self.scores.values():
+                for timestamp in [t for t in scores if t < start]:
+                    del scores[timestamp]
+
+            self.fetched_from = start
+
+    def window(self, start: int, end: int) -> AZMatrix:
+        timestamps = sorted((t for t in self.columns if start <= t < end), reverse = True)
+        return AZMatrix.from_columns(timestamps, self.azs, [self.columns[t][1] for t in timestamps])
+
+    def stale(self, key, timestamps: list) -> list:
+        """The timestamps whose score for this key is missing or was computed from older values."""
+        scores = self.scores.get(key, {})
+        return [t for t in timestamps if t not in scores or scores[t][0] != self.columns[t][0]]
+
+    def store_scores(self, key, timestamps: list, verdicts: list):
+        scores = self.scores.setdefault(key, {})
+
+        for timestamp, column in zip(timestamps, zip(*verdicts)):
+            scores[timestamp] = (self.columns[timestamp][0], column)
+
+    def verdicts(self, key, timestamps: list) -> list:
+        scores = self.scores[key]
+        return [list(row) for row in zip(*(scores[t][1] for t in timestamps))] if timestamps else [[] for az in self.azs]
+
+
+retained_series = TTLCache(INCREMENTAL_STATE_MAX_ENTRIES, INCREMENTAL_STATE_TTL_SECONDS)
+
+
+def _align(timestamp: int, period: int) -> int:
+    return int(timestamp) - int(timestamp) % period
+
+
+def fetch_incremental(plan: QueryPlan, start, end, metrics, diagnostics: Diagnostics, timings: PhaseTimings = None, deadline: float = None):
+    """
+    Brings the retained series for the plan up to date for the window,
+    fetching only from the newest retained datapoint less a few periods
+    of overlap. Falls back to fetching the whole window when nothing
+    usable is retained.
+    """
+    window_start = _align(start, plan.period)
+    series: RetainedSeries = retained_series.get(plan.key)
+    fetch_start = series.refetch_start(window_start) if series is not None else None
+
+    if fetch_start is None:
+        series = RetainedSeries(plan.azs, plan.period)
+        fetch_start = start
+
+    if fetch_start < end:
+        changed = series.merge(fetch_az_matrix(plan, fetch_start, end, diagnostics, timings, deadline), _align(fetch_start, plan.period))
+    else:
+        changed = 0
+
+    series.trim(window_start)
+    retained_series.put(plan.key, series)
+
+    metrics.put_metric("IncrementalFetchSeconds", end - fetch_start, "Seconds")
+    metrics.put_metric("IncrementalChangedDatapoints", changed, "Count")
+
+    return series, series.window(window_start, end)
+
+
+def score_incremental(series: RetainedSeries, matrix: AZMatrix, algorithm: str, threshold, metrics, diagnostics: Diagnostics) -> list:
+    """
+    Scores only the timestamps in the window whose retained score is missing
+    or out of date. Scores are kept for every AZ, so the alarms for the
+    other AZs reuse them.
+    """
+    if any(t not in series.columns for t in matrix.timestamps):
+        # The series moved on to a later window after this matrix was cached
+        return score(algorithm, matrix, threshold, metrics, diagnostics)
+
+    if algorithm in STATEFUL_ALGORITHMS:
+        metrics.put_metric("ScoredDatapoints", len(matrix.timestamps), "Count")
+        return score(algorithm, matrix, threshold, metrics, diagnostics)
+
+    key = (algorithm, threshold)
+    stale = series.stale(key, matrix.timestamps)
+
+    if stale:
+        columns = [series.columns[t][1] for t in stale]
+        series.store_scores(key, stale, score(algorithm, AZMatrix.from_columns(stale, series.azs, columns), threshold, metrics, diagnostics))
+
+    metrics.put_metric("ScoredDatapoints", len(stale), "Count")
+    return series.verdicts(key, matrix.timestamps)
+
+
 # --- Lambda handler and business logic ---
 
-@metric_scope
-def handler(event, context, metrics):
+_scoped_handler = None
+
+
+def handler(event, context):
+    """
+    The Lambda entry point. The metrics scope is created on the first
+    invocation rather than at import.
+    """
+    global _scoped_handler
+
+    if _scoped_handler is None:
+        from aws_embedded_metrics import metric_scope
+        _scoped_handler = metric_scope(_handle)
+
+    return _scoped_handler(event, context)
+
+
+def _handle(event, context, metrics):
     start = time.perf_counter()
     metrics.set_dimensions(
         {
@@ -141,13 +1241,26 @@ def handler(event, context, metrics):
         }
     )
     metrics.set_namespace("OutlierDetection")
-    metrics.set_property("Event", json.loads(json.dumps(event, default = str)))
+    diagnostics = Diagnostics(metrics)
+    diagnostics.add("Event", event)
     
     event_type = event["EventType"]
 
     if event_type == "GetMetricData":
+        timings = PhaseTimings()
+        profiler = None
+
+        if PROFILE:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
         try:
-            result = get_metric_data(event["GetMetricDataRequest"], metrics)
+            result = get_metric_data(event["GetMetricDataRequest"], metrics, diagnostics, timings, deadline_from(context))
+
+            with timings.phase("Serialize"):
+                diagnostics.flush()
+
             metrics.put_metric("Success", 1, "Count")
 
             end = time.perf_counter()
@@ -170,6 +1283,7 @@ def handler(event, context, metrics):
                 "description": str(exc_value),
                 "details": details
             })
+            diagnostics.flush()
 
             return {
                 "Error": {
@@ -177,6 +1291,18 @@ def handler(event, context, metrics):
                     "Value": str(e)
                 }
             }
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                metrics.set_property("Profile", _profile_summary(profiler, PROFILE_TOP_FUNCTIONS))
+
+            timings.emit(metrics)
+    elif event_type == "Prefetch":
+        result = prefetch(event.get("PrefetchRequest", {}), metrics, deadline = deadline_from(context))
+        end = time.perf_counter()
+        metrics.put_metric("SuccessLatency", (end - start) * 1000, "Milliseconds")
+        metrics.put_metric("Success", 1, "Count")
+        return result
     elif event_type == "DescribeGetMetricData":
         end = time.perf_counter()
         metrics.put_metric("SuccessLatency", (end - start) * 1000, "Milliseconds")
@@ -189,242 +1315,681 @@ def handler(event, context, metrics):
         return {}
 
 
-def get_metric_data(event, metrics):
-    start = event["StartTime"]
-    end = event["EndTime"]
-    period = event["Period"]
-    args: list = event["Arguments"]
-    algorithm: str = str(args[0])
-    threshold: float = float(args[1])
-    metrics.set_property("Threshold", threshold)
-    az_id: str= args[2]
-    metrics.set_property("AZ-ID", az_id)
-    dimensions_per_az: dict = json.loads(args[3])
-    metric_namespace: str = args[4]
-    metrics.set_property("Namespace", metric_namespace)
-    metric_names: list = args[5].split(":")
-    metric_stat: str = args[6]
-    unit: str = args[7]    
-    metrics.set_property("Algorithm", algorithm)
+def get_metric_data(event, metrics, diagnostics: Diagnostics = None, timings: PhaseTimings = None, deadline: float = None, cache_ttl: float = None):
+    if diagnostics is None:
+        diagnostics = Diagnostics(metrics)
+
+    if timings is None:
+        timings = PhaseTimings()
+
+    with timings.phase("ParseArguments"):
+        start = event["StartTime"]
+        end = event["EndTime"]
+        period = event["Period"]
+        args: list = event["Arguments"]
+        algorithm: str = str(args[0])
+        threshold: float = float(args[1])
+        metrics.set_property("Threshold", threshold)
+        az_id: str= args[2]
+        metrics.set_property("AZ-ID", az_id)
+        metrics.set_property("Namespace", args[4])
+        metrics.set_property("Algorithm", algorithm)
+
+        fetch_period: int = plan_period(period, start)
+        metrics.set_property("Period", period)
+        metrics.set_property("FetchPeriod", fetch_period)
+
+    with timings.phase("QueryPlan"):
+        plan: QueryPlan = compile_query_plan(args[3], args[4], args[5], args[6], args[7], fetch_period)
+
+    if plan.operation != "":
+        metrics.set_property("ServiceOperation", plan.operation)
+
+    if plan.warnings:
+        metrics.set_property("QueryPlanWarnings", list(plan.warnings))
+
+    # Windows are aligned to period boundaries, so the alarms and the
+    # prefetch for the same periods share a cache entry
+    start = _align(start, fetch_period)
+    end = -_align(-end, fetch_period)
+
+    # Stateful algorithms need the periods before the window to warm up
+    fetch_start = start - EWMA_LOOKBACK_PERIODS * fetch_period if algorithm in STATEFUL_ALGORITHMS else start
+    cache_key = (plan.key, fetch_start, end)
+    status = "Complete"
+    evictions_before = fetch_cache.evictions
+    cached = fetch_cache.get(cache_key)
+
+    if cached is None:
+        metrics.put_metric("FetchCacheHit", 0, "Count")
+        metrics.put_metric("FetchCacheMiss", 1, "Count")
+
+        with timings.phase("Fetch"):
+            try:
+                if INCREMENTAL_EVALUATION:
+                    series, matrix = fetch_incremental(plan, fetch_start, end, metrics, diagnostics, timings, deadline)
+                else:
+                    series, matrix = None, fetch_az_matrix(plan, fetch_start, end, diagnostics, timings, deadline)
+            except FetchDeadlineExceeded as e:
+                # Score what was fetched rather than letting the invocation time out
+                series = None
+                matrix = e.matrix if e.matrix is not None else AZMatrix([], list(plan.azs), [[] for az in plan.azs])
+                status = "PartialData"
+                diagnostics.summary("FetchDeadlineExceeded", True)
+
+        # Don't serve high resolution results for longer than one period,
+        # or partial ones at all
+        if status == "Complete":
+            fetch_cache.put(cache_key, (series, matrix), cache_ttl if cache_ttl is not None else min(fetch_cache.ttl_seconds, fetch_period))
+    else:
+        series, matrix = cached
+        metrics.put_metric("FetchCacheHit", 1, "Count")
+        metrics.put_metric("FetchCacheMiss", 0, "Count")
 
-    metric_query = {
-        "StartTime": start,
-        "EndTime": end,
-        "MetricDataQueries": [],
-    }
+    metrics.put_metric("FetchCacheEvictions", fetch_cache.evictions - evictions_before, "Count")
+    metrics.set_property("FetchCache", fetch_cache.stats())
+    metrics.set_property("QueryPlanCache", compile_query_plan.cache_info()._asdict())
 
-    operation = ""
+    if diagnostics.detailed:
+        diagnostics.add("InterimCalculation", {"Timestamps": matrix.timestamps, "AZs": matrix.azs, "Values": matrix.rows})
 
-    for az in dimensions_per_az:
+    with timings.phase("Score"):
+        if series is not None:
+            verdicts = score_incremental(series, matrix, algorithm, threshold, metrics, diagnostics)
+        else:
+            verdicts = score(algorithm, matrix, threshold, metrics, diagnostics)
+
+        if fetch_start != start:
+            # Timestamps are newest first, so the window is a prefix
+            kept = sum(1 for timestamp in matrix.timestamps if timestamp >= start)
+            matrix = AZMatrix(matrix.timestamps[:kept], matrix.azs, [row[:kept] for row in matrix.rows])
+            verdicts = [row[:kept] for row in verdicts]
+
+    with timings.phase("Serialize"):
+        # A single invocation can return the results for every AZ, so a dashboard
+        # graph showing all of them only needs one LAMBDA call
+        result_azs = matrix.azs if az_id == ALL_AVAILABILITY_ZONES else [az_id]
+        results = {az: verdicts[matrix.row_index(az)] for az in result_azs}
+
+        diagnostics.summary("Datapoints", len(matrix.timestamps))
+        diagnostics.summary("StatusCode", status)
+        diagnostics.summary("OutlierDatapoints", {az: sum(values) for az, values in results.items()})
+
+        if matrix.timestamps:
+            diagnostics.summary("LatestTimestamp", matrix.timestamps[0])
+            diagnostics.summary("LatestResult", {az: values[0] for az, values in results.items()})
+
+        data_results = {
+            "MetricDataResults": [
+              {
+                 "StatusCode": status,
+                 "Label": az,
+                 "Timestamps": matrix.timestamps,
+                 "Values": values
+              }
+              for az, values in results.items()
+            ]
+        }
 
-        for dimension_set in dimensions_per_az[az]:
+    return data_results
 
-            index = 0
-            az_query_keys = []
 
-            dimensions = []
+def prefetch(request, metrics, now = None, deadline: float = None) -> dict:
+    """
+    Runs each query's window ending at the last period boundary before now,
+    or before the request's EndTime, for every AZ so the matrices are cached
+    before the alarms ask for them. Queries whose boundary passed more than
+    PREFETCH_MAX_AGE_SECONDS ago are skipped. A query that fails, or runs out
+    of time, is counted and the rest still run.
+    """
+    now = time.time() if now is None else now
+    diagnostics = Diagnostics(metrics, level = "OFF")
+    prefetched = 0
+    skipped = 0
+    failed = []
 
-            for dim in dimension_set:
-                dimensions.append({
-                    "Name": dim,
-                    "Value": dimension_set[dim]
-                })
+    for query in request.get("Queries", []):
+        try:
+            period = int(query["Period"])
+            # The bucket after the boundary is still filling, so it isn't fetched
+            reference = min(int(request.get("EndTime", now)), now)
+            end = _align(reference, period)
+
+            if reference - end > PREFETCH_MAX_AGE_SECONDS:
+                skipped += 1
+                continue
+
+            args = list(query["Arguments"])
+            args[2] = ALL_AVAILABILITY_ZONES
+
+            result = get_metric_data({
+                "StartTime": end - int(query.get("EvaluationPeriods", 1)) * period,
+                "EndTime": end,
+                "Period": period,
+                "Arguments": args
+            }, metrics, diagnostics, deadline = deadline, cache_ttl = max(end + period - now, 0) + PREFETCH_GRACE_SECONDS)
+
+            # Partial results aren't cached, so the alarms gain nothing from them
+            if any(item["StatusCode"] != "Complete" for item in result["MetricDataResults"]):
+                failed.append("The prefetch ran out of time")
+            else:
+                prefetched += 1
+        except Exception as e:
+            failed.append(str(e))
 
-                if dim == "Operation":
-                    operation = dimension_set[dim]
+    metrics.put_metric("PrefetchedQueries", prefetched, "Count")
+    metrics.put_metric("PrefetchSkippedQueries", skipped, "Count")
+    metrics.put_metric("PrefetchFailures", len(failed), "Count")
 
-            for metric in metric_names:
-                query = {
-                  "Id": az.replace("-", "_") + str(index),
-                  "Label": az + ' ' + metric,
-                  "ReturnData": False,
-                  "MetricStat": {
-                    "Metric": {
-                      "Namespace": metric_namespace,
-                      "MetricName": metric,
-                      "Dimensions": dimensions
-                    },
-                    "Period": 60,
-                    "Stat": metric_stat,
-                    "Unit": unit,
-                  }
-                }
+    if failed:
+        metrics.set_property("PrefetchErrors", failed)
 
-                az_query_keys.append(az.replace("-", "_")  + str(index))
-                index += 1
+    return {"Prefetched": prefetched, "Failed": len(failed)}
 
-                metric_query["MetricDataQueries"].append(query)
 
-        metric_query["MetricDataQueries"].append({
-            "Id": az.replace("-", "_"),
-            "Label": az,
-            "ReturnData": True,
-            "Expression": "+".join(az_query_keys)
-        })
+def score(algorithm: str, matrix: AZMatrix, threshold, metrics, diagnostics: Diagnostics) -> list:
+    """
+    Runs the requested outlier algorithm, returning a row per AZ of 1 or 0
+    for each timestamp in the matrix.
+    """
+    if not matrix.timestamps:
+        return [[] for az in matrix.azs]
 
-    metrics.set_property("Query", json.loads(json.dumps(metric_query, default = str)))
+    match algorithm:
+        case "Z_SCORE":
+            return _z_score_verdicts(matrix, threshold, diagnostics)
+        case "IQR":
+            return _iqr_verdicts(matrix, threshold, diagnostics)
+        case "MAD":
+            return _mad_verdicts(matrix, threshold, diagnostics)
+        case "EWMA":
+            return _ewma_verdicts(matrix, threshold, diagnostics)
+        case "ENSEMBLE":
+            return _ensemble_verdicts(matrix, threshold, diagnostics)
+        case "CHI_SQUARED" | _:
+            return _chi_squared_verdicts(matrix, threshold, diagnostics)
 
-    if operation != "":
-        metrics.set_property("ServiceOperation", operation)
 
-    next_token: str = None
+def _cloudwatch():
+    """The CloudWatch client, created on first use and shared by every fetch thread."""
+    global cw_client
+
+    if cw_client is None:
+        with _cw_client_lock:
+            if cw_client is None:
+                import boto3
+                from botocore.config import Config
+                cw_client = boto3.client("cloudwatch", os.environ.get("AWS_REGION", "us-east-1"), config = Config(
+                    retries = {"mode": "standard", "max_attempts": 1},
+                    connect_timeout = FETCH_CONNECT_TIMEOUT_SECONDS,
+                    read_timeout = FETCH_READ_TIMEOUT_SECONDS
+                ))
+
+    return cw_client
+
+
+_fetch_executor: ThreadPoolExecutor = None
+_fetch_executor_lock = threading.Lock()
+
+
+def _fetch_pool() -> ThreadPoolExecutor:
+    """The thread pool chunks and slices are fetched on, kept for the life of the container."""
+    global _fetch_executor
+
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(max_workers = max(1, FETCH_MAX_CONCURRENCY), thread_name_prefix = "fetch")
+        return _fetch_executor
+
+
+def time_slices(start, end, period: int, max_slices: int = None, min_periods: int = None) -> list:
+    """
+    Splits [start, end) into up to max_slices contiguous (start, end) ranges
+    of at least min_periods periods each. The boundaries between slices fall
+    on multiples of the period so no datapoint is split across two slices.
+    """
+    max_slices = FETCH_MAX_SLICES if max_slices is None else max_slices
+    min_periods = FETCH_SLICE_MIN_PERIODS if min_periods is None else min_periods
+
+    base = _align(start, period)
+    periods = max(1, math.ceil((end - base) / period))
+    count = max(1, min(max_slices, periods // max(1, min_periods)))
 
-    az_counts: dict = {}
+    if count == 1:
+        return [(start, end)]
+
+    step = math.ceil(periods / count) * period
+    boundaries = [start] + [base + step * index for index in range(1, count) if base + step * index < end]
+
+    return list(zip(boundaries, boundaries[1:] + [end]))
+
+
+def _fetch_slice(queries: tuple, start, end, builder, lock, diagnostics: Diagnostics, name: str, timings: PhaseTimings, labels: dict = None, deadline: float = None):
+    """
+    Fetches one chunk of queries over one slice, folding each page into the
+    builder as it arrives. With labels, results are grouped Metrics Insights
+    results whose labels are mapped to their AZ, and groups for other AZs
+    are ignored.
+    """
+    metric_query = {
+        "StartTime": start,
+        "EndTime": end,
+        "MetricDataQueries": list(queries),
+    }
+
+    next_token: str = None
 
     while True:
         if next_token is not None:
             metric_query["NextToken"] = next_token
 
-        data = cw_client.get_metric_data(**metric_query)
+        begin = time.perf_counter()
+        data = _get_metric_data_with_retries(metric_query, deadline, timings)
+        fetched = time.perf_counter()
+
+        # The invocation has already returned without this page
+        if deadline is not None and time.monotonic() >= deadline:
+            raise FetchDeadlineExceeded()
 
         if next_token is not None:
-            metrics.set_property("GetMetricResult::" + next_token, json.loads(json.dumps(data, default = str)))
+            diagnostics.add(name + "::" + next_token, data)
         else:
-            metrics.set_property("GetMetricResult", json.loads(json.dumps(data, default = str)))
+            diagnostics.add(name, data)
+
+        with lock:
+            for item in data["MetricDataResults"]:
+                az = item["Label"] if labels is None else labels.get(item["Label"])
 
-        for item in data["MetricDataResults"]:          
-            az_id = item["Id"].replace("_", "-")
-            
-            for index, timestamp in enumerate(item["Timestamps"]):
-                epoch_timestamp = int(timestamp.timestamp())
-                if epoch_timestamp not in az_counts:
-                    az_counts[epoch_timestamp] = {az:0 for az in dimensions_per_az}
+                if az is not None:
+                    builder.add(az, item["Timestamps"], item["Values"], item["Id"])
 
-                az_counts[epoch_timestamp][az_id] = item["Values"][index]
+        timings.page(fetched - begin, sum(len(item["Values"]) for item in data["MetricDataResults"]))
+        timings.add("Assemble", time.perf_counter() - fetched)
 
-        if "NextToken" in data:
-            next_token = data["NextToken"]
+        next_token = data.get("NextToken")
+        data = None
 
         if next_token is None:
             break
 
-    metrics.set_property("InterimCalculation", json.loads(json.dumps(az_counts, default = str)))
 
-    results = []
+def fetch_az_matrix(plan: QueryPlan, start, end, diagnostics: Diagnostics, timings: PhaseTimings = None, deadline: float = None) -> AZMatrix:
+    """
+    Runs the query plan against CloudWatch, following pagination, and returns
+    the value of each AZ at each timestamp. Long windows are fetched as time
+    slices and plans that exceed the request limits as chunks, all of them
+    concurrently. Recent windows use the plan's Metrics Insights queries
+    when there are any and they are enabled. When the deadline passes first,
+    FetchDeadlineExceeded is raised with the matrix of what was fetched. The result is shared through the fetch cache and must not
+    be mutated by callers.
+    """
+    if timings is None:
+        timings = PhaseTimings()
+
+    for name in ("GetMetricDataThrottles", "GetMetricDataRetries", "FetchDeadlineExceeded"):
+        timings.count(name, 0)
+
+    slices = time_slices(start, end, plan.period)
 
-    match algorithm:
-        case "Z_SCORE":
-            results = z_score(az_counts = az_counts, az_id = az_id, threshold = threshold, metrics = metrics)
-        case "IQR":
-            results = iqr(az_counts = az_counts, az_id = az_id, threshold = threshold, metrics = metrics)
-        case "MAD":
-            results = mad(az_counts = az_counts, az_id = az_id, threshold = threshold, metrics = metrics)
-        case "CHI_SQUARED" | _:
-            results = chi_squared(az_counts = az_counts, az_id = az_id, threshold = threshold, metrics = metrics)
-
-    data_results = {
-        "MetricDataResults": [
-          {
-             "StatusCode": "Complete",
-             "Label": az_id,
-             "Timestamps": sorted(az_counts.keys(), reverse = True),
-             "Values": results
-          }
-        ]
-    }
+    if METRICS_INSIGHTS and plan.insights and start >= time.time() - METRICS_INSIGHTS_MAX_AGE_SECONDS:
+        chunks, labels = (plan.insights,), plan.insights_labels
+    else:
+        chunks, labels = plan.chunks, None
 
-    return data_results
+    diagnostics.summary("FetchStrategy", "MetricsInsights" if labels is not None else "Enumerate")
+    diagnostics.add("Query", {
+        "StartTime": start,
+        "EndTime": end,
+        "MetricDataQueries": [query for chunk in chunks for query in chunk],
+        "Chunks": len(chunks),
+        "Slices": slices
+    })
 
+    builder = AZMatrixBuilder(plan.azs)
+    lock = threading.Lock()
 
-# Chi-squared     
-def chi_squared(az_counts: dict, az_id: str, threshold, metrics):
-    results = []
-    for timestamp_key in sorted(az_counts.keys(), reverse = True):
-        vals = list(az_counts[timestamp_key].values())
-        
-        if not all(v == 0 for v in vals):
-            if len(vals) > 0:
-                expected = sum(vals) / len(vals)
-                p_value = _chi_squared_p_value(vals)
-                metrics.set_property("PValue_" + str(timestamp_key), str(p_value))
-
-                for az in az_counts[timestamp_key]:
-                    farthest_from_expected = az
-                    break
-
-                for az in az_counts[timestamp_key]:
-                    if abs(az_counts[timestamp_key][az] - expected) > abs(az_counts[timestamp_key][farthest_from_expected] - expected):
-                        farthest_from_expected = az        
-
-                if not math.isnan(p_value) and p_value <= threshold and az_id == farthest_from_expected:
-                    results.append(1)
-                else:
-                    results.append(0)
-            else:
-                metrics.set_property("PValue_" + str(timestamp_key), "No values for timestamp.")
-                results.append(0)
-            
-        else:
-            metrics.set_property("PValue_" + str(timestamp_key), "All values are zero.")
-            results.append(0)
+    requests = []
 
-    return results
+    for chunk_index, queries in enumerate(chunks):
+        for slice_start, slice_end in slices:
+            name = "GetMetricResult"
 
-# Z-Score
-def z_score(az_counts: dict, az_id: str, threshold, metrics):
-    results = []
-    for timestamp_key in sorted(az_counts.keys(), reverse = True):
-        vals = list(az_counts[timestamp_key].values())
-        mean = _mean(vals)
-        metrics.set_property("Mean_" + str(timestamp_key), mean)
-        std = _std(vals)
-        metrics.set_property("StdDev_" + str(timestamp_key), std)
-        
-        val = az_counts[timestamp_key][az_id]
-
-        if std == 0:
-            results.append(0)
+            if len(chunks) > 1:
+                name += "[chunk " + str(chunk_index) + "]"
+            if len(slices) > 1:
+                name += "[" + str(slice_start) + "]"
+
+            requests.append((queries, slice_start, slice_end, builder, lock, diagnostics, name, timings, labels, deadline))
+
+    expired = False
+
+    if len(requests) == 1 and deadline is None:
+        _fetch_slice(*requests[0])
+    else:
+        # Waiting with a timeout lets the invocation return on time even
+        # when a request is still in flight
+        futures = [_fetch_pool().submit(_fetch_slice, *request) for request in requests]
+        done, pending = wait(futures, timeout = None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+        for future in pending:
+            future.cancel()
+
+        expired = bool(pending)
+
+        for future in futures:
+            if future in done:
+                try:
+                    future.result()
+                except FetchDeadlineExceeded:
+                    expired = True
+
+    with timings.phase("Assemble"), lock:
+        matrix = builder.build()
+
+    if expired:
+        timings.count("FetchDeadlineExceeded")
+        raise FetchDeadlineExceeded(matrix)
+
+    return matrix
+
+
+# Each algorithm computes the statistics for every timestamp once and returns
+# a row of 1 (outlier) or 0 results per AZ, in the matrix's AZ order. The
+# column statistics can be passed in when they have already been computed
+# for the matrix. The public functions return the row for a single AZ.
+
+def _chi_squared_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics, totals = None) -> list:
+    n = len(matrix.azs)
+    totals = _column_sums(matrix) if totals is None else totals
+    expected = [total / n for total in totals]
+    chi2 = [sum((v - e) ** 2 / e for v in column) if e != 0 else 0.0 for column, e in zip(zip(*matrix.rows), expected)]
+
+    if _numpy_enabled():
+        a = matrix.array()
+        # argmax picks the first AZ on ties, as the loop below does
+        farthest = np.argmax(np.abs(a - np.array(expected)), axis = 0).tolist()
+        all_zero = np.all(a == 0, axis = 0).tolist()
+    else:
+        farthest = []
+        for j, e in enumerate(expected):
+            best = 0
+            for i in range(1, n):
+                if abs(matrix.rows[i][j] - e) > abs(matrix.rows[best][j] - e):
+                    best = i
+            farthest.append(best)
+        all_zero = [all(row[j] == 0 for row in matrix.rows) for j in range(len(matrix.timestamps))]
+
+    verdicts = [[0] * len(matrix.timestamps) for az in matrix.azs]
+    p_values = []
+
+    # The exact p-value is only needed near the critical value, or when it
+    # is written to the diagnostics
+    low, high = _chi_squared_decision_bounds(n - 1, threshold) if n >= 2 else (0.0, 0.0)
+
+    for j in range(len(matrix.timestamps)):
+        if all_zero[j]:
+            p_values.append(None)
             continue
 
-        z = (val - mean) / std
-        metrics.set_property("ZScore_" + str(timestamp_key), z)
-            
-        if z >= threshold:
-            results.append(1)
+        if n < 2 or totals[j] == 0:
+            p_value = 1.0
+        elif diagnostics.detailed or (j == 0 and diagnostics.level != "OFF") or not (chi2[j] < low or chi2[j] > high):
+            p_value = _chi_squared_sf(chi2[j], n - 1)
         else:
-            results.append(0)
-    
-    return results
+            p_value = None
 
-# Interquartile Range Method
-def iqr(az_counts: dict, az_id: str, threshold, metrics):
-    results = []
-    for timestamp_key in sorted(az_counts.keys(), reverse = True):
-        vals = sorted(list(az_counts[timestamp_key].values()))
-        q1 = _percentile(vals, 25)
-        metrics.set_property("Q1_" + str(timestamp_key), q1)
-        q3 = _percentile(vals, 75)
-        metrics.set_property("Q3_" + str(timestamp_key), q3)
-        iqr_val = q3 - q1
-        metrics.set_property("IQR_" + str(timestamp_key), iqr_val)
-
-        upper_bound = q3 + (1.5 * iqr_val)
-
-        metrics.set_property("UPPER_BOUND_" + str(timestamp_key), upper_bound)
-
-        if az_counts[timestamp_key][az_id] > upper_bound:
-            results.append(1)
-        else:
-            results.append(0)
-    
-    return results
+        p_values.append(p_value)
 
-# Median Absolute Deviation (MAD)
-def mad(az_counts: dict, az_id: str, threshold, metrics):
-    results = []
-    for timestamp_key in sorted(az_counts.keys(), reverse = True):
-        vals = sorted(list(az_counts[timestamp_key].values()))
-        median = _median(vals)
+        if p_value is None:
+            if chi2[j] > high:
+                verdicts[farthest[j]][j] = 1
+        elif not math.isnan(p_value) and p_value <= threshold:
+            verdicts[farthest[j]][j] = 1
 
-        absolute_deviations = [abs(val - median) for val in vals]
+    diagnostics.summary("PValue", "All values are zero." if p_values[0] is None else p_values[0])
+    diagnostics.add("PValue", p_values)
 
-        mad_val = _median(absolute_deviations)
+    return verdicts
 
-        metrics.set_property("MAD_" + str(timestamp_key), mad_val)
 
-        if az_counts[timestamp_key][az_id] >= median + (threshold * mad_val):
-            results.append(1)
-        else:
-            results.append(0)
-    
-    return results
+def _z_score_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics, means = None, stds = None, as_array: bool = False) -> list:
+    means = _column_means(matrix) if means is None else means
+    stds = _column_stds(matrix, means) if stds is None else stds
+
+    if _numpy_enabled():
+        std_array = np.array(stds)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            z = (matrix.array() - np.array(means)) / std_array
+        verdicts = np.where(std_array == 0, 0, z >= threshold).astype(int)
+        verdicts = verdicts if as_array else verdicts.tolist()
+        z = z.tolist()
+    else:
+        z = [[(v - m) / sd if sd != 0 else 0 for v, m, sd in zip(row, means, stds)] for row in matrix.rows]
+        verdicts = [[0 if sd == 0 else int(score >= threshold) for score, sd in zip(z_row, stds)] for z_row in z]
+
+    means = _to_list(means)
+    stds = _to_list(stds)
+    diagnostics.summary("Mean", means[0])
+    diagnostics.summary("StdDev", stds[0])
+
+    if diagnostics.detailed:
+        diagnostics.add("Mean", means)
+        diagnostics.add("StdDev", stds)
+        diagnostics.add("ZScore", {az: [score if std != 0 else None for score, std in zip(z_row, stds)] for az, z_row in zip(matrix.azs, z)})
+
+    return verdicts
+
+
+def _iqr_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics, sorted_rows = None, as_array: bool = False) -> list:
+    rows = matrix.array() if _numpy_enabled() else matrix.rows
+    sorted_rows = _sorted_columns(rows) if sorted_rows is None else sorted_rows
+    q1 = _column_percentiles(sorted_rows, 25)
+    q3 = _column_percentiles(sorted_rows, 75)
+
+    if _numpy_enabled():
+        iqr_vals = q3 - q1
+        upper_bounds = q3 + (1.5 * iqr_vals)
+        verdicts = (rows > upper_bounds).astype(int)
+        verdicts = verdicts if as_array else verdicts.tolist()
+    else:
+        iqr_vals = [high - low for low, high in zip(q1, q3)]
+        upper_bounds = [high + (1.5 * spread) for high, spread in zip(q3, iqr_vals)]
+        verdicts = [[int(v > bound) for v, bound in zip(row, upper_bounds)] for row in rows]
+
+    diagnostics.summary("Q1", _first(q1))
+    diagnostics.summary("Q3", _first(q3))
+    diagnostics.summary("UpperBound", _first(upper_bounds))
+
+    if diagnostics.detailed:
+        diagnostics.add("Q1", _to_list(q1))
+        diagnostics.add("Q3", _to_list(q3))
+        diagnostics.add("IQR", _to_list(iqr_vals))
+        diagnostics.add("UpperBound", _to_list(upper_bounds))
+
+    return verdicts
+
+
+def _mad_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics, sorted_rows = None, as_array: bool = False) -> list:
+    rows = matrix.array() if _numpy_enabled() else matrix.rows
+    medians = _column_medians(_sorted_columns(rows) if sorted_rows is None else sorted_rows)
+
+    if _numpy_enabled():
+        mad_vals = _column_medians(_sorted_columns(np.abs(rows - medians)))
+        verdicts = (rows >= medians + (threshold * mad_vals)).astype(int)
+        verdicts = verdicts if as_array else verdicts.tolist()
+    else:
+        deviations = [[abs(v - median) for v, median in zip(row, medians)] for row in rows]
+        mad_vals = _column_medians(_sorted_columns(deviations))
+        bounds = [median + (threshold * mad_val) for median, mad_val in zip(medians, mad_vals)]
+        verdicts = [[int(v >= bound) for v, bound in zip(row, bounds)] for row in rows]
+
+    diagnostics.summary("Median", _first(medians))
+    diagnostics.summary("MAD", _first(mad_vals))
+
+    if diagnostics.detailed:
+        diagnostics.add("Median", _to_list(medians))
+        diagnostics.add("MAD", _to_list(mad_vals))
+
+    return verdicts
+
+
+def _ewma_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics) -> list:
+    """
+    Walks the timestamps oldest first, keeping for each AZ an exponentially
+    weighted moving average of its values and a slower baseline mean and
+    variance of them. An AZ is an outlier when its smoothed value has a
+    z-score of at least threshold against the mean and standard deviation
+    of the other AZs' smoothed values, or is above them when they are all
+    equal, and, once its baseline is warmed up, is also at least threshold
+    baseline standard deviations above its own baseline mean. The AZ being
+    scored is left out of its peers, otherwise it pulls their mean toward
+    itself and with n AZs its z-score can't exceed the square root of n - 1.
+    The smoothing keeps single period spikes from low traffic AZs from
+    counting.
+    """
+    n = len(matrix.azs)
+    count = len(matrix.timestamps)
+    alpha = 2.0 / (EWMA_SPAN + 1)
+    baseline_alpha = 2.0 / (EWMA_BASELINE_SPAN + 1)
+
+    smoothed = [None] * n
+    baseline_mean = [0.0] * n
+    baseline_var = [0.0] * n
+    seen = [0] * n
+
+    verdicts = [[0] * count for az in matrix.azs]
+    smoothed_history = [[0.0] * count for az in matrix.azs]
+    deviations = [[None] * count for az in matrix.azs]
+    peer_z = [[None] * count for az in matrix.azs]
+
+    for j in range(count - 1, -1, -1):
+        for i in range(n):
+            value = matrix.rows[i][j]
+            smoothed[i] = value if smoothed[i] is None else smoothed[i] + alpha * (value - smoothed[i])
+            smoothed_history[i][j] = smoothed[i]
+
+        for i in range(n):
+            peers = smoothed[:i] + smoothed[i + 1:]
+            above_peers = False
+
+            if peers:
+                mean = _mean(peers)
+                std = _std(peers)
+
+                if std != 0:
+                    peer_z[i][j] = (smoothed[i] - mean) / std
+                    above_peers = peer_z[i][j] >= threshold
+                else:
+                    above_peers = smoothed[i] > mean
+
+            # Until the baseline is warmed up only the peers are compared
+            above_baseline = True
+
+            if seen[i] >= EWMA_WARMUP_PERIODS:
+                if baseline_var[i] > 0:
+                    deviations[i][j] = (smoothed[i] - baseline_mean[i]) / math.sqrt(baseline_var[i])
+                    above_baseline = deviations[i][j] >= threshold
+                else:
+                    above_baseline = smoothed[i] > baseline_mean[i]
+
+            if above_peers and above_baseline:
+                verdicts[i][j] = 1
+
+            # The baseline is updated after scoring so it never includes
+            # the value being scored
+            value = matrix.rows[i][j]
+
+            if seen[i] == 0:
+                baseline_mean[i] = value
+            else:
+                difference = value - baseline_mean[i]
+                increment = baseline_alpha * difference
+                baseline_mean[i] += increment
+                baseline_var[i] = (1 - baseline_alpha) * (baseline_var[i] + difference * increment)
+
+            seen[i] += 1
+
+    diagnostics.summary("Smoothed", {az: row[0] for az, row in zip(matrix.azs, smoothed_history)})
+    diagnostics.summary("BaselineDeviation", {az: row[0] for az, row in zip(matrix.azs, deviations)})
+
+    if diagnostics.detailed:
+        diagnostics.add("Smoothed", dict(zip(matrix.azs, smoothed_history)))
+        diagnostics.add("ZScore", dict(zip(matrix.azs, peer_z)))
+        diagnostics.add("BaselineDeviation", dict(zip(matrix.azs, deviations)))
+
+    return verdicts
+
+
+def _ensemble_verdicts(matrix: AZMatrix, threshold, diagnostics: Diagnostics) -> list:
+    """
+    Computes the column sums, means, standard deviations and sorted values
+    once and derives the CHI_SQUARED, Z_SCORE, IQR and MAD verdicts from
+    them, each with its ENSEMBLE_ threshold. An AZ is an outlier at a
+    timestamp when at least threshold of the four flag it.
+    """
+    n = len(matrix.azs)
+    sums = _column_sums(matrix)
+    means = [total / n for total in sums]
+    stds = _column_stds(matrix, means)
+    sorted_rows = _sorted_columns(matrix.array() if _numpy_enabled() else matrix.rows)
+    required = min(4, max(1, int(math.ceil(threshold))))
+
+    votes = [
+        _chi_squared_verdicts(matrix, ENSEMBLE_CHI_SQUARED_THRESHOLD, diagnostics, totals = sums),
+        _z_score_verdicts(matrix, ENSEMBLE_Z_SCORE_THRESHOLD, diagnostics, means = means, stds = stds, as_array = True),
+        _iqr_verdicts(matrix, None, diagnostics, sorted_rows = sorted_rows, as_array = True),
+        _mad_verdicts(matrix, ENSEMBLE_MAD_THRESHOLD, diagnostics, sorted_rows = sorted_rows, as_array = True)
+    ]
+
+    if _numpy_enabled():
+        counts = np.array(votes[0], dtype = int) + votes[1] + votes[2] + votes[3]
+        verdicts = (counts >= required).astype(int).tolist()
+        counts = counts.tolist() if diagnostics.detailed else counts[:, :1].tolist()
+    else:
+        counts = [[a + b + c + d for a, b, c, d in zip(*az_votes)] for az_votes in zip(*votes)]
+        verdicts = [[int(count >= required) for count in row] for row in counts]
+
+    diagnostics.summary("Votes", {az: row[0] for az, row in zip(matrix.azs, counts)})
+    diagnostics.summary("RequiredVotes", required)
+
+    if diagnostics.detailed:
+        diagnostics.add("Votes", dict(zip(matrix.azs, counts)))
+
+    return verdicts
+
+
+def _verdicts_for(verdicts_fn, az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics) -> list:
+    matrix = _as_matrix(az_counts)
+
+    if diagnostics is None:
+        diagnostics = Diagnostics(metrics)
+
+    if not matrix.timestamps:
+        return []
+
+    target = matrix.row_index(az_id)
+    return verdicts_fn(matrix, threshold, diagnostics)[target]
+
+# Chi-squared
+def chi_squared(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_chi_squared_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
+
+# Z-Score
+def z_score(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_z_score_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
+
+# Interquartile Range Method
+def iqr(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_iqr_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
+
+# Median Absolute Deviation (MAD)
+def mad(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_mad_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
+
+# Exponentially weighted moving average against peers and a rolling baseline
+def ewma(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_ewma_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
+
+# Vote of CHI_SQUARED, Z_SCORE, IQR and MAD from shared statistics
+def ensemble(az_counts, az_id: str, threshold, metrics, diagnostics: Diagnostics = None):
+    return _verdicts_for(_ensemble_verdicts, az_counts, az_id, threshold, metrics, diagnostics)
@@ -132,6 +132,12 @@ export class InstrumentedServiceMultiAZObservability
           regionalRequestCount: testProps.regionalRequestCount
             ? testProps.regionalRequestCount
             : testProps.requestCount,
+          requestsPerSecond: testProps.requestsPerSecond,
+          maxConcurrentRequests: testProps.maxConcurrentRequests,
+          maxResponseBodyBytes: testProps.maxResponseBodyBytes,
+          expectedResponseBodySize: testProps.expectedResponseBodySize,
+          expectedResponseBodySha256: testProps.expectedResponseBodySha256,
+          aggregateMetrics: testProps.aggregateMetrics,
           schedule: testProps.schedule,
           operation: operation,
           loadBalancer: testProps.loadBalancer,
@@ -452,7 +458,10 @@ export class InstrumentedServiceMultiAZObservability
       this.outlierDetectionFunction = new OutlierDetectionFunction(
         outlierDetectionStack,
         'OutlierDetectionFunction',
-        {},
+        {
+          slim: true,
+          prefetch: props.outlierDetectionPrefetch,
+        },
       ).function;
     }
 
@@ -523,6 +532,11 @@ export class InstrumentedServiceMultiAZObservability
               interval: props.interval
                 ? props.interval
                 : Duration.minutes(60),
+              outlierDetectionFunction: this.outlierDetectionFunction,
+              availabilityOutlierDetectionAlgorithm: availabilityOutlierDetectionAlgorithm,
+              availabilityOutlierThreshold: availabilityOutlierThreshold,
+              latencyOutlierDetectionAlgorithm: latencyOutlierDetectionAlgorithm,
+              latencyOutlierThreshold: latencyOutlierThreshold,
             },
           ).dashboard,
         );
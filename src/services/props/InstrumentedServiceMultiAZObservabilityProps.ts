@@ -99,6 +99,15 @@ export interface InstrumentedServiceMultiAZObservabilityProps {
    */
   readonly latencyOutlierMetricAggregation?: LatencyOutlierMetricAggregation;
 
+  /**
+   * Sends the outlier detection function a scheduled event every minute so
+   * it fetches the windows the outlier alarms evaluate before they ask for
+   * them. This adds an invocation of the function each minute.
+   *
+   * @default false
+   */
+  readonly outlierDetectionPrefetch?: boolean;
+
   /**
    * The interval used in the dashboard, defaults to
    * 60 minutes.
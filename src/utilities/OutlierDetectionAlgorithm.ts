@@ -46,4 +46,28 @@ export enum OutlierDetectionAlgorithm {
    * A common default value threshold 3
    */
   MAD = 'MAD',
+
+  /**
+   * Smooths each AZ's values with an exponentially weighted moving average and
+   * finds outliers using the z-score of the smoothed value against the other AZs
+   * and against the AZ's own rolling baseline
+   *
+   * The threshold applies to both z-scores. Single period spikes in low traffic AZs
+   * are smoothed out, so this can be used with fewer evaluation periods. The AZ
+   * being scored is left out of the mean and standard deviation of the other AZs
+   * it is compared to, so a good default threshold is 2.
+   */
+  EWMA = 'EWMA',
+
+  /**
+   * Runs the chi squared, z-score, IQR and MAD methods from one set of
+   * statistics and finds outliers that enough of them agree on
+   *
+   * The threshold is the number of the four methods, from 1 to 4, that must
+   * flag the same AZ. Each method uses its own threshold, set with the
+   * ENSEMBLE_CHI_SQUARED_THRESHOLD, ENSEMBLE_Z_SCORE_THRESHOLD and
+   * ENSEMBLE_MAD_THRESHOLD environment variables of the function. A good
+   * default threshold is 2.
+   */
+  ENSEMBLE = 'ENSEMBLE',
 }
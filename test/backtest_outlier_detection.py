@@ -0,0 +1,204 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Backtests outlier algorithms and thresholds over weeks of per-AZ history to
+help choose them for an operation. The history is loaded through the
+function's own query plan and fetch path from the CloudWatch stand-in, then
+each algorithm scores the whole history at once for each threshold in the
+grid, instead of making one handler call per minute.
+
+    python3 test/backtest_outlier_detection.py --days 30 --azs 6 --impaired-az use1-az2 --impairment 1.5
+    python3 test/backtest_outlier_detection.py --recording faults.json --evaluation-periods 5 --datapoints-to-alarm 3
+    python3 test/backtest_outlier_detection.py --csv export.csv --thresholds Z_SCORE=1.5,2,2.5
+
+History comes from a synthetic source by default, from a recording saved by
+RecordingCloudWatch with --recording, or from a CSV export with Timestamp,
+AvailabilityZoneId and Value columns with --csv.
+
+For each algorithm and threshold it reports the outlier datapoints of each
+AZ, and the periods in alarm and the alarm episodes an alarm on the outlier
+metric would have had with --evaluation-periods and --datapoints-to-alarm.
+
+Every algorithm but EWMA scores each timestamp only from that timestamp's
+values, so the results are the ones the alarms would have seen. EWMA is
+scored over the whole history, which warms its baseline more than an
+alarm's short window does.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "outlier-detection", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import index
+from cloudwatch_stand_in import CloudWatchStandIn, RecordedSource, SyntheticSource
+
+DEFAULT_THRESHOLDS = {
+    "CHI_SQUARED": [0.01, 0.05, 0.1],
+    "Z_SCORE": [1.0, 1.5, 2.0, 3.0],
+    # IQR ignores the threshold
+    "IQR": [0.0],
+    "MAD": [2.0, 3.0, 4.0],
+    "EWMA": [1.5, 2.0, 3.0],
+    # The number of the four algorithms above that must agree
+    "ENSEMBLE": [1, 2, 3],
+}
+
+
+class Metrics:
+    """Discards what the scoring functions write to the metrics scope."""
+
+    def set_property(self, name, value):
+        pass
+
+    def put_metric(self, name, value, unit = None):
+        pass
+
+    def set_dimensions(self, *dimensions):
+        pass
+
+    def set_namespace(self, namespace):
+        pass
+
+
+def load_csv(path: str) -> dict:
+    """Reads a Timestamp, AvailabilityZoneId, Value export into the recording format."""
+    recorded = {}
+
+    with open(path, newline = "") as f:
+        for row in csv.DictReader(f):
+            timestamp = row["Timestamp"]
+            seconds = int(timestamp) if timestamp.isdigit() else int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp())
+            recorded.setdefault(row["AvailabilityZoneId"], []).append((seconds, float(row["Value"])))
+
+    return recorded
+
+
+def load_history(source, azs: list, start: int, end: int, period: int) -> index.AZMatrix:
+    """Fetches the history through the query plan and paginated fetch, returned newest first."""
+    dimensions = json.dumps({az: [{"AvailabilityZoneId": az, "Operation": "Backtest"}] for az in azs})
+    plan = index.compile_query_plan(dimensions, "Backtest", "Fault", "Sum", "Count", period)
+    original = index.cw_client
+    index.cw_client = CloudWatchStandIn(source)
+
+    try:
+        return index.fetch_az_matrix(plan, start, end, index.Diagnostics(Metrics(), level = "OFF"))
+    finally:
+        index.cw_client = original
+
+
+def alarm_states(verdicts: list, evaluation_periods: int, datapoints_to_alarm: int) -> tuple:
+    """
+    The periods in alarm and the number of alarm episodes for a row of
+    verdicts, oldest first, with an M out of N alarm on them.
+    """
+    in_alarm = 0
+    episodes = 0
+    breaching = 0
+    alarming = False
+
+    for i, verdict in enumerate(verdicts):
+        breaching += verdict
+
+        if i >= evaluation_periods:
+            breaching -= verdicts[i - evaluation_periods]
+
+        now_alarming = breaching >= datapoints_to_alarm
+        in_alarm += now_alarming
+
+        if now_alarming and not alarming:
+            episodes += 1
+
+        alarming = now_alarming
+
+    return in_alarm, episodes
+
+
+def backtest(matrix: index.AZMatrix, grid: dict, evaluation_periods: int, datapoints_to_alarm: int) -> list:
+    results = []
+
+    for algorithm, thresholds in grid.items():
+        for threshold in thresholds:
+            begin = time.perf_counter()
+            verdicts = index.score(algorithm, matrix, threshold, Metrics(), index.Diagnostics(Metrics(), level = "OFF"))
+            elapsed = time.perf_counter() - begin
+            azs = {}
+
+            for az, row in zip(matrix.azs, verdicts):
+                in_alarm, episodes = alarm_states(row[::-1], evaluation_periods, datapoints_to_alarm)
+                azs[az] = {"OutlierDatapoints": sum(row), "AlarmPeriods": in_alarm, "AlarmEpisodes": episodes}
+
+            results.append({"Algorithm": algorithm, "Threshold": threshold, "ScoringSeconds": elapsed, "AZs": azs})
+
+    return results
+
+
+def parse_grid(algorithms: str, overrides: list) -> dict:
+    grid = {algorithm: DEFAULT_THRESHOLDS[algorithm] for algorithm in algorithms.split(",")}
+
+    for override in overrides or []:
+        algorithm, values = override.split("=", 1)
+        grid[algorithm] = [float(value) for value in values.split(",")]
+
+    return grid
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recording", help = "replay series recorded with RecordingCloudWatch")
+    parser.add_argument("--csv", help = "replay a Timestamp, AvailabilityZoneId, Value export")
+    parser.add_argument("--days", type = float, default = 30.0, help = "days of history to backtest")
+    parser.add_argument("--end", type = int, help = "end of the history, defaults to the newest recorded datapoint or now")
+    parser.add_argument("--period", type = int, default = 60)
+    parser.add_argument("--azs", type = int, default = 3, help = "AZs in the synthetic history")
+    parser.add_argument("--impaired-az", help = "multiply this AZ's synthetic series by --impairment")
+    parser.add_argument("--impairment", type = float, default = 3.0)
+    parser.add_argument("--algorithms", default = ",".join(DEFAULT_THRESHOLDS))
+    parser.add_argument("--thresholds", action = "append", help = "ALGORITHM=v1,v2,... replaces the algorithm's default grid")
+    parser.add_argument("--evaluation-periods", type = int, default = 5)
+    parser.add_argument("--datapoints-to-alarm", type = int, default = 3)
+    parser.add_argument("--json", action = "store_true", help = "print the results as JSON")
+    args = parser.parse_args()
+
+    if args.recording or args.csv:
+        source = RecordedSource(load_csv(args.csv)) if args.csv else RecordedSource.load(args.recording)
+        azs = sorted(source.recorded)
+        newest = max((t for points in source.recorded.values() for t in points), default = int(time.time()))
+        end = args.end or newest + args.period
+    else:
+        azs = ["use1-az" + str(i + 1) for i in range(args.azs)]
+        source = SyntheticSource(impaired = {args.impaired_az: args.impairment} if args.impaired_az else None)
+        end = args.end or (int(time.time()) // args.period) * args.period
+
+    start = end - int(args.days * 86400)
+    begin = time.perf_counter()
+    matrix = load_history(source, azs, start, end, args.period)
+    loaded = time.perf_counter() - begin
+
+    grid = parse_grid(args.algorithms, args.thresholds)
+    results = backtest(matrix, grid, args.evaluation_periods, args.datapoints_to_alarm)
+
+    if args.json:
+        print(json.dumps({"Timestamps": len(matrix.timestamps), "AZs": matrix.azs, "LoadSeconds": loaded, "Results": results}, indent = 2))
+        return 0
+
+    print(str(len(matrix.timestamps)) + " timestamps x " + str(len(matrix.azs)) + " AZs loaded in " + format(loaded, ".2f") + "s")
+    print("Each AZ: outlier datapoints / periods in alarm / alarm episodes")
+
+    for result in results:
+        print(
+            (result["Algorithm"] + " " + format(result["Threshold"], "g")).ljust(18) +
+            "  ".join(az + " " + "/".join(str(v) for v in counts.values()) for az, counts in result["AZs"].items()) +
+            "  (" + format(result["ScoringSeconds"] * 1000, ".0f") + "ms)"
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
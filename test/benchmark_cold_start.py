@@ -0,0 +1,141 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Measures the cold start cost of the outlier detection function. Each sample
+runs in a new interpreter so nothing is warm, and times:
+
+  Import      importing index.py, which is the Lambda init phase
+  FirstInvoke the first invocation, including the deferred metrics scope
+  Client      creating the CloudWatch client on first fetch
+
+Run it with the function's runtime dependencies (boto3 and
+aws_embedded_metrics) installed to measure what Lambda will see. Any that
+aren't installed are replaced with minimal stand-ins, so the script still
+runs in the dev environment, but then only index.py's own cost is timed and
+the stubbed modules are reported:
+
+    python3 test/benchmark_cold_start.py --samples 20 --save cold-start.json
+    python3 test/benchmark_cold_start.py --baseline cold-start.json --max-regression 0.2
+
+With --baseline the script exits non-zero when the median of any phase is
+more than --max-regression slower than the baseline's.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "outlier-detection", "src")
+MARKER = "COLD_START_SAMPLE "
+PHASES = ("Import", "FirstInvoke", "Client")
+
+SAMPLE = """
+import sys, time, json, types, importlib.util
+
+class Metrics:
+    def set_property(self, name, value): pass
+    def put_metric(self, name, value, unit = None): pass
+    def set_dimensions(self, *dimensions): pass
+    def set_namespace(self, namespace): pass
+
+stubbed = []
+
+def stub(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    stubbed.append(name)
+
+if importlib.util.find_spec("aws_embedded_metrics") is None:
+    stub("aws_embedded_metrics", metric_scope = lambda fn: lambda event, context: fn(event, context, Metrics()))
+if importlib.util.find_spec("boto3") is None:
+    stub("boto3", client = lambda *args, **kwargs: object())
+if importlib.util.find_spec("botocore") is None:
+    stub("botocore")
+    stub("botocore.config", Config = lambda **kwargs: kwargs)
+
+sys.path.insert(0, {source!r})
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+index.handler({{"EventType": "DescribeGetMetricData"}}, None)
+invoked = time.perf_counter()
+index._cloudwatch()
+created = time.perf_counter()
+print({marker!r} + json.dumps({{
+    "Import": imported - start,
+    "FirstInvoke": invoked - imported,
+    "Client": created - invoked,
+    "Stubbed": stubbed,
+}}))
+"""
+
+
+def sample(env: dict) -> dict:
+    code = SAMPLE.format(source = SOURCE, marker = MARKER)
+    output = subprocess.run([sys.executable, "-c", code], env = env, capture_output = True, text = True, check = True).stdout
+
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            return json.loads(line[len(MARKER):])
+
+    raise RuntimeError("No sample in output: " + output)
+
+
+def summarize(samples: list) -> dict:
+    summary = {}
+
+    for phase in PHASES:
+        values = sorted(s[phase] * 1000 for s in samples)
+        summary[phase] = {
+            "MedianMs": statistics.median(values),
+            "P90Ms": values[min(len(values) - 1, int(len(values) * 0.9))],
+        }
+
+    return summary
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type = int, default = 20)
+    parser.add_argument("--baseline", help = "JSON summary to compare against")
+    parser.add_argument("--max-regression", type = float, default = 0.2, help = "allowed fractional slowdown of each median")
+    parser.add_argument("--save", help = "write the summary to this file")
+    args = parser.parse_args()
+
+    # Run as the function does: EMF writes to stdout instead of an agent
+    env = dict(os.environ)
+    env.setdefault("AWS_REGION", "us-east-1")
+    env.setdefault("AWS_LAMBDA_FUNCTION_NAME", "outlier-detection-benchmark")
+
+    samples = [sample(env) for _ in range(args.samples)]
+    summary = summarize(samples)
+    print(json.dumps(summary, indent = 2))
+
+    if samples[0]["Stubbed"]:
+        print("Stubbed " + ", ".join(samples[0]["Stubbed"]) + ", their import and setup times are not included", file = sys.stderr)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = [
+            phase for phase in summary
+            if phase in baseline and summary[phase]["MedianMs"] > baseline[phase]["MedianMs"] * (1 + args.max_regression)
+        ]
+
+        if regressions:
+            print("Regressed: " + ", ".join(regressions), file = sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Benchmarks the outlier detection hot path against the CloudWatch stand-in
+for 3, 4 and 6 AZs and windows of 60 to 10,080 one minute timestamps. Each
+phase is timed separately:
+
+  QueryPlan   compiling the GetMetricData queries from the LAMBDA arguments
+  Fetch       the paginated fetch through the stand-in, folding each page
+  Assemble    building the AZ matrix from already fetched pages
+  <ALGORITHM> scoring every timestamp with each algorithm
+  EMF         flushing FULL diagnostics and serializing the metrics context
+  Handler     get_metric_data end to end with an empty fetch cache
+
+    python3 test/benchmark_outlier_detection.py --save baseline.json
+    python3 test/benchmark_outlier_detection.py --baseline baseline.json
+
+The run fails when any case's Handler time exceeds --budget seconds, the
+function's 5 second timeout by default, or with --baseline when the median
+of a phase is more than --max-regression slower than the baseline's.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "outlier-detection", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import index
+from cloudwatch_stand_in import CloudWatchStandIn, RecordedSource
+
+AZ_COUNTS = [3, 4, 6]
+TIMESTAMP_COUNTS = [60, 1440, 10080]
+ALGORITHMS = ["CHI_SQUARED", "Z_SCORE", "IQR", "MAD", "EWMA", "ENSEMBLE"]
+PERIOD = 60
+
+class Metrics:
+    """Records what the handler writes to its metrics scope."""
+
+    def __init__(self):
+        self.properties = {}
+        self.metrics = []
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def put_metric(self, name, value, unit = None):
+        self.metrics.append((name, value, unit))
+
+    def set_dimensions(self, *dimensions):
+        pass
+
+    def set_namespace(self, namespace):
+        pass
+
+
+def make_case(az_count: int, timestamp_count: int, seed: int = 1):
+    rng = random.Random(seed)
+    azs = ["use1-az" + str(i + 1) for i in range(az_count)]
+    end = (int(time.time()) // PERIOD) * PERIOD
+    start = end - timestamp_count * PERIOD
+    series = {
+        az: [(t, float(rng.randint(0, 100))) for t in range(end - PERIOD, start - PERIOD, -PERIOD)]
+        for az in azs
+    }
+    dimensions = json.dumps({az: [{"AvailabilityZoneId": az, "Operation": "Ride"}] for az in azs})
+    event = {
+        "StartTime": start,
+        "EndTime": end,
+        "Period": PERIOD,
+        "Arguments": ["Z_SCORE", "3", azs[0], dimensions, "Ns", "Fault:Error", "Sum", "Count"]
+    }
+    return series, event
+
+
+def timed(fn, repeat: int) -> float:
+    """The median wall time of fn in milliseconds."""
+    samples = []
+
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - begin) * 1000)
+
+    return statistics.median(samples)
+
+
+def serialize_emf(metrics: Metrics) -> str:
+    try:
+        from aws_embedded_metrics.logger.metrics_context import MetricsContext
+        from aws_embedded_metrics.serializers.log_serializer import LogSerializer
+    except ImportError:
+        return json.dumps({"Properties": metrics.properties, "Metrics": metrics.metrics}, default = str)
+
+    context = MetricsContext.empty()
+
+    for name, value in metrics.properties.items():
+        context.set_property(name, value)
+
+    for name, value, unit in metrics.metrics:
+        context.put_metric(name, value, unit)
+
+    return LogSerializer.serialize(context)
+
+
+def run_case(az_count: int, timestamp_count: int, repeat: int) -> dict:
+    series, event = make_case(az_count, timestamp_count)
+    client = CloudWatchStandIn(RecordedSource(series))
+    args = event["Arguments"]
+    diagnostics_off = index.Diagnostics(Metrics(), level = "OFF")
+    results = {}
+
+    index.cw_client = client
+    plan = index.compile_query_plan(args[3], args[4], args[5], args[6], args[7], PERIOD)
+
+    results["QueryPlan"] = timed(lambda: index.compile_query_plan.__wrapped__(args[3], args[4], args[5], args[6], args[7], PERIOD), repeat)
+    results["Fetch"] = timed(lambda: index.fetch_az_matrix(plan, event["StartTime"], event["EndTime"], diagnostics_off), repeat)
+
+    pages = []
+    token = None
+
+    for queries in plan.chunks:
+        while True:
+            request = {"StartTime": event["StartTime"], "EndTime": event["EndTime"], "MetricDataQueries": list(queries)}
+            if token is not None:
+                request["NextToken"] = token
+            page = client.get_metric_data(**request)
+            pages.append(page)
+            token = page.get("NextToken")
+            if token is None:
+                break
+
+    def assemble():
+        builder = index.AZMatrixBuilder(plan.azs)
+        for page in pages:
+            for item in page["MetricDataResults"]:
+                builder.add(item["Label"], item["Timestamps"], item["Values"], item["Id"])
+        return builder.build()
+
+    results["Assemble"] = timed(assemble, repeat)
+    matrix = assemble()
+
+    for algorithm in ALGORITHMS:
+        threshold = {"CHI_SQUARED": 0.05, "ENSEMBLE": 2}.get(algorithm, 3.0)
+        results[algorithm] = timed(
+            lambda: index.score(algorithm, index.AZMatrix(matrix.timestamps, matrix.azs, matrix.rows), threshold, Metrics(), diagnostics_off),
+            repeat
+        )
+
+    def emf():
+        metrics = Metrics()
+        diagnostics = index.Diagnostics(metrics, level = "FULL", sample_rate = 1.0)
+        index.get_metric_data(event, metrics, diagnostics)
+        index.fetch_cache.clear()
+        begin = time.perf_counter()
+        diagnostics.flush()
+        serialize_emf(metrics)
+        return (time.perf_counter() - begin) * 1000
+
+    results["EMF"] = statistics.median(emf() for _ in range(repeat))
+
+    def handler():
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+        index.get_metric_data(event, Metrics(), index.Diagnostics(Metrics(), level = "SUMMARY"))
+
+    results["Handler"] = timed(handler, repeat)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per phase, the median is reported")
+    parser.add_argument("--budget", type = float, default = 5.0, help = "seconds any case's Handler time may take")
+    parser.add_argument("--baseline", help = "JSON results to compare against")
+    parser.add_argument("--max-regression", type = float, default = 0.25, help = "allowed fractional slowdown of each phase")
+    parser.add_argument("--save", help = "write the results to this file")
+    args = parser.parse_args()
+
+    original = index.cw_client
+    results = {}
+
+    try:
+        for az_count in AZ_COUNTS:
+            for timestamp_count in TIMESTAMP_COUNTS:
+                name = str(az_count) + "x" + str(timestamp_count)
+                results[name] = run_case(az_count, timestamp_count, args.repeat)
+                print(name.ljust(10) + "  ".join(phase + " " + format(ms, ".2f") + "ms" for phase, ms in results[name].items()))
+    finally:
+        index.cw_client = original
+        index.fetch_cache.clear()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent = 2)
+
+    failures = [
+        name + " Handler " + format(phases["Handler"], ".0f") + "ms is over the " + str(args.budget) + "s budget"
+        for name, phases in results.items()
+        if phases["Handler"] > args.budget * 1000
+    ]
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        for name, phases in results.items():
+            for phase, ms in phases.items():
+                before = baseline.get(name, {}).get(phase)
+                if before is not None and ms > before * (1 + args.max_regression):
+                    failures.append(name + " " + phase + " " + format(ms, ".2f") + "ms, was " + format(before, ".2f") + "ms")
+
+    for failure in failures:
+        print("FAILED " + failure, file = sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+A local stand-in for the CloudWatch GetMetricData API that the outlier
+detection function's cw_client can be pointed at without network access.
+It serves per-AZ series from a synthetic or a recorded source, paginating,
+delaying and throttling requests the way the service does.
+
+    import index
+    from cloudwatch_stand_in import CloudWatchStandIn, SyntheticSource
+    index.cw_client = CloudWatchStandIn(SyntheticSource(impaired = {"use1-az1": 3.0}))
+
+Each returned expression, one per AZ in the query plan, is answered with
+the AZ's series. When a plan splits an AZ into partial sums, the first
+partial gets the series and the rest get zeros, so they still add up to it.
+
+Metrics Insights queries are answered with one result per group, labelled
+with the group's value and served from the source's series with that label.
+The groups are the recorded labels of a RecordedSource, or insights_groups.
+As with partial sums, only the query for the first metric name gets values.
+
+Recordings are made by wrapping a real client with RecordingCloudWatch and
+are replayed with RecordedSource.
+"""
+import json
+import math
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+# GetMetricData returns at most this many datapoints in a page
+MAX_DATAPOINTS_PER_PAGE = 100800
+
+
+class ThrottlingException(Exception):
+    """Raised like botocore's ClientError with a Throttling error code."""
+
+    def __init__(self, operation: str = "GetMetricData"):
+        self.response = {
+            "Error": {"Code": "Throttling", "Message": "Rate exceeded"},
+            "ResponseMetadata": {"HTTPStatusCode": 400}
+        }
+        self.operation_name = operation
+        super().__init__("An error occurred (Throttling) when calling the " + operation + " operation: Rate exceeded")
+
+
+class SyntheticSource:
+    """
+    Generates a noisy per-AZ series. Each value is drawn from a generator
+    seeded by the AZ and timestamp, so every request for the same datapoint
+    gets the same value. AZs in impaired are multiplied by their factor.
+    """
+
+    def __init__(self, base: float = 20.0, noise: float = 0.3, impaired: dict = None, seed: int = 1):
+        self.base = base
+        self.noise = noise
+        self.impaired = impaired or {}
+        self.seed = seed
+
+    def value(self, label: str, timestamp: int) -> float:
+        rng = random.Random(str(self.seed) + ":" + label + ":" + str(timestamp))
+        value = self.base * max(0.0, rng.gauss(1.0, self.noise))
+        return float(round(value * self.impaired.get(label, 1.0)))
+
+    def series(self, label: str, start: int, end: int, period: int) -> list:
+        """The (timestamp, value) pairs in [start, end), newest first."""
+        first = int(math.ceil(start / period)) * period
+        return [(t, self.value(label, t)) for t in range(first, int(end), period)][::-1]
+
+
+class RecordedSource:
+    """Replays series recorded by RecordingCloudWatch, keyed by AZ label."""
+
+    def __init__(self, recorded: dict):
+        self.recorded = {label: dict((int(t), v) for t, v in points) for label, points in recorded.items()}
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def series(self, label: str, start: int, end: int, period: int) -> list:
+        points = self.recorded.get(label, {})
+        return sorted(((t, v) for t, v in points.items() if start <= t < end), reverse = True)
+
+
+class RecordingCloudWatch:
+    """Wraps a real CloudWatch client and records every returned series by label."""
+
+    def __init__(self, client):
+        self.client = client
+        self.recorded = {}
+        self._lock = threading.Lock()
+
+    def get_metric_data(self, **kwargs):
+        data = self.client.get_metric_data(**kwargs)
+
+        with self._lock:
+            for item in data["MetricDataResults"]:
+                points = self.recorded.setdefault(item["Label"], {})
+                for timestamp, value in zip(item["Timestamps"], item["Values"]):
+                    points[int(timestamp.timestamp())] = value
+
+        return data
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({label: sorted(points.items()) for label, points in self.recorded.items()}, f)
+
+
+class CloudWatchStandIn:
+    """
+    Serves GetMetricData from a source. Each request sleeps for latency_ms
+    plus per_datapoint_us per datapoint returned, with log-normal jitter,
+    and is throttled once more than rate_limit requests a second are made.
+    """
+
+    def __init__(self, source = None, latency_ms: float = 0.0, per_datapoint_us: float = 0.0, jitter: float = 0.0,
+            rate_limit: float = None, max_datapoints_per_page: int = MAX_DATAPOINTS_PER_PAGE, seed: int = 1,
+            insights_groups: list = None):
+        self.source = source or SyntheticSource()
+        self.insights_groups = insights_groups
+        self.latency_ms = latency_ms
+        self.per_datapoint_us = per_datapoint_us
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.max_datapoints_per_page = max_datapoints_per_page
+        self.requests = 0
+        self.throttled = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            self.requests += 1
+
+            if self.rate_limit is None:
+                return True
+
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+
+            if self._tokens < 1:
+                self.throttled += 1
+                return False
+
+            self._tokens -= 1
+            return True
+
+    def _groups(self) -> list:
+        if self.insights_groups is not None:
+            return self.insights_groups
+
+        return sorted(getattr(self.source, "recorded", {}))
+
+    def _delay(self, datapoints: int):
+        seconds = self.latency_ms / 1000 + datapoints * self.per_datapoint_us / 1000000
+
+        if self.jitter:
+            with self._lock:
+                seconds *= self._rng.lognormvariate(0, self.jitter)
+
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def get_metric_data(self, **kwargs):
+        if not self._take_token():
+            self._delay(0)
+            raise ThrottlingException()
+
+        start = int(kwargs["StartTime"])
+        end = int(kwargs["EndTime"])
+        offset = int(kwargs.get("NextToken", "0"))
+        points = []
+
+        returned = []
+
+        for query in kwargs["MetricDataQueries"]:
+            if not query["ReturnData"]:
+                continue
+
+            period = _period(query, kwargs["MetricDataQueries"])
+            labels = self._groups() if query.get("Expression", "").startswith("SELECT") else [query["Label"]]
+
+            for label in labels:
+                series = self.source.series(label, start, end, period)
+
+                # Partial sums and metric names after the first get zeros so the parts add up
+                if re.search(r"(_p|^insights_)[1-9][0-9]*$", query["Id"]):
+                    series = [(t, 0.0) for t, v in series]
+
+                returned.append((query["Id"], label))
+                points.extend(((query["Id"], label), t, v) for t, v in series)
+
+        page = points[offset:offset + self.max_datapoints_per_page]
+        more = offset + self.max_datapoints_per_page < len(points)
+        results = []
+
+        for result in returned:
+            results.append({
+                "Id": result[0],
+                "Label": result[1],
+                "Timestamps": [datetime.fromtimestamp(t, tz = timezone.utc) for r, t, v in page if r == result],
+                "Values": [v for r, t, v in page if r == result],
+                "StatusCode": "PartialData" if more else "Complete"
+            })
+
+        self._delay(len(page))
+        response = {"MetricDataResults": results, "Messages": []}
+
+        if more:
+            response["NextToken"] = str(offset + self.max_datapoints_per_page)
+
+        return response
+
+
+def _period(query: dict, queries: list) -> int:
+    """The period of a query or of an expression's inputs, 60 if it has none."""
+    if "MetricStat" in query:
+        return query["MetricStat"]["Period"]
+
+    if "Period" in query:
+        return query["Period"]
+
+    ids = set(query.get("Expression", "").split("+"))
+
+    for other in queries:
+        if other["Id"] in ids and "MetricStat" in other:
+            return other["MetricStat"]["Period"]
+
+    return 60
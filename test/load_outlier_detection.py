@@ -0,0 +1,195 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+"""
+Drives the outlier detection handler with production shaped load against
+the CloudWatch stand-in. Every simulated minute each operation's alarms
+for each alarm type and AZ send a GetMetricData event, and a fraction of
+DescribeGetMetricData events are mixed in. The events are run on a pool of
+processes, each standing in for one warm Lambda execution environment.
+
+    python3 test/load_outlier_detection.py --operations 20 --azs 3 --minutes 5 --speedup 10
+
+Reports throughput, handler latency percentiles, errors, throttles and the
+peak resident memory of the busiest environment. With --speedup a minute of
+load is replayed in 60 / speedup seconds.
+
+When aws_embedded_metrics is installed the handler runs with its metrics
+scope, writing EMF to a discarded stdout. Otherwise the handler body is
+called with a recording metrics object.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "outlier-detection", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cloudwatch_stand_in import CloudWatchStandIn, RecordedSource, SyntheticSource
+
+ALARM_TYPES = {
+    "availability": ("Fault", "Sum", "Count"),
+    "latency": ("SuccessLatency", "TC(100:)", "Milliseconds"),
+}
+
+_invoke = None
+_client = None
+
+
+class Metrics:
+    """Stands in for the metrics scope when aws_embedded_metrics isn't installed."""
+
+    def set_property(self, name, value):
+        pass
+
+    def put_metric(self, name, value, unit = None):
+        pass
+
+    def set_dimensions(self, *dimensions):
+        pass
+
+    def set_namespace(self, namespace):
+        pass
+
+
+def _initialize(options: dict):
+    """Sets up one simulated execution environment."""
+    global _invoke, _client
+
+    os.environ.setdefault("AWS_LAMBDA_FUNCTION_NAME", "outlier-detection-load")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    sys.stdout = open(os.devnull, "w")
+
+    import index
+
+    if options["recording"]:
+        source = RecordedSource.load(options["recording"])
+    else:
+        source = SyntheticSource(impaired = {options["impaired_az"]: options["impairment"]} if options["impaired_az"] else None)
+
+    index.cw_client = _client = CloudWatchStandIn(
+        source,
+        latency_ms = options["latency_ms"],
+        per_datapoint_us = options["per_datapoint_us"],
+        jitter = options["jitter"],
+        # The account's limit is shared by every environment
+        rate_limit = options["rate_limit"] / options["processes"] if options["rate_limit"] else None,
+    )
+
+    try:
+        import aws_embedded_metrics
+        _invoke = lambda event: index.handler(event, None)
+    except ImportError:
+        _invoke = lambda event: index._handle(event, None, Metrics())
+
+
+def _run(event: dict) -> tuple:
+    begin = time.perf_counter()
+    result = _invoke(event)
+    latency = (time.perf_counter() - begin) * 1000
+    error = isinstance(result, dict) and "Error" in result
+    return event["EventType"], latency, error, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, os.getpid(), _client.throttled
+
+
+def minute_events(minute_end: int, options: dict) -> list:
+    azs = ["use1-az" + str(i + 1) for i in range(options["azs"])]
+    events = []
+    invocation = 0
+
+    for operation in range(options["operations"]):
+        name = "Operation" + str(operation)
+        dimensions = json.dumps({az: [{"Operation": name, "AvailabilityZoneId": az, "Region": "us-east-1"}] for az in azs})
+
+        for alarm_type, (metric_names, statistic, unit) in ALARM_TYPES.items():
+            for az in azs:
+                invocation += 1
+                events.append({
+                    "EventType": "GetMetricData",
+                    "GetMetricDataRequest": {
+                        "StartTime": minute_end - options["window_periods"] * 60,
+                        "EndTime": minute_end,
+                        "Period": 60,
+                        "Arguments": [options["algorithm"], str(options["threshold"]), az, dimensions, "Service", metric_names, statistic, unit]
+                    }
+                })
+
+                if options["describe_rate"] and invocation % int(1 / options["describe_rate"]) == 0:
+                    events.append({"EventType": "DescribeGetMetricData"})
+
+    return events
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(len(values) * p / 100)) - 1)] if values else 0.0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type = int, default = 10)
+    parser.add_argument("--azs", type = int, default = 3)
+    parser.add_argument("--minutes", type = int, default = 3)
+    parser.add_argument("--speedup", type = float, default = 1.0, help = "replay each minute in 60 / speedup seconds")
+    parser.add_argument("--processes", type = int, default = 4, help = "concurrent execution environments")
+    parser.add_argument("--window-periods", type = int, default = 5, help = "periods each alarm evaluates")
+    parser.add_argument("--algorithm", default = "Z_SCORE")
+    parser.add_argument("--threshold", type = float, default = 1.0)
+    parser.add_argument("--describe-rate", type = float, default = 0.01, help = "DescribeGetMetricData events per GetMetricData event")
+    parser.add_argument("--latency-ms", type = float, default = 100.0, help = "stand-in latency per request")
+    parser.add_argument("--per-datapoint-us", type = float, default = 1.0, help = "stand-in latency per returned datapoint")
+    parser.add_argument("--jitter", type = float, default = 0.3, help = "sigma of the stand-in's log-normal latency jitter")
+    parser.add_argument("--rate-limit", type = float, default = 50.0, help = "account GetMetricData requests per second, 0 for none")
+    parser.add_argument("--recording", help = "replay series recorded with RecordingCloudWatch instead of synthetic ones")
+    parser.add_argument("--impaired-az", help = "multiply this AZ's synthetic series by --impairment")
+    parser.add_argument("--impairment", type = float, default = 3.0)
+    args = parser.parse_args()
+    options = vars(args)
+
+    minute = 60 / args.speedup
+    results = []
+    late_minutes = 0
+    now = (int(time.time()) // 60) * 60 - args.minutes * 60
+    begin = time.perf_counter()
+
+    with multiprocessing.Pool(args.processes, initializer = _initialize, initargs = (options,)) as pool:
+        for m in range(args.minutes):
+            scheduled = begin + m * minute
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+            events = minute_events(now + (m + 1) * 60, options)
+            results.extend(pool.imap_unordered(_run, events, chunksize = 1))
+
+            if time.perf_counter() - scheduled > minute:
+                late_minutes += 1
+
+    elapsed = time.perf_counter() - begin
+    latencies = [r[1] for r in results if r[0] == "GetMetricData"]
+    throttled = {}
+
+    for r in results:
+        throttled[r[4]] = max(throttled.get(r[4], 0), r[5])
+
+    print(json.dumps({
+        "Invocations": len(results),
+        "Errors": sum(1 for r in results if r[2]),
+        "Throttled": sum(throttled.values()),
+        "ThroughputPerSecond": len(results) / elapsed,
+        "LatencyMs": {
+            "p50": statistics.median(latencies) if latencies else 0.0,
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default = 0.0),
+        },
+        "MinutesOverrun": late_minutes,
+        "PeakRssKb": max((r[3] for r in results), default = 0),
+    }, indent = 2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,545 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+import unittest
+import functools
+import hashlib
+import importlib.util
+import os
+import socket
+import sys
+import threading
+import time
+import types
+from unittest.mock import MagicMock, patch
+
+# Stand in for the canary's dependencies before importing it. The HTTP layer
+# is replaced by sessions that answer from a handler each test sets, and EMF
+# loggers record what they would have written.
+
+emitted = []
+
+class FakeMetricsLogger:
+    """Records what a probe writes, and appends itself to emitted when flushed."""
+
+    def __init__(self):
+        self.context = types.SimpleNamespace(properties = {})
+        self.namespace = None
+        self.dimensions = None
+        self.values = {}
+        self.units = {}
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+
+    def set_dimensions(self, *dimensions):
+        self.dimensions = dimensions[0] if dimensions else None
+
+    def set_property(self, key, value):
+        self.context.properties[key] = value
+
+    def put_metric(self, key, value, unit = "None"):
+        self.values.setdefault(key, []).append(value)
+        self.units[key] = unit
+
+    def flush_sync(self):
+        emitted.append(self)
+
+    async def flush(self):
+        raise AssertionError("Loggers are flushed with flush_sync")
+
+
+def metric_scope(fn):
+    """Passes a new logger as metrics and flushes it, as the real metric_scope does."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        logger = FakeMetricsLogger()
+
+        try:
+            return fn(*args, metrics = logger, **kwargs)
+        finally:
+            logger.flush_sync()
+
+    return wrapper
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+class FakeConnection:
+    """
+    Stands in for urllib3's connections, recording the host each connect
+    used. Connecting takes connect_seconds, and is refused for the
+    addresses in refused.
+    """
+
+    connect_seconds = 0.0
+    refused = ()
+
+    def __init__(self, host, port = 443):
+        self.host = host
+        self._dns_host = host
+        self.port = port
+        self.sock = None
+        self.connected_to = []
+
+    def _new_conn(self):
+        self.connected_to.append(self._dns_host)
+        time.sleep(self.connect_seconds)
+
+        if self._dns_host in self.refused:
+            raise ConnectionRefusedError("Connection to " + self._dns_host + " refused")
+
+        return MagicMock()
+
+    def connect(self):
+        self.sock = self._new_conn()
+
+
+class FakeHTTPConnection(FakeConnection):
+    pass
+
+
+class FakeHTTPSConnection(FakeConnection):
+    pass
+
+
+class FakeHTTPAdapter:
+    def __init__(self, max_retries = None, pool_connections = 10, pool_maxsize = 10):
+        self.pool_maxsize = pool_maxsize
+        self.init_poolmanager()
+
+    def init_poolmanager(self, *args, **kwargs):
+        self.poolmanager = types.SimpleNamespace()
+
+
+class FakeSession:
+    """Answers every request from the handler the test sets on the class."""
+
+    handler = None
+
+    def __init__(self):
+        self.cookies = MagicMock()
+        self.adapters = {}
+
+    def mount(self, prefix, adapter):
+        self.adapters[prefix] = adapter
+
+    def request(self, **kwargs):
+        return FakeSession.handler(**kwargs)
+
+
+class FakeResponse:
+    def __init__(self, status_code = 200, body = b"", connection = None, chunk_bytes = None):
+        self.status_code = status_code
+        self.reason = "OK" if status_code < 400 else "Error"
+        self.headers = {"Content-Type": "application/json"}
+        self.body = body
+        self.chunk_bytes = chunk_bytes
+        self.raw = types.SimpleNamespace(_connection = connection)
+
+    def iter_content(self, chunk_size = 1):
+        size = self.chunk_bytes or chunk_size
+
+        for offset in range(0, len(self.body), size):
+            yield self.body[offset:offset + size]
+
+
+_module("aws_embedded_metrics", metric_scope = metric_scope)
+_module("aws_embedded_metrics.logger")
+_module("aws_embedded_metrics.logger.metrics_logger_factory", create_metrics_logger = FakeMetricsLogger)
+_module("aws_xray_sdk")
+_module("aws_xray_sdk.core", xray_recorder = types.SimpleNamespace(capture = lambda name: (lambda fn: fn), put_annotation = lambda key, value: None), patch_all = lambda: None)
+_module("dateutil")
+_module("dateutil.parser")
+_module("requests", Session = FakeSession)
+_module("requests.adapters", HTTPAdapter = FakeHTTPAdapter)
+_module("requests.packages")
+_module("requests.packages.urllib3")
+_module("requests.packages.urllib3.util")
+_module("requests.packages.urllib3.util.retry", Retry = object)
+_module("requests.packages.urllib3.util.connection", allowed_gai_family = lambda: socket.AF_INET)
+_module("requests.packages.urllib3.connection", HTTPConnection = FakeHTTPConnection, HTTPSConnection = FakeHTTPSConnection)
+_module("requests.packages.urllib3.connectionpool", HTTPConnectionPool = object, HTTPSConnectionPool = object)
+
+# The outlier detection function is also named index, so the canary is loaded under its own name
+spec = importlib.util.spec_from_file_location("canary_index", os.path.join(os.path.dirname(__file__), "..", "src", "canaries", "src", "index.py"))
+canary = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(canary)
+
+
+class FakeContext:
+    function_name = "canary"
+    aws_request_id = "request-id"
+
+    def __init__(self, remaining_ms = 60000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+ITEM = {
+    "url": "https://example.com/ride",
+    "operation": "Ride",
+    "faultBoundaryId": "use1-az1",
+    "faultBoundary": "az",
+    "metricNamespace": "Canary"
+}
+
+
+class TestRequestScheduling(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _fake_request(self, duration):
+        def verify_request(context, item, method, id, scheduled_time = None, pool_size = 10):
+            with self._lock:
+                self.started.append((method, time.perf_counter(), scheduled_time, pool_size))
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+            time.sleep(duration)
+
+            with self._lock:
+                self.in_flight -= 1
+
+        return verify_request
+
+    def test_requests_start_at_the_rate(self):
+        with patch.object(canary, "verify_request", self._fake_request(0.01)):
+            skipped = canary.run_open_loop(FakeContext(), ITEM, ["GET"] * 5, "id", 50.0, 5, [], [])
+
+        self.assertEqual(skipped, 0)
+        scheduled = [entry[2] for entry in self.started]
+        self.assertEqual(len(scheduled), 5)
+
+        for earlier, later in zip(scheduled, scheduled[1:]):
+            self.assertAlmostEqual(later - earlier, 0.02, places = 6)
+
+        for method, started, scheduled_time, pool_size in self.started:
+            self.assertGreaterEqual(started, scheduled_time)
+            self.assertEqual(pool_size, 5)
+
+    def test_concurrency_is_capped(self):
+        with patch.object(canary, "verify_request", self._fake_request(0.1)):
+            canary.run_open_loop(FakeContext(), ITEM, ["GET"] * 6, "id", 1000.0, 2, [], [])
+
+        self.assertEqual(len(self.started), 6)
+        self.assertEqual(self.max_in_flight, 2)
+
+    def test_requests_are_skipped_near_the_deadline(self):
+        context = FakeContext(canary.timeout * 1000 + canary.DEADLINE_MARGIN_MS - 1)
+
+        with patch.object(canary, "verify_request", self._fake_request(0)):
+            skipped = canary.run_open_loop(context, ITEM, ["GET"] * 3, "id", 100.0, 2, [], [])
+
+        self.assertEqual(skipped, 3)
+        self.assertEqual(self.started, [])
+
+    def test_errors_are_collected(self):
+        errors = []
+        tracebacks = []
+
+        with patch.object(canary, "verify_request", MagicMock(side_effect = ValueError("boom"))):
+            canary.run_open_loop(FakeContext(), ITEM, ["GET", "POST"], "id", 100.0, 2, errors, tracebacks)
+
+        self.assertEqual(errors, ["boom", "boom"])
+        self.assertEqual(len(tracebacks), 2)
+
+    def test_sequential_requests_do_not_overlap(self):
+        with patch.object(canary, "verify_request", self._fake_request(0.01)), patch.object(canary, "SEQUENTIAL_PAUSE_SECONDS", 0.02):
+            skipped = canary.run_sequential(FakeContext(), ITEM, ["GET", "POST", "GET"], "id", [], [])
+
+        self.assertEqual(skipped, 0)
+        self.assertEqual([entry[0] for entry in self.started], ["GET", "POST", "GET"])
+        self.assertEqual(self.max_in_flight, 1)
+
+        for earlier, later in zip(self.started, self.started[1:]):
+            self.assertGreaterEqual(later[1] - earlier[1], 0.03)
+
+    def _handle(self, parameters):
+        event = {"parameters": dict(ITEM, methods = ["GET"], requestCount = 2, **parameters)}
+
+        with patch.object(canary, "run_sequential", MagicMock(return_value = 0)) as sequential, \
+            patch.object(canary, "run_open_loop", MagicMock(return_value = 0)) as open_loop:
+            canary.handler(event, FakeContext())
+
+        return sequential, open_loop
+
+    def test_requests_are_sequential_by_default(self):
+        sequential, open_loop = self._handle({})
+        sequential.assert_called_once()
+        open_loop.assert_not_called()
+        self.assertEqual(sequential.call_args.args[2], ["GET", "GET"])
+
+    def test_rate_is_opt_in(self):
+        sequential, open_loop = self._handle({"requestsPerSecond": 5, "maxConcurrentRequests": 3})
+        sequential.assert_not_called()
+        self.assertEqual(open_loop.call_args.args[4:6], (5.0, 3))
+
+
+
+class TestSessionReuse(unittest.TestCase):
+    def setUp(self):
+        canary.sessions.clear()
+        emitted.clear()
+
+    def tearDown(self):
+        canary.sessions.clear()
+        FakeSession.handler = None
+
+    def test_one_session_per_scheme_and_host(self):
+        parsed = canary.urllib.parse.urlparse
+        session = canary.get_session(parsed("https://example.com/ride"), 4)
+        self.assertIs(canary.get_session(parsed("https://example.com/other"), 4), session)
+        self.assertIsNot(canary.get_session(parsed("http://example.com/ride"), 4), session)
+        self.assertIsNot(canary.get_session(parsed("https://example.org/ride"), 4), session)
+
+        adapter = session.adapters["https://"]
+        self.assertIsInstance(adapter, canary.TimedHTTPAdapter)
+        self.assertEqual(adapter.pool_maxsize, 4)
+        self.assertEqual(adapter.poolmanager.pool_classes_by_scheme["https"], canary.TimedHTTPSConnectionPool)
+
+    def test_reuse_is_detected_per_socket(self):
+        first = types.SimpleNamespace(sock = MagicMock())
+        second = types.SimpleNamespace(sock = MagicMock())
+
+        self.assertIsNone(canary.is_reused(types.SimpleNamespace(sock = None)))
+        self.assertFalse(canary.is_reused(first))
+        self.assertTrue(canary.is_reused(first))
+        self.assertFalse(canary.is_reused(second))
+
+    def test_only_the_first_request_on_a_connection_is_new(self):
+        connection = types.SimpleNamespace(sock = MagicMock(), phases = {"DnsLookupTime": 1.0, "ConnectTime": 2.0, "TlsHandshakeTime": 3.0})
+        connection.sock.getsockname.return_value = ("10.0.0.1", 443)
+        FakeSession.handler = lambda **kwargs: FakeResponse(200, b"{}", connection)
+
+        canary.verify_request(FakeContext(), ITEM, "GET", "id")
+        canary.verify_request(FakeContext(), ITEM, "GET", "id")
+
+        first, second = emitted
+        self.assertEqual(first.values["NewConnection"], [1])
+        self.assertEqual(first.values["TlsHandshakeTime"], [3.0])
+        self.assertIn("TimeToResponseReceivedNewConnection", first.values)
+        self.assertFalse(first.context.properties["ConnectionReused"])
+
+        self.assertEqual(second.values["NewConnection"], [0])
+        self.assertNotIn("TlsHandshakeTime", second.values)
+        self.assertIn("TimeToResponseReceivedReusedConnection", second.values)
+        self.assertTrue(second.context.properties["ConnectionReused"])
+
+
+class TestConnectionPhases(unittest.TestCase):
+    def _resolve(self, addresses, seconds = 0.0):
+        self.families = []
+
+        def getaddrinfo(host, port, family = 0, type = 0):
+            self.families.append(family)
+            time.sleep(seconds)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port)) for address in addresses]
+
+        return patch.object(socket, "getaddrinfo", getaddrinfo)
+
+    def test_each_phase_is_timed(self):
+        connection = canary.TimedHTTPSConnection("example.com")
+        connection.connect_seconds = 0.02
+
+        with self._resolve(["10.0.0.1"], 0.03):
+            connection.connect()
+
+        self.assertEqual(connection.connected_to, ["10.0.0.1"])
+        self.assertEqual(connection._dns_host, "example.com")
+        self.assertEqual(self.families, [socket.AF_INET])
+        self.assertGreaterEqual(connection.phases["DnsLookupTime"], 30)
+        self.assertGreaterEqual(connection.phases["ConnectTime"], 20)
+        self.assertGreaterEqual(connection.phases["TlsHandshakeTime"], 0)
+        self.assertNotIn("FailedConnectTime", connection.phases)
+
+    def test_plain_http_has_no_handshake(self):
+        connection = canary.TimedHTTPConnection("example.com", 80)
+
+        with self._resolve(["10.0.0.1"]):
+            connection.connect()
+
+        self.assertEqual(set(connection.phases), {"DnsLookupTime", "ConnectTime"})
+
+    def test_falls_back_to_the_next_address(self):
+        connection = canary.TimedHTTPSConnection("example.com")
+        connection.connect_seconds = 0.02
+        connection.refused = ("10.0.0.1",)
+
+        with self._resolve(["10.0.0.1", "10.0.0.2"]):
+            connection.connect()
+
+        self.assertEqual(connection.connected_to, ["10.0.0.1", "10.0.0.2"])
+        # The failed attempt isn't part of the connect time
+        self.assertGreaterEqual(connection.phases["FailedConnectTime"], 20)
+        self.assertLess(connection.phases["ConnectTime"], 40)
+
+    def test_last_error_is_raised_when_every_address_fails(self):
+        connection = canary.TimedHTTPSConnection("example.com")
+        connection.refused = ("10.0.0.1", "10.0.0.2")
+
+        with self._resolve(["10.0.0.1", "10.0.0.2"]):
+            with self.assertRaisesRegex(ConnectionRefusedError, "10.0.0.2"):
+                connection.connect()
+
+        self.assertEqual(connection._dns_host, "example.com")
+        self.assertIsNone(connection.phases)
+
+
+
+class TestResponseBody(unittest.TestCase):
+    BODY = b'{"ride": "' + b"x" * 90 + b'"}'
+
+    def setUp(self):
+        canary.sessions.clear()
+        emitted.clear()
+
+    def tearDown(self):
+        canary.sessions.clear()
+        FakeSession.handler = None
+
+    def test_read_is_capped_but_sized_and_hashed_in_full(self):
+        body, size, sha256 = canary.read_body(FakeResponse(200, self.BODY, chunk_bytes = 7), 10, True)
+        self.assertEqual(body, self.BODY[:10])
+        self.assertEqual(size, len(self.BODY))
+        self.assertEqual(sha256, hashlib.sha256(self.BODY).hexdigest())
+
+    def test_digest_is_only_computed_when_asked(self):
+        self.assertEqual(canary.read_body(FakeResponse(200, self.BODY), 0, False), (b"", len(self.BODY), None))
+
+    def _probe(self, status_code, **parameters):
+        connection = types.SimpleNamespace(sock = None)
+        FakeSession.handler = lambda **kwargs: FakeResponse(status_code, self.BODY, connection, chunk_bytes = 16)
+        canary.verify_request(FakeContext(), dict(ITEM, **parameters), "GET", "id")
+        return emitted[-1]
+
+    def test_failed_probe_logs_the_truncated_body(self):
+        logger = self._probe(500, maxResponseBodyBytes = 20)
+        self.assertEqual(logger.values["Fault"], [1])
+        self.assertEqual(logger.values["ResponseBodySize"], [len(self.BODY)])
+        self.assertTrue(logger.context.properties["ResponseTruncated"])
+        self.assertEqual(logger.context.properties["Response"], self.BODY[:20].decode())
+        self.assertIn("ResponseDecodeError", logger.context.properties)
+
+    def test_successful_probe_does_not_log_the_body(self):
+        logger = self._probe(200)
+        self.assertEqual(logger.values["Success"], [1])
+        self.assertNotIn("Response", logger.context.properties)
+        self.assertNotIn("ResponseBodyCheckFailure", logger.values)
+
+    def test_size_mismatch_is_a_failure(self):
+        logger = self._probe(200, expectedResponseBodySize = len(self.BODY) + 1)
+        self.assertEqual(logger.values["ResponseBodyCheckFailure"], [1])
+        self.assertEqual(logger.context.properties["ResponseBodySizeMismatch"], len(self.BODY))
+        self.assertIn("Response", logger.context.properties)
+
+    def test_digest_mismatch_is_a_failure(self):
+        logger = self._probe(200, expectedResponseBodySha256 = hashlib.sha256(b"other").hexdigest())
+        self.assertEqual(logger.values["ResponseBodyCheckFailure"], [1])
+        self.assertEqual(logger.context.properties["ResponseBodySha256Mismatch"], hashlib.sha256(self.BODY).hexdigest())
+        self.assertIn("Headers", logger.context.properties)
+
+    def test_matching_body_passes(self):
+        logger = self._probe(200, expectedResponseBodySize = len(self.BODY), expectedResponseBodySha256 = hashlib.sha256(self.BODY).hexdigest().upper())
+        self.assertEqual(logger.values["ResponseBodyCheckFailure"], [0])
+        self.assertNotIn("Response", logger.context.properties)
+
+
+class TestMetricsAggregation(unittest.TestCase):
+    def setUp(self):
+        canary.sessions.clear()
+        emitted.clear()
+        self.codes = {}
+
+    def tearDown(self):
+        canary.sessions.clear()
+        FakeSession.handler = None
+
+    def _respond(self, **kwargs):
+        return FakeResponse(self.codes.get(kwargs["url"], 200), b"{}", types.SimpleNamespace(sock = None))
+
+    def _probe(self, aggregator, az, url = ITEM["url"]):
+        canary.verify_request_aggregated(aggregator, FakeContext(), dict(ITEM, faultBoundaryId = az, url = url), "GET", "id")
+
+    def test_one_document_per_dimension_set(self):
+        FakeSession.handler = self._respond
+        self.codes["https://example.com/broken"] = 500
+        aggregator = canary.MetricsAggregator("id")
+
+        for x in range(3):
+            self._probe(aggregator, "use1-az1")
+        for x in range(2):
+            self._probe(aggregator, "use1-az2")
+
+        self._probe(aggregator, "use1-az1", "https://example.com/broken")
+        failed = list(emitted)
+        aggregator.flush()
+        documents = {logger.dimensions["AZ-ID"]: logger for logger in emitted[len(failed):]}
+
+        # The failed probe is emitted on its own, with its properties, before the flush
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0].values["Fault"], [1])
+        self.assertEqual(failed[0].context.properties["HttpStatusCode"], 500)
+
+        self.assertEqual(set(documents), {"use1-az1", "use1-az2"})
+        self.assertEqual(aggregator.probes, 5)
+
+        for az, count in [("use1-az1", 3), ("use1-az2", 2)]:
+            document = documents[az]
+            self.assertEqual(document.namespace, "Canary")
+            self.assertEqual(document.values["Success"], [1] * count)
+            self.assertEqual(document.values["Failure"], [0] * count)
+            self.assertEqual(len(document.values["SuccessLatency"]), count)
+            self.assertEqual(document.context.properties, {"LambdaRequestId": "id"})
+
+    def test_recorder_failed_totals(self):
+        recorder = canary.ProbeRecorder()
+        recorder.put_metric("Success", 1, "Count")
+        self.assertFalse(recorder.failed())
+
+        recorder.put_metric("ResponseBodyCheckFailure", 1, "Count")
+        self.assertTrue(recorder.failed())
+
+        recorder = canary.ProbeRecorder()
+        recorder.put_metric("Success", 0, "Count")
+        self.assertTrue(recorder.failed())
+
+    def test_large_sets_flush_at_the_threshold(self):
+        FakeSession.handler = self._respond
+        aggregator = canary.MetricsAggregator("id")
+        self._probe(aggregator, "use1-az1")
+        values_per_probe = aggregator.counts[(ITEM["metricNamespace"], (("AZ-ID", "use1-az1"), ("Operation", "Ride"), ("Region", canary.region)))]
+
+        # Every second probe fills the set
+        with patch.object(canary, "AGGREGATION_FLUSH_VALUES", values_per_probe * 2):
+            for x in range(4):
+                self._probe(aggregator, "use1-az1")
+
+            aggregator.flush()
+
+        self.assertEqual([len(logger.values["Success"]) for logger in emitted], [2, 2, 1])
+
+    def test_handler_counts_aggregated_probes(self):
+        FakeSession.handler = self._respond
+        event = {"parameters": dict(ITEM, methods = ["GET"], requestCount = 3, aggregateMetrics = True)}
+
+        with patch.object(canary, "SEQUENTIAL_PAUSE_SECONDS", 0):
+            canary.handler(event, FakeContext())
+
+        documents, handler_logger = emitted[:-1], emitted[-1]
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0].values["Success"], [1, 1, 1])
+        self.assertEqual(handler_logger.values["AggregatedProbes"], [3])
+        self.assertEqual(handler_logger.values["SkippedRequests"], [0])
+
+if __name__ == "__main__":
+    unittest.main()
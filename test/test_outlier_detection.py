@@ -3,6 +3,7 @@
 import unittest
 import math
 import sys
+import time
 import os
 from unittest.mock import MagicMock
 
@@ -11,6 +12,10 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'outlier
 
 # Mock aws_embedded_metrics and boto3 before importing index
 import types
+import json
+import importlib.util
+import random
+from datetime import datetime, timezone
 mock_emm = types.ModuleType('aws_embedded_metrics')
 def metric_scope(fn):
     """Mock metric_scope that just passes through the function."""
@@ -18,12 +23,17 @@ def metric_scope(fn):
 mock_emm.metric_scope = metric_scope
 sys.modules['aws_embedded_metrics'] = mock_emm
 sys.modules['boto3'] = MagicMock()
+sys.modules['botocore'] = MagicMock()
+sys.modules['botocore.config'] = MagicMock()
 
+import index
 from index import (
     _mean, _std, _median, _percentile,
     _chi_squared_p_value, _regularized_gamma_inc,
     _gamma_inc_series, _gamma_inc_cf,
-    chi_squared, z_score, iqr, mad,
+    chi_squared, z_score, iqr, mad, ewma, ensemble,
+    TTLCache, compile_query_plan, get_metric_data, plan_period,
+    AZMatrix, AZMatrixBuilder, Diagnostics, time_slices,
 )
 
 
@@ -217,6 +227,53 @@ class TestChiSquaredAlgorithm(unittest.TestCase):
         # Sorted descending: 2000 first (uniform=0), then 1000 (outlier=1)
         self.assertEqual(results, [0, 1])
 
+    def test_python_path_p_value_matches_the_scalar_one(self):
+        values = [7.1, 2.1, 8.3, 5.7, 2.8, 0.6]
+        azs = ["az" + str(i) for i in range(len(values))]
+        metrics = _make_metrics()
+        original = index.USE_NUMPY
+        index.USE_NUMPY = False
+        try:
+            index._chi_squared_verdicts(AZMatrix([1000], azs, [[v] for v in values]), 0.05, Diagnostics(metrics, "SUMMARY"))
+        finally:
+            index.USE_NUMPY = original
+
+        metrics.set_property.assert_any_call("PValue", index._chi_squared_p_value(values))
+
+
+class TestChiSquaredDecisionBounds(unittest.TestCase):
+    """The fast decision path must match comparing every exact p-value with the threshold."""
+
+    THRESHOLDS = [0.0, 1e-13, 1e-10, 0.001, 0.05, 0.5, 0.99, 1.0, 1.5]
+
+    def _verdicts(self, matrix, threshold, level):
+        diagnostics = Diagnostics(_make_metrics(), level = level, sample_rate = 1.0)
+        return index._chi_squared_verdicts(matrix, threshold, diagnostics)
+
+    def test_bounds_bracket_the_critical_value(self):
+        for df in range(1, 6):
+            low, high = index._chi_squared_decision_bounds(df, 0.05)
+            self.assertGreater(index._chi_squared_sf(low, df), 0.05)
+            self.assertLessEqual(index._chi_squared_sf(high, df), 0.05)
+            self.assertLess(high - low, 1e-6)
+
+    def test_matches_exact_decisions(self):
+        rng = random.Random(11)
+
+        for n in range(2, 7):
+            azs = ["az" + str(i) for i in range(n)]
+            columns = [tuple(rng.randint(0, 50) for az in azs) for _ in range(300)]
+            columns += [(k,) + (0,) * (n - 1) for k in range(0, 40)]
+            columns += [(k,) + (1,) * (n - 1) for k in range(0, 40)]
+            matrix = AZMatrix.from_columns(list(range(len(columns), 0, -1)), azs, columns)
+
+            for threshold in self.THRESHOLDS:
+                self.assertEqual(
+                    self._verdicts(matrix, threshold, "OFF"),
+                    self._verdicts(matrix, threshold, "FULL"),
+                    (n, threshold)
+                )
+
 
 class TestZScoreAlgorithm(unittest.TestCase):
     def test_identical_values_returns_zero(self):
@@ -295,5 +352,1189 @@ class TestMADAlgorithm(unittest.TestCase):
         self.assertEqual(results, [0, 1])
 
 
+class TestEWMAAlgorithm(unittest.TestCase):
+    AZS = ["az1", "az2", "az3", "az4", "az5", "az6"]
+
+    def _counts(self, newest_az1_values):
+        # 40 periods of noisy low traffic, alternating between 2 and 6
+        az_counts = {t: {az: 2 if t % 2 else 6 for az in self.AZS} for t in range(40)}
+        for offset, value in enumerate(newest_az1_values):
+            az_counts[39 - offset]["az1"] = value
+        return az_counts
+
+    def test_uniform_values(self):
+        az_counts = {t: {az: 10 for az in self.AZS} for t in range(10)}
+        self.assertEqual(ewma(az_counts, "az1", 1, _make_metrics()), [0] * 10)
+
+    def test_single_period_spike_is_smoothed_out(self):
+        az_counts = self._counts([10])
+        self.assertEqual(z_score(az_counts, "az1", 2, _make_metrics())[0], 1)
+        self.assertEqual(ewma(az_counts, "az1", 2, _make_metrics())[0], 0)
+
+    def test_sustained_shift_is_detected(self):
+        az_counts = self._counts([30, 30, 30])
+        self.assertEqual(ewma(az_counts, "az1", 2, _make_metrics())[0], 1)
+        self.assertEqual(ewma(az_counts, "az2", 2, _make_metrics())[0], 0)
+
+    def test_drift_in_one_of_three_azs_is_detected(self):
+        # Including az1 in its own peers would cap its z-score at the square root of 2
+        az_counts = {t: {"az1": 10 + t % 3, "az2": 9 + t % 4, "az3": 11 - t % 2} for t in range(40)}
+        for offset in range(8):
+            az_counts[32 + offset]["az1"] = 14 + 3 * offset
+
+        self.assertEqual(ewma(az_counts, "az1", 2, _make_metrics())[:7], [1] * 7)
+
+        # Once the baselines are warmed up the steady periods before the drift aren't flagged
+        for az in ["az1", "az2", "az3"]:
+            self.assertEqual(ewma(az_counts, az, 2, _make_metrics())[8:30], [0] * 22)
+
+    def test_empty(self):
+        self.assertEqual(ewma({}, "az1", 2, _make_metrics()), [])
+
+
+class TestEnsembleAlgorithm(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(11)
+        azs = ["az1", "az2", "az3", "az4"]
+        self.matrix = AZMatrix(list(range(6000, 0, -60)), azs, [[float(rng.randint(0, 40)) for _ in range(100)] for _ in azs])
+
+    def _individual(self, az):
+        return [
+            chi_squared(self.matrix, az, index.ENSEMBLE_CHI_SQUARED_THRESHOLD, _make_metrics()),
+            z_score(self.matrix, az, index.ENSEMBLE_Z_SCORE_THRESHOLD, _make_metrics()),
+            iqr(self.matrix, az, 0, _make_metrics()),
+            mad(self.matrix, az, index.ENSEMBLE_MAD_THRESHOLD, _make_metrics()),
+        ]
+
+    def test_votes_combine_the_four_algorithms(self):
+        for az in self.matrix.azs:
+            votes = [sum(column) for column in zip(*self._individual(az))]
+            for required in [1, 2, 3, 4]:
+                self.assertEqual(ensemble(self.matrix, az, required, _make_metrics()), [int(v >= required) for v in votes])
+
+    def test_required_votes_are_clamped(self):
+        self.assertEqual(ensemble(self.matrix, "az1", 0, _make_metrics()), ensemble(self.matrix, "az1", 1, _make_metrics()))
+        self.assertEqual(ensemble(self.matrix, "az1", 9, _make_metrics()), ensemble(self.matrix, "az1", 4, _make_metrics()))
+
+    def test_clear_outlier_gets_every_vote(self):
+        az_counts = {t: {"az1": 100, "az2": 10, "az3": 11, "az4": 9} for t in range(5)}
+        self.assertEqual(ensemble(az_counts, "az1", 4, _make_metrics()), [1] * 5)
+        self.assertEqual(ensemble(az_counts, "az2", 1, _make_metrics()), [0] * 5)
+
+    def test_empty(self):
+        self.assertEqual(ensemble({}, "az1", 2, _make_metrics()), [])
+
+
+class TestAZMatrix(unittest.TestCase):
+    def test_from_counts_is_newest_first(self):
+        matrix = AZMatrix.from_counts({
+            1000: {"az1": 1, "az2": 2},
+            2000: {"az1": 3, "az2": 4},
+        })
+        self.assertEqual(matrix.timestamps, [2000, 1000])
+        self.assertEqual(matrix.azs, ["az1", "az2"])
+        self.assertEqual(matrix.rows, [[3, 1], [4, 2]])
+
+    def test_missing_values_are_zero(self):
+        matrix = AZMatrix.from_counts({
+            2000: {"az1": 10, "az2": 11},
+            1000: {"az1": 100, "az2": 10, "az3": 11},
+        })
+        self.assertEqual(matrix.rows[2], [0, 11])
+
+    def test_round_trip(self):
+        counts = {2000: {"az1": 1, "az2": 2}, 1000: {"az1": 3, "az2": 4}}
+        self.assertEqual(AZMatrix.from_counts(counts).to_counts(), counts)
+
+    def test_builder_aligns_series(self):
+        builder = AZMatrixBuilder(["az1", "az2"])
+        builder.add("az1", [datetime.fromtimestamp(60, tz = timezone.utc), datetime.fromtimestamp(120, tz = timezone.utc)], [1, 2])
+        builder.add("az2", [datetime.fromtimestamp(120, tz = timezone.utc)], [5])
+        matrix = builder.build()
+        self.assertEqual(matrix.timestamps, [120, 60])
+        self.assertEqual(matrix.rows, [[2, 1], [5, 0]])
+
+    def test_algorithms_accept_empty_input(self):
+        for algorithm in [chi_squared, z_score, iqr, mad]:
+            self.assertEqual(algorithm({}, "az1", 0.05, _make_metrics()), [])
+
+
+def _scalar_z_score(values, i, threshold):
+    """The Z_SCORE decision for one timestamp, as the scorer made it before the column kernels."""
+    std = index._std(values)
+    return 0 if std == 0 else int((values[i] - index._mean(values)) / std >= threshold)
+
+
+def _scalar_chi_squared(values, i, threshold):
+    """The CHI_SQUARED decision for one timestamp, as the scorer made it before the column kernels."""
+    if all(v == 0 for v in values):
+        return 0
+
+    expected = sum(values) / len(values)
+    farthest = 0
+
+    for j in range(1, len(values)):
+        if abs(values[j] - expected) > abs(values[farthest] - expected):
+            farthest = j
+
+    p_value = index._chi_squared_p_value(values)
+    return int(not math.isnan(p_value) and p_value <= threshold and farthest == i)
+
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "NumPy is not installed")
+class TestNumpyAndPythonPathsMatch(unittest.TestCase):
+    def _run(self, algorithm, matrix, az, threshold, use_numpy):
+        original = index.USE_NUMPY
+        index.USE_NUMPY = use_numpy
+        try:
+            metrics = _make_metrics()
+            diagnostics = Diagnostics(metrics, "FULL", 1.0, 10 ** 9)
+            results = algorithm(AZMatrix(matrix.timestamps, matrix.azs, matrix.rows), az, threshold, metrics, diagnostics)
+            output = diagnostics.flush()
+            properties = [c.args for c in metrics.set_property.call_args_list]
+            return results, properties, output
+        finally:
+            index.USE_NUMPY = original
+
+    ALGORITHMS = [(chi_squared, 0.05), (z_score, 1.5), (z_score, 2), (iqr, 1.5), (mad, 3.0), (ensemble, 2)]
+
+    def _assert_paths_match(self, matrix, algorithms = None):
+        for algorithm, threshold in algorithms or self.ALGORITHMS:
+            for az in matrix.azs:
+                numpy_run = self._run(algorithm, matrix, az, threshold, True)
+                python_run = self._run(algorithm, matrix, az, threshold, False)
+                self.assertEqual(numpy_run[0], python_run[0], (algorithm.__name__, threshold, az, matrix.rows))
+                self._assert_identical(numpy_run[1:], python_run[1:])
+
+    def _assert_identical(self, a, b):
+        """The statistics are identical, NumPy only returns floats where Python keeps ints."""
+        if isinstance(a, str) and a.startswith("{"):
+            a, b = json.loads(a), json.loads(b)
+
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+            if math.isnan(a):
+                self.assertTrue(math.isnan(b))
+            else:
+                self.assertEqual(float(a), float(b))
+        elif isinstance(a, dict):
+            self.assertEqual(list(a), list(b))
+            for key in a:
+                self._assert_identical(a[key], b[key])
+        elif isinstance(a, (list, tuple)):
+            self.assertEqual(len(a), len(b))
+            for x, y in zip(a, b):
+                self._assert_identical(x, y)
+        else:
+            self.assertEqual(a, b)
+
+    def _random_matrices(self, value):
+        rng = random.Random(7)
+        for az_count in [3, 4, 5, 6]:
+            azs = ["az" + str(i) for i in range(az_count)]
+            for _ in range(5):
+                timestamps = list(range(3600, 0, -60))
+                yield AZMatrix(timestamps, azs, [[value(rng) for _ in timestamps] for _ in azs])
+
+    def test_random_inputs(self):
+        for matrix in self._random_matrices(lambda rng: rng.choice([0.0, rng.uniform(0, 5), rng.uniform(0, 500), float(rng.randint(0, 3))])):
+            self._assert_paths_match(matrix)
+
+    def test_random_integer_counts(self):
+        for matrix in self._random_matrices(lambda rng: rng.choice([0, 1, rng.randint(0, 5), rng.randint(0, 1000)])):
+            self._assert_paths_match(matrix)
+
+    def test_random_fractional_counts(self):
+        for matrix in self._random_matrices(lambda rng: rng.randint(0, 3000) + rng.choice([0.1, 0.3, 0.7])):
+            self._assert_paths_match(matrix)
+
+    def test_exact_threshold_and_ties_match_the_scalar_detectors(self):
+        for rows in [[0], [0], [1], [0], [0]], [[2000.3], [0.3], [1000.3]], [[1], [1], [1]], [[0.1], [0.2], [0.3]], [[5], [0], [5]]:
+            azs = ["az" + str(i) for i in range(len(rows))]
+            matrix = AZMatrix([60], azs, rows)
+            self._assert_paths_match(matrix)
+            values = [row[0] for row in rows]
+
+            for use_numpy in [True, False]:
+                for az in azs:
+                    self.assertEqual(self._run(z_score, matrix, az, 2, use_numpy)[0], [_scalar_z_score(values, azs.index(az), 2)])
+                    self.assertEqual(self._run(chi_squared, matrix, az, 0.05, use_numpy)[0], [_scalar_chi_squared(values, azs.index(az), 0.05)])
+
+    def test_ensemble_votes_match_the_detectors(self):
+        for matrix in self._random_matrices(lambda rng: rng.randint(0, 3000) + rng.choice([0.0, 0.3])):
+            for az in matrix.azs:
+                for use_numpy in [True, False]:
+                    detectors = [
+                        self._run(chi_squared, matrix, az, index.ENSEMBLE_CHI_SQUARED_THRESHOLD, use_numpy)[0],
+                        self._run(z_score, matrix, az, index.ENSEMBLE_Z_SCORE_THRESHOLD, use_numpy)[0],
+                        self._run(iqr, matrix, az, None, use_numpy)[0],
+                        self._run(mad, matrix, az, index.ENSEMBLE_MAD_THRESHOLD, use_numpy)[0]
+                    ]
+                    expected = [int(sum(votes) >= 2) for votes in zip(*detectors)]
+                    self.assertEqual(self._run(ensemble, matrix, az, 2, use_numpy)[0], expected)
+
+    def test_python_path_matches_the_scalar_statistics(self):
+        # sum() compensates for the cancellation here from Python 3.12
+        matrix = AZMatrix([120, 60], ["az1", "az2", "az3"], [[1e16, 3.0], [1.0, 0.1], [-1e16, 0.2]])
+        original = index.USE_NUMPY
+        index.USE_NUMPY = False
+        try:
+            means = index._column_means(matrix)
+            stds = index._column_stds(matrix, means)
+        finally:
+            index.USE_NUMPY = original
+
+        for j, column in enumerate(zip(*matrix.rows)):
+            self.assertEqual(means[j], index._mean(list(column)))
+            self.assertEqual(stds[j], index._std(list(column)))
+
+
+class TestDiagnostics(unittest.TestCase):
+    def test_off_writes_nothing(self):
+        metrics = _make_metrics()
+        diagnostics = Diagnostics(metrics, "OFF")
+        diagnostics.summary("Mean", 1)
+        diagnostics.add("Query", {"a": 1})
+        self.assertIsNone(diagnostics.flush())
+        metrics.set_property.assert_not_called()
+
+    def test_summary_writes_only_summary_values(self):
+        metrics = _make_metrics()
+        diagnostics = Diagnostics(metrics, "SUMMARY")
+        diagnostics.summary("Mean", 1)
+        diagnostics.add("Query", {"a": 1})
+        self.assertFalse(diagnostics.detailed)
+        self.assertIsNone(diagnostics.flush())
+        metrics.set_property.assert_called_once_with("Mean", 1)
+
+    def test_full_is_serialized_once_as_one_property(self):
+        metrics = _make_metrics()
+        diagnostics = Diagnostics(metrics, "FULL", 1.0)
+        diagnostics.add("Query", {"StartTime": datetime.fromtimestamp(0, tz = timezone.utc)})
+        diagnostics.add("PValue", [0.5, None])
+        output = diagnostics.flush()
+        self.assertEqual(json.loads(output), {"Query": {"StartTime": "1970-01-01 00:00:00+00:00"}, "PValue": [0.5, None]})
+        metrics.set_property.assert_called_once_with("Diagnostics", output)
+
+    def test_unsampled_full_is_not_detailed(self):
+        self.assertFalse(Diagnostics(_make_metrics(), "FULL", 0.0).detailed)
+
+    def test_sections_past_budget_are_dropped(self):
+        metrics = _make_metrics()
+        diagnostics = Diagnostics(metrics, "FULL", 1.0, 40)
+        diagnostics.add("Small", 1)
+        diagnostics.add("Large", "x" * 100)
+        diagnostics.add("Other", 2)
+        output = diagnostics.flush()
+        self.assertLessEqual(len(output.encode("utf-8")), 40)
+        self.assertEqual(json.loads(output), {"Small": 1, "Other": 2})
+        metrics.set_property.assert_any_call("DiagnosticsDropped", ["Large"])
+
+    def test_algorithm_summary_is_for_newest_timestamp(self):
+        metrics = _make_metrics()
+        z_score({2000: {"az1": 5, "az2": 5}, 1000: {"az1": 1, "az2": 3}}, "az1", 1, metrics, Diagnostics(metrics, "SUMMARY"))
+        metrics.set_property.assert_any_call("Mean", 5.0)
+        metrics.set_property.assert_any_call("StdDev", 0.0)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_miss_then_hit(self):
+        cache = TTLCache(4, 10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+
+    def test_expired_entry_is_evicted(self):
+        clock = FakeClock()
+        cache = TTLCache(4, 10, clock = clock)
+        cache.put("a", 1)
+        clock.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted_at_capacity(self):
+        cache = TTLCache(2, 10)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_zero_capacity_disables_cache(self):
+        cache = TTLCache(0, 10)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+DIMENSIONS = '{"use1-az1": [{"Operation": "Ride", "AZ-ID": "use1-az1"}], "use1-az2": [{"Operation": "Ride", "AZ-ID": "use1-az2"}], "use1-az3": [{"Operation": "Ride", "AZ-ID": "use1-az3"}]}'
+
+
+def _make_event(az_id, algorithm = "Z_SCORE", threshold = "1", dimensions = DIMENSIONS):
+    return {
+        "StartTime": 1700000000,
+        "EndTime": 1700000180,
+        "Period": 60,
+        "Arguments": [algorithm, threshold, az_id, dimensions, "Ns", "Fault:Error", "Sum", "Count"]
+    }
+
+
+def _make_response(values_per_az, timestamps):
+    return {
+        "MetricDataResults": [
+            {
+                "Id": az.replace("-", "_"),
+                "Label": az,
+                "Timestamps": [datetime.fromtimestamp(t, tz = timezone.utc) for t in timestamps],
+                "Values": values,
+                "StatusCode": "Complete"
+            }
+            for az, values in values_per_az.items()
+        ]
+    }
+
+
+class TestCompileQueryPlan(unittest.TestCase):
+    def test_builds_one_stat_per_metric_and_one_expression_per_az(self):
+        plan = compile_query_plan(DIMENSIONS, "Ns", "Fault:Error", "Sum", "Count")
+        self.assertEqual(plan.azs, ("use1-az1", "use1-az2", "use1-az3"))
+        self.assertEqual(plan.operation, "Ride")
+        expressions = [q for q in plan.queries if "Expression" in q]
+        self.assertEqual([q["Expression"] for q in expressions][0], "use1_az1_0+use1_az1_1")
+        self.assertEqual(len(plan.queries), 9)
+
+    def test_multiple_dimension_sets_have_unique_ids(self):
+        dimensions = '{"use1-az1": [{"AvailabilityZone": "us-east-1a", "LoadBalancer": "a"}, {"AvailabilityZone": "us-east-1a", "LoadBalancer": "b"}]}'
+        plan = compile_query_plan(dimensions, "Ns", "Fault", "Sum", "Count")
+        ids = [q["Id"] for q in plan.queries]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(plan.queries[-1]["Expression"], "use1_az1_0+use1_az1_1")
+
+    def test_key_ignores_json_formatting(self):
+        compact = compile_query_plan('{"use1-az1":[{"A":"1","B":"2"}]}', "Ns", "Fault", "Sum", "Count")
+        spaced = compile_query_plan('{"use1-az1": [{"B": "2", "A": "1"}]}', "Ns", "Fault", "Sum", "Count")
+        self.assertEqual(compact.key, spaced.key)
+
+
+class TestWildcardDimensions(unittest.TestCase):
+    def setUp(self):
+        self.dimensions = json.dumps({
+            az: [{"AvailabilityZoneId": az, "Operation": "Ride", "InstanceId": "*"}]
+            for az in ["use1-az1", "use1-az2", "use1-az3"]
+        })
+
+    def test_wildcard_set_is_one_search_expression(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault:Error", "Sum", "Count")
+        self.assertEqual(len(plan.queries), 6)
+        self.assertEqual(plan.queries[0]["Expression"], (
+            "SUM(SEARCH('{\"Ns\",\"AvailabilityZoneId\",\"Operation\",\"InstanceId\"} "
+            "\"AvailabilityZoneId\"=\"use1-az1\" \"Operation\"=\"Ride\" (MetricName=\"Fault\" OR MetricName=\"Error\")', 'Sum', 60))"
+        ))
+        self.assertEqual(plan.queries[1]["Expression"], "use1_az1_0")
+        self.assertEqual(plan.operation, "Ride")
+
+    def test_explicit_and_wildcard_sets_are_summed(self):
+        dimensions = '{"use1-az1": [{"AZ-ID": "use1-az1", "Host": "*"}, {"AZ-ID": "use1-az1", "Host": "canary"}]}'
+        plan = compile_query_plan(dimensions, "Ns", "Fault", "Sum", "Count")
+        self.assertTrue(plan.queries[0]["Expression"].startswith("SUM(SEARCH("))
+        self.assertIn("MetricStat", plan.queries[1])
+        self.assertEqual(plan.queries[2]["Expression"], "use1_az1_0+use1_az1_1")
+
+    def test_unit_with_a_wildcard_is_a_warning(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "Count")
+        self.assertEqual(len(plan.warnings), 1)
+        self.assertIn("Count", plan.warnings[0])
+        self.assertNotIn("Unit", plan.queries[0])
+
+        self.assertEqual(compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "").warnings, ())
+        self.assertEqual(compile_query_plan(DIMENSIONS, "Ns", "Fault", "Sum", "Count").warnings, ())
+
+    def test_warnings_are_logged(self):
+        client = MagicMock()
+        client.get_metric_data.return_value = {"MetricDataResults": []}
+        original = index.cw_client
+        index.cw_client = client
+        index.fetch_cache.clear()
+
+        try:
+            metrics = _make_metrics()
+            event = _make_event("use1-az1", dimensions = self.dimensions)
+            get_metric_data(event, metrics)
+        finally:
+            index.cw_client = original
+            index.fetch_cache.clear()
+
+        warnings = [c.args[1] for c in metrics.set_property.call_args_list if c.args[0] == "QueryPlanWarnings"]
+        self.assertEqual(len(warnings), 1)
+
+    def test_quotes_are_rejected(self):
+        dimensions = '{"use1-az1": [{"AZ-ID": "use1-az1", "Host": "*", "Name": "it\'s"}]}'
+        with self.assertRaises(ValueError):
+            compile_query_plan(dimensions, "Ns", "Fault", "Sum", "Count")
+
+    def test_metrics_insights_leaves_wildcards_unfiltered(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "Count")
+        self.assertEqual(
+            plan.insights[0]["Expression"],
+            'SELECT SUM("Fault") FROM SCHEMA("Ns", "AvailabilityZoneId", "InstanceId", "Operation") WHERE "Operation" = \'Ride\' GROUP BY "AvailabilityZoneId"'
+        )
+
+
+class TestQueryPlanChunking(unittest.TestCase):
+    """A fleet with more dimension sets than fit in one request."""
+
+    HOSTS = 200
+
+    def setUp(self):
+        self.dimensions = json.dumps({
+            az: [{"AvailabilityZoneId": az, "Host": str(host)} for host in range(self.HOSTS)]
+            for az in ["use1-az1", "use1-az2", "use1-az3"]
+        })
+
+    def test_chunks_fit_request_limits(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "Count")
+        self.assertGreater(len(plan.chunks), 1)
+
+        for chunk in plan.chunks:
+            self.assertLessEqual(len(chunk), index.MAX_QUERIES_PER_REQUEST)
+            ids = {q["Id"] for q in chunk}
+            for query in chunk:
+                if "Expression" in query:
+                    self.assertLessEqual(len(query["Expression"]), index.MAX_EXPRESSION_LENGTH)
+                    self.assertTrue(set(query["Expression"].split("+")) <= ids)
+
+    def test_every_input_is_summed_once(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "Count")
+        inputs = [q["Id"] for q in plan.queries if "MetricStat" in q]
+        summed = [i for q in plan.queries if "Expression" in q for i in q["Expression"].split("+")]
+        self.assertEqual(sorted(inputs), sorted(summed))
+        self.assertEqual(len(inputs), 3 * self.HOSTS)
+
+    def test_chunked_fetch_adds_partial_sums(self):
+        class ExpressionCloudWatch:
+            """Evaluates each expression as the sum of its inputs' host numbers."""
+            def __init__(self):
+                self.requests = []
+
+            def get_metric_data(self, **kwargs):
+                self.requests.append(kwargs)
+                values = {
+                    q["Id"]: float(q["MetricStat"]["Metric"]["Dimensions"][1]["Value"])
+                    for q in kwargs["MetricDataQueries"] if "MetricStat" in q
+                }
+                timestamp = datetime.fromtimestamp(kwargs["StartTime"], tz = timezone.utc)
+                return {"MetricDataResults": [
+                    {
+                        "Id": q["Id"],
+                        "Label": q["Label"],
+                        "Timestamps": [timestamp],
+                        "Values": [sum(values[i] for i in q["Expression"].split("+"))],
+                        "StatusCode": "Complete"
+                    }
+                    for q in kwargs["MetricDataQueries"] if q["ReturnData"]
+                ]}
+
+        original = index.cw_client
+        index.cw_client = ExpressionCloudWatch()
+        try:
+            plan = compile_query_plan(self.dimensions, "Ns", "Fault", "Sum", "Count")
+            matrix = index.fetch_az_matrix(plan, 1700000000, 1700000060, Diagnostics(_make_metrics(), level = "OFF"))
+            self.assertEqual(len(index.cw_client.requests), len(plan.chunks))
+        finally:
+            index.cw_client = original
+
+        total = float(sum(range(self.HOSTS)))
+        self.assertEqual(matrix.azs, ["use1-az1", "use1-az2", "use1-az3"])
+        self.assertEqual(matrix.columns(), [(total, total, total)])
+
+
+class GroupedCloudWatch:
+    """
+    Answers Metrics Insights queries with one result per AZ-ID group and
+    enumerated queries with one result per AZ expression, from the same
+    per-AZ and per-metric series.
+    """
+
+    def __init__(self, series: dict):
+        self.series = series
+        self.requests = []
+
+    def _points(self, az, metric, start, end):
+        return sorted(((t, v) for t, v in self.series[az][metric].items() if start <= t < end), reverse = True)
+
+    def get_metric_data(self, **kwargs):
+        self.requests.append(kwargs)
+        start = kwargs["StartTime"]
+        end = kwargs["EndTime"]
+        queries = {q["Id"]: q for q in kwargs["MetricDataQueries"]}
+        results = []
+
+        for query in kwargs["MetricDataQueries"]:
+            if query.get("Expression", "").startswith("SELECT"):
+                metric = query["Expression"].split('"')[1]
+                groups = [(az, self._points(az, metric, start, end)) for az in sorted(self.series)]
+            elif query["ReturnData"]:
+                totals = {}
+                for i in query["Expression"].split("+"):
+                    metric = queries[i]["MetricStat"]["Metric"]["MetricName"]
+                    for t, v in self._points(query["Label"], metric, start, end):
+                        totals[t] = totals.get(t, 0) + v
+                groups = [(query["Label"], sorted(totals.items(), reverse = True))]
+            else:
+                continue
+
+            for label, points in groups:
+                results.append({
+                    "Id": query["Id"],
+                    "Label": label,
+                    "Timestamps": [datetime.fromtimestamp(t, tz = timezone.utc) for t, v in points],
+                    "Values": [v for t, v in points],
+                    "StatusCode": "Complete"
+                })
+
+        return {"MetricDataResults": results}
+
+
+class TestMetricsInsights(unittest.TestCase):
+    AZS = ["use1-az1", "use1-az2", "use1-az3"]
+
+    def setUp(self):
+        rng = random.Random(7)
+        self.end = (int(time.time()) // 60) * 60
+        self.dimensions = json.dumps({az: [{"AvailabilityZoneId": az, "Operation": "Ride"}] for az in self.AZS})
+        series = {
+            az: {metric: {t: float(rng.randint(0, 20)) for t in range(self.end - 7200, self.end, 60)} for metric in ["Fault", "Error"]}
+            for az in self.AZS + ["use1-az4"]
+        }
+        self.client = GroupedCloudWatch(series)
+        self._original = (index.cw_client, index.METRICS_INSIGHTS)
+        index.cw_client = self.client
+
+    def tearDown(self):
+        index.cw_client, index.METRICS_INSIGHTS = self._original
+
+    def _fetch(self, insights, start):
+        index.METRICS_INSIGHTS = insights
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault:Error", "Sum", "Count")
+        return index.fetch_az_matrix(plan, start, self.end, Diagnostics(_make_metrics(), level = "OFF"))
+
+    def test_query_per_metric_grouped_by_the_varying_dimension(self):
+        plan = compile_query_plan(self.dimensions, "Ns", "Fault:Error", "Sum", "Count")
+        self.assertEqual([q["Expression"] for q in plan.insights], [
+            'SELECT SUM("' + metric + '") FROM SCHEMA("Ns", "AvailabilityZoneId", "Operation") WHERE "Operation" = \'Ride\' GROUP BY "AvailabilityZoneId"'
+            for metric in ["Fault", "Error"]
+        ])
+        self.assertEqual(plan.insights_labels, {az: az for az in self.AZS})
+
+    def test_falls_back_when_schema_does_not_allow_it(self):
+        self.assertEqual(compile_query_plan(self.dimensions, "Ns", "Latency", "TC(100:)", "Milliseconds").insights, ())
+        self.assertEqual(compile_query_plan(DIMENSIONS.replace('"Ride"', '"Ride\'s"'), "Ns", "Fault", "Sum", "Count").insights, ())
+        two_sets = '{"use1-az1": [{"AvailabilityZone": "us-east-1a", "LoadBalancer": "a"}, {"AvailabilityZone": "us-east-1a", "LoadBalancer": "b"}], "use1-az2": [{"AvailabilityZone": "us-east-1b", "LoadBalancer": "a"}]}'
+        self.assertEqual(compile_query_plan(two_sets, "Ns", "Fault", "Sum", "Count").insights, ())
+
+    def test_group_values_map_to_their_az(self):
+        dimensions = json.dumps({"use1-az" + str(i + 1): [{"AvailabilityZone": "us-east-1" + letter, "LoadBalancer": "lb"}] for i, letter in enumerate("abc")})
+        plan = compile_query_plan(dimensions, "Ns", "Fault", "Sum", "Count")
+        self.assertEqual(plan.insights_labels, {"us-east-1a": "use1-az1", "us-east-1b": "use1-az2", "us-east-1c": "use1-az3"})
+
+    def test_grouped_fetch_matches_enumerated_fetch(self):
+        enumerated = self._fetch(False, self.end - 3600)
+        requests = len(self.client.requests)
+        grouped = self._fetch(True, self.end - 3600)
+        self.assertEqual(len(self.client.requests) - requests, 1)
+        self.assertTrue(all(q["Expression"].startswith("SELECT") for q in self.client.requests[-1]["MetricDataQueries"]))
+        self.assertEqual(grouped.azs, enumerated.azs)
+        self.assertEqual(grouped.timestamps, enumerated.timestamps)
+        self.assertEqual(grouped.rows, enumerated.rows)
+
+    def test_old_windows_are_enumerated(self):
+        self._fetch(True, self.end - index.METRICS_INSIGHTS_MAX_AGE_SECONDS - 60)
+        self.assertTrue(all("SELECT" not in q.get("Expression", "") for r in self.client.requests for q in r["MetricDataQueries"]))
+
+
+class TestPlanPeriod(unittest.TestCase):
+    NOW = 1700000000
+
+    def test_requested_period_is_used(self):
+        self.assertEqual(plan_period(300, self.NOW - 3600, now = self.NOW), 300)
+
+    def test_high_resolution_periods(self):
+        for period in [1, 5, 10, 30]:
+            self.assertEqual(plan_period(period, self.NOW - 600, now = self.NOW), period)
+
+    def test_rounds_up_to_valid_period(self):
+        self.assertEqual(plan_period(20, self.NOW - 600, now = self.NOW), 30)
+        self.assertEqual(plan_period(45, self.NOW - 600, now = self.NOW), 60)
+        self.assertEqual(plan_period(90, self.NOW - 600, now = self.NOW), 120)
+
+    def test_high_resolution_unavailable_after_three_hours(self):
+        self.assertEqual(plan_period(10, self.NOW - 4 * 3600, now = self.NOW), 60)
+
+    def test_retention_minimums(self):
+        self.assertEqual(plan_period(60, self.NOW - 20 * 86400, now = self.NOW), 300)
+        self.assertEqual(plan_period(60, self.NOW - 70 * 86400, now = self.NOW), 3600)
+
+
+class TestGetMetricDataFetchCache(unittest.TestCase):
+    def setUp(self):
+        index.fetch_cache.clear()
+        self.client = MagicMock()
+        self.client.get_metric_data.return_value = _make_response(
+            {"use1-az1": [100, 10], "use1-az2": [10, 10], "use1-az3": [10, 10]},
+            [1700000120, 1700000060]
+        )
+        self._original_client = index.cw_client
+        index.cw_client = self.client
+
+    def tearDown(self):
+        index.cw_client = self._original_client
+        index.fetch_cache.clear()
+
+    def test_alarms_for_each_az_share_one_fetch(self):
+        results = [get_metric_data(_make_event(az), _make_metrics()) for az in ["use1-az1", "use1-az2", "use1-az3"]]
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+        self.assertEqual(results[0]["MetricDataResults"][0]["Values"], [1, 0])
+        self.assertEqual(results[1]["MetricDataResults"][0]["Values"], [0, 0])
+        self.assertEqual(results[0]["MetricDataResults"][0]["Timestamps"], [1700000120, 1700000060])
+
+    def test_result_is_for_requested_az(self):
+        result = get_metric_data(_make_event("use1-az1"), _make_metrics())
+        self.assertEqual(result["MetricDataResults"][0]["Label"], "use1-az1")
+        self.assertEqual(result["MetricDataResults"][0]["Values"], [1, 0])
+
+    def test_all_availability_zones_returns_a_series_per_az(self):
+        result = get_metric_data(_make_event("*"), _make_metrics())
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+        self.assertEqual([r["Label"] for r in result["MetricDataResults"]], ["use1-az1", "use1-az2", "use1-az3"])
+
+        for entry in result["MetricDataResults"]:
+            single = get_metric_data(_make_event(entry["Label"]), _make_metrics())["MetricDataResults"][0]
+            self.assertEqual(entry, single)
+
+    def test_different_window_is_fetched_again(self):
+        get_metric_data(_make_event("use1-az1"), _make_metrics())
+        event = _make_event("use1-az1")
+        # The event is old enough to be fetched at one hour periods
+        event["EndTime"] += 3600
+        get_metric_data(event, _make_metrics())
+        self.assertEqual(self.client.get_metric_data.call_count, 2)
+
+    def test_unaligned_window_shares_the_aligned_entry(self):
+        get_metric_data(_make_event("use1-az1"), _make_metrics())
+        event = _make_event("use1-az1")
+        event["StartTime"] += 7
+        event["EndTime"] -= 7
+        get_metric_data(event, _make_metrics())
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+
+    def test_cache_counts_are_emitted(self):
+        get_metric_data(_make_event("use1-az1"), _make_metrics())
+        metrics = _make_metrics()
+        get_metric_data(_make_event("use1-az2"), metrics)
+        metrics.put_metric.assert_any_call("FetchCacheHit", 1, "Count")
+        metrics.put_metric.assert_any_call("FetchCacheMiss", 0, "Count")
+        metrics.put_metric.assert_any_call("FetchCacheEvictions", 0, "Count")
+
+    def test_queries_use_planned_period(self):
+        event = _make_event("use1-az1")
+        event["StartTime"] = int(time.time()) - 600
+        event["EndTime"] = int(time.time())
+        event["Period"] = 10
+        get_metric_data(event, _make_metrics())
+        queries = self.client.get_metric_data.call_args.kwargs["MetricDataQueries"]
+        self.assertTrue(all(q["MetricStat"]["Period"] == 10 for q in queries if "MetricStat" in q))
+
+    def test_pagination_stops_after_last_page(self):
+        first = _make_response({"use1-az1": [1], "use1-az2": [1], "use1-az3": [1]}, [1700000120])
+        first["NextToken"] = "token"
+        second = _make_response({"use1-az1": [2], "use1-az2": [2], "use1-az3": [2]}, [1700000060])
+        self.client.get_metric_data.side_effect = [first, second]
+        result = get_metric_data(_make_event("use1-az1"), _make_metrics())
+        self.assertEqual(self.client.get_metric_data.call_count, 2)
+        self.assertEqual(result["MetricDataResults"][0]["Timestamps"], [1700000120, 1700000060])
+
+
+class TestPhaseTimings(unittest.TestCase):
+    def setUp(self):
+        index.fetch_cache.clear()
+        self.client = MagicMock()
+        first = _make_response({"use1-az1": [1], "use1-az2": [1], "use1-az3": [1]}, [1700000120])
+        first["NextToken"] = "token"
+        second = _make_response({"use1-az1": [2], "use1-az2": [2], "use1-az3": [2]}, [1700000060])
+        self.client.get_metric_data.side_effect = [first, second]
+        self._original = (index.cw_client, index.PROFILE)
+        index.cw_client = self.client
+
+    def tearDown(self):
+        index.cw_client, index.PROFILE = self._original
+        index.fetch_cache.clear()
+
+    def _handle(self):
+        metrics = _make_metrics()
+        index._handle({"EventType": "GetMetricData", "GetMetricDataRequest": _make_event("use1-az1")}, None, metrics)
+        return metrics
+
+    def test_each_phase_is_timed(self):
+        metrics = self._handle()
+        names = [c.args[0] for c in metrics.put_metric.call_args_list]
+
+        for phase in ["ParseArguments", "QueryPlan", "Fetch", "Assemble", "Score", "Serialize"]:
+            self.assertEqual(names.count(phase + "Latency"), 1)
+
+        self.assertEqual(names.count("GetMetricDataPageLatency"), 2)
+        metrics.put_metric.assert_any_call("GetMetricDataPages", 2, "Count")
+        metrics.put_metric.assert_any_call("GetMetricDataDatapoints", 6, "Count")
+
+    def test_cache_hit_has_no_fetch_phase(self):
+        self._handle()
+        names = [c.args[0] for c in self._handle().put_metric.call_args_list]
+        self.assertNotIn("FetchLatency", names)
+        self.assertNotIn("GetMetricDataPages", names)
+
+    def test_profile_is_written_when_enabled(self):
+        index.PROFILE = True
+        metrics = self._handle()
+        profile = [c.args[1] for c in metrics.set_property.call_args_list if c.args[0] == "Profile"]
+        self.assertEqual(len(profile), 1)
+        self.assertTrue(0 < len(profile[0]) <= index.PROFILE_TOP_FUNCTIONS)
+        self.assertEqual(set(profile[0][0]), {"Function", "Calls", "TotalMs", "CumulativeMs"})
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        index.fetch_cache.clear()
+        self.client = MagicMock()
+        self.client.get_metric_data.return_value = _make_response(
+            {"use1-az1": [100, 10], "use1-az2": [10, 10], "use1-az3": [10, 10]},
+            [1700000120, 1700000060]
+        )
+        self._original_client = index.cw_client
+        index.cw_client = self.client
+
+    def tearDown(self):
+        index.cw_client = self._original_client
+        index.fetch_cache.clear()
+
+    def _query(self, event):
+        return {"Period": event["Period"], "EvaluationPeriods": 3, "Arguments": event["Arguments"]}
+
+    def test_alarms_after_prefetch_are_served_from_cache(self):
+        event = _make_event("use1-az2")
+        result = index.prefetch({"EndTime": event["EndTime"], "Queries": [self._query(event)]}, _make_metrics())
+        self.assertEqual(result, {"Prefetched": 1, "Failed": 0})
+
+        for az in ["use1-az1", "use1-az2", "use1-az3"]:
+            get_metric_data(_make_event(az), _make_metrics())
+
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+
+    def test_window_ends_at_last_period_boundary(self):
+        now = (int(time.time()) // 60) * 60 + 30
+        event = _make_event("use1-az1")
+        index.prefetch({"Queries": [self._query(event)]}, _make_metrics(), now = now)
+        request = self.client.get_metric_data.call_args.kwargs
+        self.assertEqual(request["EndTime"], now - 30)
+        self.assertEqual(request["StartTime"], now - 30 - 180)
+
+    def test_alarm_for_the_prefetched_window_is_served_from_cache(self):
+        boundary = (int(time.time()) // 60) * 60
+        event = _make_event("use1-az1")
+        index.prefetch({"Queries": [self._query(event)]}, _make_metrics(), now = boundary + 50)
+
+        event["StartTime"] = boundary - 180
+        event["EndTime"] = boundary
+        get_metric_data(event, _make_metrics())
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+
+        # Kept until the grace period after the next boundary, when the alarms for this window have run
+        expires_at = next(iter(index.fetch_cache._entries.values()))[0]
+        self.assertAlmostEqual(expires_at - time.monotonic(), 10 + index.PREFETCH_GRACE_SECONDS, delta = 1)
+
+    def test_alarm_after_the_boundary_gets_the_fresh_bucket(self):
+        boundary = (int(time.time()) // 60) * 60
+        self.client.get_metric_data.return_value = _make_response(
+            {"use1-az1": [100, 10], "use1-az2": [10, 10], "use1-az3": [10, 10]},
+            [boundary - 120, boundary - 180]
+        )
+        event = _make_event("use1-az1")
+        index.prefetch({"Queries": [self._query(event)]}, _make_metrics(), now = boundary - 10)
+
+        # The bucket that was filling during the prefetch has completed with a different value
+        self.client.get_metric_data.return_value = _make_response(
+            {"use1-az1": [10, 100, 10], "use1-az2": [10, 10, 10], "use1-az3": [10, 10, 10]},
+            [boundary - 60, boundary - 120, boundary - 180]
+        )
+        event["StartTime"] = boundary - 180
+        event["EndTime"] = boundary
+        result = get_metric_data(event, _make_metrics())
+
+        self.assertEqual(self.client.get_metric_data.call_count, 2)
+        self.assertEqual(self.client.get_metric_data.call_args.kwargs["EndTime"], boundary)
+        values = dict(zip(result["MetricDataResults"][0]["Timestamps"], result["MetricDataResults"][0]["Values"]))
+        self.assertEqual(values[boundary - 60], 0)
+        self.assertEqual(values[boundary - 120], 1)
+
+    def test_queries_long_after_their_boundary_are_skipped(self):
+        now = (int(time.time()) // 300) * 300 + 70
+        event = _make_event("use1-az1")
+        query = {"Period": 300, "EvaluationPeriods": 3, "Arguments": event["Arguments"]}
+        metrics = _make_metrics()
+        result = index.prefetch({"Queries": [query]}, metrics, now = now)
+        self.assertEqual(result, {"Prefetched": 0, "Failed": 0})
+        metrics.put_metric.assert_any_call("PrefetchSkippedQueries", 1, "Count")
+        self.client.get_metric_data.assert_not_called()
+
+    def test_failed_query_does_not_stop_the_others(self):
+        event = _make_event("use1-az1")
+        metrics = _make_metrics()
+        result = index.prefetch({"EndTime": event["EndTime"], "Queries": [{"Period": 60}, self._query(event)]}, metrics)
+        self.assertEqual(result, {"Prefetched": 1, "Failed": 1})
+        metrics.put_metric.assert_any_call("PrefetchFailures", 1, "Count")
+
+    def test_handler_accepts_prefetch_events(self):
+        event = _make_event("use1-az1")
+        result = index._handle({
+            "EventType": "Prefetch",
+            "PrefetchRequest": {"EndTime": event["EndTime"], "Queries": [self._query(event)]}
+        }, None, _make_metrics())
+        self.assertEqual(result["Prefetched"], 1)
+
+
+class ClientError(Exception):
+    """Stands in for botocore's ClientError."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class TestFetchDeadline(unittest.TestCase):
+    def setUp(self):
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+        index.backoff = index.AdaptiveBackoff()
+        self.response = _make_response(
+            {"use1-az1": [100, 10], "use1-az2": [10, 10], "use1-az3": [10, 10]},
+            [1700000120, 1700000060]
+        )
+        self.client = MagicMock()
+        self._original_client = index.cw_client
+        index.cw_client = self.client
+
+    def tearDown(self):
+        index.cw_client = self._original_client
+        index.backoff = index.AdaptiveBackoff()
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+
+    def test_throttled_request_is_retried(self):
+        self.client.get_metric_data.side_effect = [ClientError("Throttling"), self.response]
+        timings = index.PhaseTimings()
+        result = get_metric_data(_make_event("use1-az1"), _make_metrics(), timings = timings, deadline = time.monotonic() + 5)
+        self.assertEqual(result["MetricDataResults"][0]["StatusCode"], "Complete")
+        self.assertEqual(result["MetricDataResults"][0]["Values"], [1, 0])
+        self.assertEqual(timings.counts["GetMetricDataThrottles"], 1)
+        self.assertEqual(timings.counts["GetMetricDataRetries"], 1)
+        self.assertEqual(timings.counts["FetchDeadlineExceeded"], 0)
+
+    def test_other_errors_are_not_retried(self):
+        self.client.get_metric_data.side_effect = ClientError("ValidationError")
+
+        with self.assertRaises(ClientError):
+            get_metric_data(_make_event("use1-az1"), _make_metrics(), deadline = time.monotonic() + 5)
+
+        self.assertEqual(self.client.get_metric_data.call_count, 1)
+
+    def test_slow_fetch_returns_partial_data_by_the_deadline(self):
+        self.client.get_metric_data.side_effect = lambda **kwargs: time.sleep(0.3) or self.response
+        timings = index.PhaseTimings()
+        begin = time.monotonic()
+        result = get_metric_data(_make_event("use1-az1"), _make_metrics(), timings = timings, deadline = begin + 0.05)
+        self.assertLess(time.monotonic() - begin, 0.25)
+        self.assertEqual([item["StatusCode"] for item in result["MetricDataResults"]], ["PartialData"])
+        self.assertEqual(result["MetricDataResults"][0]["Values"], [])
+        self.assertEqual(timings.counts["FetchDeadlineExceeded"], 1)
+        self.assertEqual(len(index.fetch_cache), 0)
+
+    def test_persistent_throttling_stops_at_the_deadline(self):
+        self.client.get_metric_data.side_effect = ClientError("ThrottlingException")
+        timings = index.PhaseTimings()
+        result = get_metric_data(_make_event("use1-az1"), _make_metrics(), timings = timings, deadline = time.monotonic() + 0.3)
+        self.assertEqual(result["MetricDataResults"][0]["StatusCode"], "PartialData")
+        self.assertGreaterEqual(timings.counts["GetMetricDataThrottles"], 1)
+        self.assertGreater(index.backoff.delay, 0)
+
+    def test_persistent_throttling_without_a_deadline_raises(self):
+        self.client.get_metric_data.side_effect = ClientError("ThrottlingException")
+        originals = (index.FETCH_RETRY_BASE_SECONDS, index.FETCH_RETRY_MAX_SECONDS)
+        index.FETCH_RETRY_BASE_SECONDS = index.FETCH_RETRY_MAX_SECONDS = 0.001
+        timings = index.PhaseTimings()
+
+        try:
+            with self.assertRaises(ClientError):
+                get_metric_data(_make_event("use1-az1"), _make_metrics(), timings = timings)
+        finally:
+            index.FETCH_RETRY_BASE_SECONDS, index.FETCH_RETRY_MAX_SECONDS = originals
+
+        self.assertEqual(self.client.get_metric_data.call_count, index.FETCH_MAX_ATTEMPTS)
+        self.assertEqual(timings.counts["GetMetricDataThrottles"], index.FETCH_MAX_ATTEMPTS)
+        self.assertEqual(timings.counts["GetMetricDataRetries"], index.FETCH_MAX_ATTEMPTS - 1)
+
+    def test_handler_uses_the_remaining_time(self):
+        self.client.get_metric_data.side_effect = lambda **kwargs: time.sleep(0.3) or self.response
+        metrics = _make_metrics()
+        result = index._handle({"EventType": "GetMetricData", "GetMetricDataRequest": _make_event("use1-az1")},
+            FakeContext(index.FETCH_DEADLINE_RESERVE_MS + 50), metrics)
+        self.assertEqual(result["MetricDataResults"][0]["StatusCode"], "PartialData")
+        metrics.put_metric.assert_any_call("FetchDeadlineExceeded", 1, "Count")
+
+    def test_no_deadline_without_a_context(self):
+        self.assertIsNone(index.deadline_from(None))
+        self.assertAlmostEqual(index.deadline_from(FakeContext(3500)), time.monotonic() + 3.5 - index.FETCH_DEADLINE_RESERVE_MS / 1000, places = 1)
+
+
+class FakeCloudWatch:
+    """Serves GetMetricData from fixed per-AZ series, honoring the requested time range."""
+
+    def __init__(self, series: dict):
+        self.series = series
+        self.requests = []
+
+    def get_metric_data(self, **kwargs):
+        self.requests.append(kwargs)
+        start = kwargs["StartTime"]
+        end = kwargs["EndTime"]
+        results = []
+
+        for query in kwargs["MetricDataQueries"]:
+            if not query["ReturnData"]:
+                continue
+
+            points = sorted(((t, v) for t, v in self.series[query["Label"]].items() if start <= t < end), reverse = True)
+            results.append({
+                "Id": query["Id"],
+                "Label": query["Label"],
+                "Timestamps": [datetime.fromtimestamp(t, tz = timezone.utc) for t, v in points],
+                "Values": [v for t, v in points],
+                "StatusCode": "Complete"
+            })
+
+        return {"MetricDataResults": results}
+
+
+class TestLazyInitialization(unittest.TestCase):
+    def test_cloudwatch_client_is_created_once_on_first_use(self):
+        original = index.cw_client
+        index.cw_client = None
+        try:
+            client = index._cloudwatch()
+            self.assertIsNotNone(client)
+            self.assertIs(index._cloudwatch(), client)
+        finally:
+            index.cw_client = original
+
+    def test_numpy_is_not_loaded_when_disabled(self):
+        original = (index.USE_NUMPY, index.np, index._numpy_import_attempted)
+        index.USE_NUMPY = False
+        index.np = None
+        index._numpy_import_attempted = False
+        try:
+            self.assertFalse(index._numpy_enabled())
+            self.assertFalse(index._numpy_import_attempted)
+        finally:
+            index.USE_NUMPY, index.np, index._numpy_import_attempted = original
+
+
+class TestTimeSlices(unittest.TestCase):
+    def test_short_window_is_one_slice(self):
+        self.assertEqual(time_slices(0, 3600, 60, 4, 360), [(0, 3600)])
+
+    def test_slices_are_contiguous_and_period_aligned(self):
+        slices = time_slices(30, 86400 + 30, 60, 4, 360)
+        self.assertEqual(len(slices), 4)
+        self.assertEqual(slices[0][0], 30)
+        self.assertEqual(slices[-1][1], 86400 + 30)
+        for (_, end), (start, _) in zip(slices, slices[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(start % 60, 0)
+
+    def test_slice_count_is_bounded(self):
+        self.assertEqual(len(time_slices(0, 7 * 86400, 60, 4, 360)), 4)
+        self.assertEqual(len(time_slices(0, 7 * 86400, 60, 1, 360)), 1)
+
+
+class TestSlicedFetch(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(5)
+        self.end = (int(time.time()) // 60) * 60
+        self.start = self.end - 86400
+        series = {
+            az: {t: float(rng.randint(0, 20)) for t in range(self.start, self.end, 60)}
+            for az in ["use1-az1", "use1-az2", "use1-az3"]
+        }
+        self.client = FakeCloudWatch(series)
+        self._original = (index.cw_client, index.FETCH_MAX_SLICES)
+        index.cw_client = self.client
+        index.fetch_cache.clear()
+
+    def tearDown(self):
+        index.cw_client, index.FETCH_MAX_SLICES = self._original
+        index.fetch_cache.clear()
+
+    def _fetch(self, max_slices):
+        index.FETCH_MAX_SLICES = max_slices
+        index.fetch_cache.clear()
+        event = _make_event("use1-az1")
+        event["StartTime"] = self.start
+        event["EndTime"] = self.end
+        return get_metric_data(event, _make_metrics())
+
+    def test_sliced_fetch_matches_single_fetch(self):
+        single = self._fetch(1)
+        self.assertEqual(len(self.client.requests), 1)
+        sliced = self._fetch(4)
+        self.assertEqual(len(self.client.requests), 5)
+        self.assertEqual(sliced, single)
+
+
+class TestIncrementalEvaluation(unittest.TestCase):
+    def setUp(self):
+        self.now = (int(time.time()) // 60) * 60
+        rng = random.Random(3)
+        self.series = {
+            az: {t: float(rng.randint(0, 20)) for t in range(self.now - 7200, self.now, 60)}
+            for az in ["use1-az1", "use1-az2", "use1-az3"]
+        }
+        self.client = FakeCloudWatch(self.series)
+        self._original = (index.cw_client, index.INCREMENTAL_EVALUATION)
+        index.cw_client = self.client
+        index.INCREMENTAL_EVALUATION = True
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+
+    def tearDown(self):
+        index.cw_client, index.INCREMENTAL_EVALUATION = self._original
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+
+    def _event(self, end, algorithm = "Z_SCORE"):
+        event = _make_event("use1-az1", algorithm = algorithm)
+        event["StartTime"] = end - 3600
+        event["EndTime"] = end
+        return event
+
+    def _full(self, event):
+        index.INCREMENTAL_EVALUATION = False
+        index.fetch_cache.clear()
+        try:
+            return get_metric_data(event, _make_metrics())
+        finally:
+            index.INCREMENTAL_EVALUATION = True
+            index.fetch_cache.clear()
+
+    def test_only_fetches_after_newest_retained_datapoint(self):
+        get_metric_data(self._event(self.now - 600), _make_metrics())
+        get_metric_data(self._event(self.now - 540), _make_metrics())
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual(self.client.requests[1]["StartTime"], self.now - 600 - 60 - 2 * 60)
+
+    def test_only_scores_new_datapoints(self):
+        get_metric_data(self._event(self.now - 600), _make_metrics())
+        metrics = _make_metrics()
+        get_metric_data(self._event(self.now - 540), metrics)
+        metrics.put_metric.assert_any_call("ScoredDatapoints", 1, "Count")
+
+    def test_results_match_full_evaluation(self):
+        for algorithm in ["CHI_SQUARED", "Z_SCORE", "IQR", "MAD", "EWMA", "ENSEMBLE"]:
+            index.retained_series.clear()
+            for end in range(self.now - 900, self.now, 60):
+                index.fetch_cache.clear()
+                incremental = get_metric_data(self._event(end, algorithm), _make_metrics())
+                self.assertEqual(incremental, self._full(self._event(end, algorithm)))
+
+    def test_late_data_in_overlap_is_rescored(self):
+        get_metric_data(self._event(self.now - 600), _make_metrics())
+        self.series["use1-az1"][self.now - 720] = 1000.0
+        index.fetch_cache.clear()
+        result = get_metric_data(self._event(self.now - 540), _make_metrics())
+        self.assertEqual(result, self._full(self._event(self.now - 540)))
+
+    def test_window_before_retained_data_is_fetched_in_full(self):
+        get_metric_data(self._event(self.now - 600), _make_metrics())
+        get_metric_data(self._event(self.now - 1200), _make_metrics())
+        self.assertEqual(self.client.requests[1]["StartTime"], self.now - 1200 - 3600)
+
+
+
+class TestEWMALookback(unittest.TestCase):
+    AZS = ["use1-az" + str(i) for i in range(1, 7)]
+
+    def setUp(self):
+        self.now = (int(time.time()) // 60) * 60
+        # use1-az1 always runs about three times the others' traffic
+        self.series = {
+            az: {t: float((30 if az == "use1-az1" else 10) + (2 if t % 120 else -2)) for t in range(self.now - 7200, self.now, 60)}
+            for az in self.AZS
+        }
+        self._original = (index.cw_client, index.INCREMENTAL_EVALUATION, index.EWMA_LOOKBACK_PERIODS)
+        index.cw_client = FakeCloudWatch(self.series)
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+
+    def tearDown(self):
+        index.cw_client, index.INCREMENTAL_EVALUATION, index.EWMA_LOOKBACK_PERIODS = self._original
+        index.fetch_cache.clear()
+        index.retained_series.clear()
+
+    def _newest(self, periods):
+        dimensions = json.dumps({az: [{"Operation": "Ride", "AZ-ID": az}] for az in self.AZS})
+        event = _make_event("use1-az1", algorithm = "EWMA", threshold = "2", dimensions = dimensions)
+        event["StartTime"] = self.now - periods * 60
+        event["EndTime"] = self.now
+        index.fetch_cache.clear()
+        result = get_metric_data(event, _make_metrics())["MetricDataResults"][0]
+        self.assertEqual(len(result["Timestamps"]), periods)
+        return result["Values"][0]
+
+    def test_baseline_clears_an_az_that_is_always_high(self):
+        for incremental in [False, True]:
+            index.INCREMENTAL_EVALUATION = incremental
+            for periods in range(1, 6):
+                index.EWMA_LOOKBACK_PERIODS = 0
+                self.assertEqual(self._newest(periods), 1)
+                index.EWMA_LOOKBACK_PERIODS = 30
+                self.assertEqual(self._newest(periods), 0)
+
+    def test_shift_above_the_baseline_is_detected(self):
+        for t in range(self.now - 180, self.now, 60):
+            self.series["use1-az1"][t] = 60.0
+
+        for periods in range(1, 6):
+            self.assertEqual(self._newest(periods), 1)
+
+    def test_only_the_window_is_returned(self):
+        self._newest(3)
+        request = index.cw_client.requests[-1]
+        self.assertEqual(request["StartTime"], self.now - 3 * 60 - index.EWMA_LOOKBACK_PERIODS * 60)
+
 if __name__ == "__main__":
     unittest.main()